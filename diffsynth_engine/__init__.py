@@ -10,6 +10,8 @@ from .pipelines import (
 )
 from .utils.download import fetch_model, fetch_modelscope_model, fetch_civitai_model
 from .utils.video import load_video, save_video
+from .models.basic.attention import set_global_attn_implementation, set_attention_chunk_budget
+from .utils.gguf import set_gguf_dequant_cache_budget, get_gguf_dequant_cache_stats
 __all__ = [
     "FluxImagePipeline",
     "SDXLImagePipeline",
@@ -22,4 +24,8 @@ __all__ = [
     "fetch_model",
     "fetch_modelscope_model",
     "fetch_civitai_model",
+    "set_global_attn_implementation",
+    "set_attention_chunk_budget",
+    "set_gguf_dequant_cache_budget",
+    "get_gguf_dequant_cache_stats",
 ]
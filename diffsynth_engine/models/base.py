@@ -1,10 +1,13 @@
 import os
 import torch
 import torch.nn as nn
-from typing import Dict, Union
+from typing import Dict, List, Optional, Union
 from safetensors.torch import load_file
 
 from diffsynth_engine.models.utils import no_init_weights
+from diffsynth_engine.models.basic.attention import set_attn_implementation
+from diffsynth_engine.utils.gguf import GGUFParameter
+from diffsynth_engine.utils.quant_linear import replace_quantized_modules
 
 
 class LoRAStateDictConverter:
@@ -25,6 +28,11 @@ class PreTrainedModel(nn.Module):
 
     def load_state_dict(self, state_dict: Dict[str, torch.Tensor], strict: bool = True, assign: bool = False):
         state_dict = self.converter.convert(state_dict)
+        state_dict = replace_quantized_modules(self, state_dict)
+        if any(isinstance(param, GGUFParameter) for param in state_dict.values()):
+            # quantized weights can only be assigned and cannot require grad
+            self.requires_grad_(False)
+            assign = True
         super().load_state_dict(state_dict, strict=strict, assign=assign)
 
     @classmethod
@@ -40,6 +48,12 @@ class PreTrainedModel(nn.Module):
         model.to(device=device, dtype=dtype, non_blocking=True)
         return model
 
+    def set_attn_implementation(self, attn_implementation: str, module_names: Optional[List[str]] = None):
+        """
+        Sets the attention backend of all attention layers, or only of the layers under `module_names`.
+        """
+        set_attn_implementation(self, attn_implementation, module_names=module_names)
+
 
 def split_suffix(name: str):
     suffix_list = [
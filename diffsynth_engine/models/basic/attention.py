@@ -1,11 +1,526 @@
+import functools
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from dataclasses import dataclass
 from einops import rearrange
+from typing import Callable, Dict, List, Optional, Tuple
 
 from diffsynth_engine.utils import logging
+from diffsynth_engine.utils.constants import MB
 
 logger = logging.get_logger(__name__)
 
+HALF_DTYPES = (torch.float16, torch.bfloat16)
+
+
+@dataclass
+class AttentionBackend:
+    """
+    An attention implementation with inputs q: [B, N, Sq, D], k/v: [B, N, Sk, D] and output [B, N, Sq, D].
+
+    name:           registry name, used as `attn_implementation`.
+    func:           func(q, k, v, attn_mask=None, scale=None, **kwargs).
+    is_available:   whether the optional kernel can be imported on this host.
+    device_types:   supported device types, None for any device.
+    dtypes:         supported input dtypes, None for any dtype.
+    supports_mask:  whether `attn_mask` (bool or additive float) is supported.
+    supports_varlen: whether key padding can be given as `k_lens` instead of a mask.
+    max_head_dim:   the maximum supported head dim, None for unlimited.
+    fallback:       the backend to use when this one cannot handle the inputs.
+    extra_kwargs:   names of backend specific keyword arguments passed through `attention`.
+    """
+
+    name: str
+    func: Callable
+    is_available: Callable[[], bool] = lambda: True
+    device_types: Optional[Tuple[str, ...]] = None
+    dtypes: Optional[Tuple[torch.dtype, ...]] = None
+    supports_mask: bool = True
+    supports_varlen: bool = False
+    max_head_dim: Optional[int] = None
+    fallback: Optional[str] = "sdpa"
+    extra_kwargs: Tuple[str, ...] = ()
+
+    def unsupported_reason(self, q: torch.Tensor, attn_mask: Optional[torch.Tensor] = None) -> Optional[str]:
+        if not is_backend_available(self):
+            return "it is not installed or not supported on this platform"
+        if self.device_types is not None and q.device.type not in self.device_types:
+            return f"device '{q.device.type}' is not supported"
+        if self.dtypes is not None and q.dtype not in self.dtypes:
+            return f"dtype {q.dtype} is not supported"
+        if attn_mask is not None and not self.supports_mask:
+            return "attn_mask is not supported"
+        if self.max_head_dim is not None and q.shape[-1] > self.max_head_dim:
+            return f"head_dim {q.shape[-1]} is greater than {self.max_head_dim}"
+        return None
+
+
+_ATTENTION_BACKENDS: Dict[str, AttentionBackend] = {}
+# availability by backend name, a plain dict is read as a constant by compiled blocks while imports would break graphs
+_backend_availability: Dict[str, bool] = {}
+_fallback_warnings = set()
+# overrides the attn_implementation of every layer if set
+_global_attn_implementation: Optional[str] = None
+# max bytes of the score block computed at a time by the "chunked" backend
+_attn_chunk_budget: int = 256 * MB
+
+
+def register_attention_backend(backend: AttentionBackend):
+    _ATTENTION_BACKENDS[backend.name] = backend
+    _backend_availability.pop(backend.name, None)
+
+
+def is_backend_available(backend: AttentionBackend) -> bool:
+    available = _backend_availability.get(backend.name)
+    if available is None:
+        available = _backend_availability[backend.name] = backend.is_available()
+    return available
+
+
+def get_attention_backend(name: str) -> AttentionBackend:
+    if name not in _ATTENTION_BACKENDS:
+        raise ValueError(f"attn_implementation must be one of {tuple(_ATTENTION_BACKENDS)}, but got '{name}'")
+    return _ATTENTION_BACKENDS[name]
+
+
+def list_attention_backends(available_only: bool = False) -> List[str]:
+    return [
+        name for name, backend in _ATTENTION_BACKENDS.items() if not available_only or is_backend_available(backend)
+    ]
+
+
+def set_global_attn_implementation(attn_implementation: Optional[str]):
+    """
+    Forces all attention layers to use `attn_implementation`, e.g. "chunked" for CPU or very high resolution jobs.
+    Pass None to restore the per-layer selection.
+    """
+    global _global_attn_implementation
+    if attn_implementation is not None:
+        get_attention_backend(attn_implementation)
+    _global_attn_implementation = attn_implementation
+
+
+def get_global_attn_implementation() -> Optional[str]:
+    return _global_attn_implementation
+
+
+def set_attention_chunk_budget(num_bytes: int):
+    """
+    Sets the max bytes of the [B, N, q_chunk, kv_chunk] score block of the "chunked" backend.
+    """
+    global _attn_chunk_budget
+    if num_bytes <= 0:
+        raise ValueError(f"attention chunk budget must be positive, but got {num_bytes}")
+    _attn_chunk_budget = num_bytes
+
+
+def resolve_attention_backend(name: str, q: torch.Tensor, attn_mask: Optional[torch.Tensor] = None) -> AttentionBackend:
+    """
+    Returns the first backend in the fallback chain of `name` that can handle the inputs.
+    """
+    backend = get_attention_backend(name)
+    while (reason := backend.unsupported_reason(q, attn_mask)) is not None:
+        if backend.fallback is None:
+            raise RuntimeError(f"attention backend '{backend.name}' cannot be used: {reason}")
+        fallback = get_attention_backend(backend.fallback)
+        if (backend.name, fallback.name, reason) not in _fallback_warnings:
+            _fallback_warnings.add((backend.name, fallback.name, reason))
+            logger.warning(f"'{backend.name}' attention cannot be used since {reason}, fallback to '{fallback.name}'")
+        backend = fallback
+    return backend
+
+
+def make_key_padding_mask(k_lens: torch.Tensor, max_len: int, device) -> torch.Tensor:
+    # [B] -> [B, 1, 1, Sk], True for valid positions
+    positions = torch.arange(max_len, device=device)
+    return (positions[None, :] < k_lens.to(device)[:, None])[:, None, None, :]
+
+
+def attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    attn_impl: str = "sdpa",
+    attn_mask: Optional[torch.Tensor] = None,
+    scale: Optional[float] = None,
+    k_lens: Optional[torch.Tensor] = None,
+    **kwargs,
+) -> torch.Tensor:
+    """
+    q:          [B, N, Sq, D].
+    k, v:       [B, N, Sk, D].
+    attn_impl:  name of a registered attention backend, falls back automatically if it cannot handle the inputs.
+    attn_mask:  bool (True to attend) or additive float mask broadcastable to [B, N, Sq, Sk].
+    scale:      the scaling of QK^T, defaults to 1 / sqrt(D).
+    k_lens:     [B], the valid key length of each sample, keys beyond it are treated as padding.
+    kwargs:     backend specific arguments, e.g. `grid_size` of "sliding_tile", ignored by other backends.
+    """
+    if _global_attn_implementation is not None:
+        attn_impl = _global_attn_implementation
+    backend = resolve_attention_backend(attn_impl, q, attn_mask)
+    # k_lens are kept for the first varlen backend in the fallback chain, e.g. flash_attn_2 for an unavailable
+    # flash_attn_3, and only become a dense padding mask if the chain reaches a backend without varlen support
+    if k_lens is not None and (attn_mask is not None or not backend.supports_varlen):
+        padding_mask = make_key_padding_mask(k_lens, k.shape[2], q.device)
+        if attn_mask is None:
+            attn_mask = padding_mask
+        elif attn_mask.dtype == torch.bool:
+            attn_mask = attn_mask & padding_mask
+        else:
+            attn_mask = attn_mask.masked_fill(padding_mask.logical_not(), float("-inf"))
+        k_lens = None
+        backend = resolve_attention_backend(backend.name, q, attn_mask)
+    kwargs = {key: value for key, value in kwargs.items() if key in backend.extra_kwargs}
+    if k_lens is not None:
+        kwargs["k_lens"] = k_lens
+    return backend.func(q, k, v, attn_mask=attn_mask, scale=scale, **kwargs)
+
+
+def set_attn_implementation(model: nn.Module, attn_implementation: str, module_names: Optional[List[str]] = None):
+    """
+    Sets the attention backend of all attention layers of `model`, or only of the layers under `module_names`,
+    e.g. ["blocks.0", "blocks.1.self_attn"].
+    """
+    get_attention_backend(attn_implementation)
+    for name, module in model.named_modules():
+        if not hasattr(module, "attn_implementation"):
+            continue
+        if module_names is None or any(name == prefix or name.startswith(prefix + ".") for prefix in module_names):
+            module.attn_implementation = attn_implementation
+
+
+# builtin backends
+def eager_attention(q, k, v, attn_mask=None, scale=None):
+    scale = 1 / q.shape[-1] ** 0.5 if scale is None else scale
+    attn = torch.matmul(q * scale, k.transpose(-2, -1))
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn = attn.masked_fill(attn_mask.logical_not(), float("-inf"))
+        else:
+            # a float32 bias promotes the scores, the softmax then runs in float32
+            attn = attn + attn_mask
+    attn = attn.softmax(-1).to(v.dtype)
+    return attn @ v
+
+
+def sdpa_attention(q, k, v, attn_mask=None, scale=None):
+    # the fused kernels on accelerators need a bias of the query dtype, the cpu kernels add a float32 bias as it is
+    if attn_mask is not None and attn_mask.dtype != torch.bool and q.device.type != "cpu":
+        attn_mask = attn_mask.to(q.dtype)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=scale)
+
+
+def get_attention_chunk_sizes(batch_heads: int, q_len: int, kv_len: int) -> Tuple[int, int]:
+    # scores and probabilities of a chunk are kept in float32
+    max_elements = max(_attn_chunk_budget // (2 * 4 * batch_heads), 1)
+    q_chunk_size = min(q_len, 1024)
+    kv_chunk_size = min(kv_len, max(max_elements // q_chunk_size, 64))
+    q_chunk_size = min(q_len, max(max_elements // kv_chunk_size, 1))
+    return q_chunk_size, kv_chunk_size
+
+
+def _slice_mask(attn_mask, q_start, q_end, kv_start, kv_end):
+    if attn_mask is None:
+        return None
+    if attn_mask.ndim >= 2 and attn_mask.shape[-2] > 1:
+        attn_mask = attn_mask[..., q_start:q_end, :]
+    if attn_mask.shape[-1] > 1:
+        attn_mask = attn_mask[..., kv_start:kv_end]
+    return attn_mask
+
+
+def chunked_attention(q, k, v, attn_mask=None, scale=None):
+    """
+    Attention over query and key chunks with online softmax. Only a [B, N, q_chunk, kv_chunk] score block bounded by
+    the chunk budget is alive at a time, so that peak memory grows linearly with the sequence length.
+    """
+    b, n, q_len, kv_len = q.shape[0], q.shape[1], q.shape[2], k.shape[2]
+    q_chunk_size, kv_chunk_size = get_attention_chunk_sizes(b * n, q_len, kv_len)
+    if q_chunk_size == q_len and kv_chunk_size == kv_len:
+        attn_func = sdpa_attention if _sdpa_available() else eager_attention
+        return attn_func(q, k, v, attn_mask=attn_mask, scale=scale)
+
+    scale = 1 / q.shape[-1] ** 0.5 if scale is None else scale
+    out = q.new_empty((b, n, q_len, v.shape[-1]), dtype=v.dtype)
+    for q_start in range(0, q_len, q_chunk_size):
+        q_end = min(q_start + q_chunk_size, q_len)
+        q_chunk = q[:, :, q_start:q_end].float() * scale
+        row_max = q_chunk.new_full((b, n, q_end - q_start, 1), float("-inf"))
+        row_sum = q_chunk.new_zeros((b, n, q_end - q_start, 1))
+        acc = q_chunk.new_zeros((b, n, q_end - q_start, v.shape[-1]))
+        for kv_start in range(0, kv_len, kv_chunk_size):
+            kv_end = min(kv_start + kv_chunk_size, kv_len)
+            scores = q_chunk @ k[:, :, kv_start:kv_end].float().transpose(-2, -1)
+            mask = _slice_mask(attn_mask, q_start, q_end, kv_start, kv_end)
+            if mask is not None:
+                if mask.dtype == torch.bool:
+                    scores.masked_fill_(mask.logical_not(), float("-inf"))
+                else:
+                    scores += mask
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # rows without any valid key so far keep a zero offset to avoid inf - inf
+            safe_max = new_max.masked_fill(new_max == float("-inf"), 0)
+            scores = torch.exp(scores - safe_max)
+            correction = torch.exp(row_max - safe_max)
+            row_sum = row_sum * correction + scores.sum(dim=-1, keepdim=True)
+            acc = acc * correction + scores @ v[:, :, kv_start:kv_end].float()
+            row_max = new_max
+        out[:, :, q_start:q_end] = acc / row_sum
+    return out
+
+
+def _sliding_window_starts(num_tiles: int, window: int) -> Tuple[torch.Tensor, int]:
+    # windows are shifted at the borders so that every tile attends to the same number of tiles
+    window = min(window, num_tiles)
+    return (torch.arange(num_tiles) - window // 2).clamp(0, num_tiles - window), window
+
+
+def get_sliding_tile_layout(
+    grid_size: Tuple[int, int, int],
+    tile_size: Tuple[int, int, int],
+    window_size: Tuple[int, int, int],
+) -> torch.Tensor:
+    """
+    Returns the [num_tiles, window_tiles] indices of the key tiles attended by each query tile, tiles are numbered in
+    (f, h, w) order over the grid padded to multiples of `tile_size`.
+    """
+    num_tiles = [math.ceil(g / t) for g, t in zip(grid_size, tile_size)]
+    offsets = []
+    for n, window in zip(num_tiles, window_size):
+        starts, window = _sliding_window_starts(n, window)
+        offsets.append(starts[:, None] + torch.arange(window)[None, :])  # [n, window]
+    nf, nh, nw = num_tiles
+    f_idx, h_idx, w_idx = offsets
+    index = (
+        f_idx[:, None, None, :, None, None] * nh * nw
+        + h_idx[None, :, None, None, :, None] * nw
+        + w_idx[None, None, :, None, None, :]
+    )
+    return index.reshape(nf * nh * nw, -1)
+
+
+def sliding_tile_attention(
+    q,
+    k,
+    v,
+    attn_mask=None,
+    scale=None,
+    grid_size: Optional[Tuple[int, int, int]] = None,
+    tile_size: Tuple[int, int, int] = (4, 8, 8),
+    window_size: Tuple[int, int, int] = (3, 3, 3),
+    num_global_tokens: int = 64,
+):
+    """
+    Block sparse self-attention over a (f, h, w) token grid. The grid is split into tiles, each query tile attends to
+    the keys of its 3D sliding window of tiles and `num_global_tokens` tokens evenly spaced over the sequence, while the
+    global tokens attend to all keys. Computes dense attention if `grid_size` is not given.
+    """
+    b, n, s, d = q.shape
+    if grid_size is None or q.shape[2] != k.shape[2]:
+        return sdpa_attention(q, k, v, attn_mask=attn_mask, scale=scale)
+    f, h, w = grid_size
+    tf, th, tw = (min(t, g) for t, g in zip(tile_size, grid_size))
+    pad = (0, 0, 0, (-w) % tw, 0, (-h) % th, 0, (-f) % tf)
+
+    def to_tiles(x):
+        x = F.pad(x.unflatten(2, (f, h, w)), pad)
+        return rearrange(x, "b n (nf tf) (nh th) (nw tw) d -> b n (nf nh nw) (tf th tw) d", tf=tf, th=th, tw=tw)
+
+    nh, nw = math.ceil(h / th), math.ceil(w / tw)
+
+    def from_tiles(x):
+        x = rearrange(x, "b n (nf nh nw) (tf th tw) d -> b n (nf tf) (nh th) (nw tw) d", nh=nh, nw=nw, tf=tf, th=th)
+        return x[:, :, :f, :h, :w].flatten(2, 4)
+
+    layout = get_sliding_tile_layout(grid_size, (tf, th, tw), window_size).to(q.device)  # [T, W]
+    num_tiles, window_tiles = layout.shape
+    tile_volume = tf * th * tw
+    # key padding of the tiles at the borders of the grid
+    key_valid = to_tiles(q.new_ones((1, 1, s, 1), dtype=torch.bool))[0, 0, :, :, 0]  # [T, V]
+    f_tile, h_tile, w_tile = (torch.arange(g, device=q.device) // t for g, t in zip(grid_size, (tf, th, tw)))
+    tile_of_token = (f_tile[:, None, None] * nh + h_tile[None, :, None]) * nw + w_tile[None, None, :]
+    tile_of_token = tile_of_token.flatten()
+
+    num_global_tokens = min(num_global_tokens, s)
+    global_index = torch.linspace(0, s - 1, num_global_tokens, device=q.device).long() if num_global_tokens else None
+
+    q_tiles, k_tiles, v_tiles = to_tiles(q), to_tiles(k), to_tiles(v)
+    out = torch.empty_like(q_tiles, dtype=v.dtype)
+    # bound the [B, N, tiles, V, W * V] score block by the chunk budget
+    max_elements = max(_attn_chunk_budget // (4 * b * n), 1)
+    tile_chunk_size = max(max_elements // (tile_volume * (window_tiles * tile_volume + num_global_tokens)), 1)
+    for start in range(0, num_tiles, tile_chunk_size):
+        end = min(start + tile_chunk_size, num_tiles)
+        index = layout[start:end]  # [c, W]
+        k_chunk = k_tiles[:, :, index].flatten(3, 4)  # [B, N, c, W * V, D]
+        v_chunk = v_tiles[:, :, index].flatten(3, 4)
+        mask = key_valid[index].flatten(1, 2)  # [c, W * V]
+        if global_index is not None:
+            k_chunk = torch.cat([k_chunk, k[:, :, None, global_index].expand(-1, -1, end - start, -1, -1)], dim=3)
+            v_chunk = torch.cat([v_chunk, v[:, :, None, global_index].expand(-1, -1, end - start, -1, -1)], dim=3)
+            # global tokens inside the window are already attended
+            in_window = (tile_of_token[global_index][None, None, :] == index[:, :, None]).any(dim=1)  # [c, G]
+            mask = torch.cat([mask, in_window.logical_not()], dim=1)
+        out[:, :, start:end] = sdpa_attention(
+            q_tiles[:, :, start:end], k_chunk, v_chunk, attn_mask=mask[:, None, :], scale=scale
+        )
+    out = from_tiles(out)
+    if global_index is not None:
+        out[:, :, global_index] = sdpa_attention(q[:, :, global_index], k, v, scale=scale)
+    return out
+
+
+def xformers_attention(q, k, v, attn_mask=None, scale=None):
+    import xformers.ops as xops
+
+    q, k, v = (rearrange(t, "b n s d -> b s n d") for t in (q, k, v))
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn_mask = torch.zeros_like(attn_mask, dtype=q.dtype).masked_fill(attn_mask.logical_not(), float("-inf"))
+        attn_mask = attn_mask.to(q.dtype).expand(q.shape[0], q.shape[2], q.shape[1], k.shape[1])
+    out = xops.memory_efficient_attention(q, k, v, attn_bias=attn_mask, scale=scale)
+    return rearrange(out, "b s n d -> b n s d")
+
+
+def _flash_attention(q, k, v, attn_mask=None, scale=None, k_lens=None, version=2):
+    if version == 3:
+        import flash_attn_interface as flash_attn_module
+    else:
+        import flash_attn as flash_attn_module
+
+    b, lq, lk = q.shape[0], q.shape[2], k.shape[2]
+    q, k, v = (rearrange(t, "b n s d -> b s n d") for t in (q, k, v))
+    if k_lens is None:
+        out = flash_attn_module.flash_attn_func(q, k, v, softmax_scale=scale)
+    else:
+        k_lens = k_lens.to(device=q.device, dtype=torch.int32)
+        lens = k_lens.tolist()
+        k = torch.cat([u[:length] for u, length in zip(k, lens)])
+        v = torch.cat([u[:length] for u, length in zip(v, lens)])
+        cu_seqlens_q = torch.arange(0, (b + 1) * lq, lq, dtype=torch.int32, device=q.device)
+        cu_seqlens_k = F.pad(k_lens.cumsum(0, dtype=torch.int32), (1, 0))
+        out = flash_attn_module.flash_attn_varlen_func(
+            q.flatten(0, 1),
+            k,
+            v,
+            cu_seqlens_q=cu_seqlens_q,
+            cu_seqlens_k=cu_seqlens_k,
+            max_seqlen_q=lq,
+            max_seqlen_k=lk,
+            softmax_scale=scale,
+        )
+    # flash attention 3 returns (out, softmax_lse)
+    if isinstance(out, tuple):
+        out = out[0]
+    out = out.reshape(b, lq, *out.shape[-2:])
+    return rearrange(out, "b s n d -> b n s d")
+
+
+def flash_attention_2(q, k, v, attn_mask=None, scale=None, k_lens=None):
+    return _flash_attention(q, k, v, attn_mask=attn_mask, scale=scale, k_lens=k_lens, version=2)
+
+
+def flash_attention_3(q, k, v, attn_mask=None, scale=None, k_lens=None):
+    return _flash_attention(q, k, v, attn_mask=attn_mask, scale=scale, k_lens=k_lens, version=3)
+
+
+def sage_attention(q, k, v, attn_mask=None, scale=None):
+    from sageattention import sageattn
+
+    return sageattn(q, k, v, tensor_layout="HND", is_causal=False, sm_scale=scale)
+
+
+def sparge_attention(q, k, v, attn_mask=None, scale=None):
+    from spas_sage_attn import spas_sage2_attn_meansim_cuda
+
+    return spas_sage2_attn_meansim_cuda(q, k, v, tensor_layout="HND", scale=scale).to(q.dtype)
+
+
+def _is_importable(module_name: str) -> Callable[[], bool]:
+    @functools.lru_cache(maxsize=None)
+    def is_available() -> bool:
+        try:
+            __import__(module_name)
+            return True
+        except ImportError:
+            return False
+
+    return is_available
+
+
+@functools.lru_cache(maxsize=None)
+def _sdpa_available() -> bool:
+    return hasattr(F, "scaled_dot_product_attention") and not torch.backends.mps.is_available()
+
+
+register_attention_backend(AttentionBackend(name="eager", func=eager_attention, fallback=None))
+register_attention_backend(
+    AttentionBackend(name="sdpa", func=sdpa_attention, is_available=_sdpa_available, fallback="eager")
+)
+register_attention_backend(AttentionBackend(name="chunked", func=chunked_attention, fallback=None))
+register_attention_backend(
+    AttentionBackend(
+        name="sliding_tile",
+        func=sliding_tile_attention,
+        is_available=_sdpa_available,
+        supports_mask=False,
+        extra_kwargs=("grid_size", "tile_size", "window_size", "num_global_tokens"),
+    )
+)
+register_attention_backend(
+    AttentionBackend(
+        name="xformers", func=xformers_attention, is_available=_is_importable("xformers.ops"), device_types=("cuda",)
+    )
+)
+register_attention_backend(
+    AttentionBackend(
+        name="flash_attn_2",
+        func=flash_attention_2,
+        is_available=_is_importable("flash_attn"),
+        device_types=("cuda",),
+        dtypes=HALF_DTYPES,
+        supports_mask=False,
+        supports_varlen=True,
+        max_head_dim=256,
+    )
+)
+register_attention_backend(
+    AttentionBackend(
+        name="flash_attn_3",
+        func=flash_attention_3,
+        is_available=_is_importable("flash_attn_interface"),
+        device_types=("cuda",),
+        dtypes=HALF_DTYPES,
+        supports_mask=False,
+        supports_varlen=True,
+        max_head_dim=256,
+        fallback="flash_attn_2",
+    )
+)
+register_attention_backend(
+    AttentionBackend(
+        name="sage_attn",
+        func=sage_attention,
+        is_available=_is_importable("sageattention"),
+        device_types=("cuda",),
+        dtypes=HALF_DTYPES,
+        supports_mask=False,
+    )
+)
+register_attention_backend(
+    AttentionBackend(
+        name="sparge_attn",
+        func=sparge_attention,
+        is_available=_is_importable("spas_sage_attn"),
+        device_types=("cuda",),
+        dtypes=HALF_DTYPES,
+        supports_mask=False,
+        fallback="sage_attn",
+    )
+)
+
 
 class Attention(nn.Module):
     def __init__(
@@ -34,70 +549,17 @@ class Attention(nn.Module):
         self.to_out = nn.Linear(dim_inner, q_dim, bias=bias_out, device=device, dtype=dtype)
 
         self.scale = scale
-        self.attn_implementation = self._get_actual_attn_implementation(attn_implementation)
-
-    @staticmethod
-    def _get_actual_attn_implementation(attn_implementation):
-        supported_implementations = ("xformers", "sdpa", "eager")
-        if attn_implementation not in supported_implementations:
-            raise ValueError(
-                f"attn_implementation must be one of {supported_implementations}, but got '{attn_implementation}'"
-            )
-
-        actual_implementation = "eager" if attn_implementation == "eager" else ""
-        if attn_implementation == "xformers":
-            try:
-                from xformers.ops import memory_efficient_attention
-
-                actual_implementation = "xformers"
-            except ImportError:
-                pass
-        if not actual_implementation or attn_implementation == "sdpa":
-            use_mps = torch.backends.mps.is_available()
-            if hasattr(torch.nn.functional, "scaled_dot_product_attention") and not use_mps:
-                actual_implementation = "sdpa"
-
-        if actual_implementation != attn_implementation:
-            warning_msg = (
-                "xformers is not supported on this platform"
-                if attn_implementation == "xformers"
-                else "torch.nn.functional.scaled_dot_product_attention is not supported"
-            )
-            logger.warning(f"{warning_msg}, fallback to '{actual_implementation}' attention")
-        return actual_implementation
-
-    def sdpa_attn(self, hidden_states, encoder_hidden_states, attn_mask=None):
-        q = self.to_q(hidden_states)
-        k = self.to_k(encoder_hidden_states)
-        v = self.to_v(encoder_hidden_states)
-
-        q = rearrange(q, "b s (n d) -> b n s d", n=self.num_heads)
-        k = rearrange(k, "b s (n d) -> b n s d", n=self.num_heads)
-        v = rearrange(v, "b s (n d) -> b n s d", n=self.num_heads)
+        self.attn_implementation = get_attention_backend(attn_implementation).name
 
-        hidden_states = nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=self.scale)
-        hidden_states = rearrange(hidden_states, "b n s d -> b s (n d)", n=self.num_heads)
-        hidden_states = hidden_states.to(q.dtype)
-        hidden_states = self.to_out(hidden_states)
-        return hidden_states
-
-    def xformers_attn(self, hidden_states, encoder_hidden_states, attn_mask=None):
-        import xformers.ops as xops
-
-        q = self.to_q(hidden_states)
-        k = self.to_k(encoder_hidden_states)
-        v = self.to_v(encoder_hidden_states)
-        q = rearrange(q, "b s (n d) -> b s n d", n=self.num_heads)
-        k = rearrange(k, "b s (n d) -> b s n d", n=self.num_heads)
-        v = rearrange(v, "b s (n d) -> b s n d", n=self.num_heads)
-
-        hidden_states = xops.memory_efficient_attention(q, k, v, attn_bias=attn_mask, scale=self.scale)
-        hidden_states = rearrange(hidden_states, "b s n d -> b s (n d)")
-        hidden_states = hidden_states.to(q.dtype)
-        hidden_states = self.to_out(hidden_states)
-        return hidden_states
+    def forward(
+        self,
+        hidden_states,
+        encoder_hidden_states=None,
+        attn_mask=None,
+    ):
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
 
-    def eager_attn(self, hidden_states, encoder_hidden_states, attn_mask=None):
         q = self.to_q(hidden_states)
         k = self.to_k(encoder_hidden_states)
         v = self.to_v(encoder_hidden_states)
@@ -105,33 +567,8 @@ class Attention(nn.Module):
         k = rearrange(k, "b s (n d) -> b n s d", n=self.num_heads)
         v = rearrange(v, "b s (n d) -> b n s d", n=self.num_heads)
 
-        hidden_states = self._eager_attn(q, k, v, attn_bias=attn_mask, scale=self.scale)
+        hidden_states = attention(q, k, v, attn_impl=self.attn_implementation, attn_mask=attn_mask, scale=self.scale)
         hidden_states = rearrange(hidden_states, "b n s d -> b s (n d)", n=self.num_heads)
         hidden_states = hidden_states.to(q.dtype)
         hidden_states = self.to_out(hidden_states)
         return hidden_states
-
-    @staticmethod
-    def _eager_attn(query, key, value, attn_bias=None, scale=None):
-        scale = 1 / query.shape[-1] ** 0.5 if scale is None else scale
-        query = query * scale
-        attn = torch.matmul(query, key.transpose(-2, -1))
-        if attn_bias is not None:
-            attn = attn + attn_bias
-        attn = attn.softmax(-1)
-        return attn @ value
-
-    def forward(
-        self,
-        hidden_states,
-        encoder_hidden_states=None,
-        attn_mask=None,
-    ):
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-
-        if self.attn_implementation == "xformers":
-            return self.xformers_attn(hidden_states, encoder_hidden_states, attn_mask)
-        if self.attn_implementation == "sdpa":
-            return self.sdpa_attn(hidden_states, encoder_hidden_states, attn_mask)
-        return self.eager_attn(hidden_states, encoder_hidden_states, attn_mask)
@@ -0,0 +1,53 @@
+import math
+import torch
+import torch.nn.functional as F
+
+# Elementwise chains run by every DiT block. The fused ops read and write the activations once, through a single
+# PyTorch kernel (addcmul, gelu, rms_norm) in eager mode and a single generated kernel inside compiled blocks.
+# The *_reference ops compute the same results step by step and are kept for parity tests and benchmarks.
+
+
+def modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    """
+    x * (1 + scale) + shift, with shift and scale broadcast over the tokens of x.
+    """
+    # 1 + scale only touches the [B, 1, C] modulation
+    return torch.addcmul(shift, x, 1 + scale)
+
+
+def modulate_reference(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor) -> torch.Tensor:
+    return x * (1 + scale) + shift
+
+
+def gate_add(x: torch.Tensor, gate: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    """
+    The gated residual x + gate * y.
+    """
+    return torch.addcmul(x, gate, y)
+
+
+def gate_add_reference(x: torch.Tensor, gate: torch.Tensor, y: torch.Tensor) -> torch.Tensor:
+    return x + gate * y
+
+
+def rms_norm(x: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    """
+    Normalizes x in float32 and scales the result in the dtype of x by weight.
+    """
+    return F.rms_norm(x, x.shape[-1:], weight, eps)
+
+
+def rms_norm_reference(x: torch.Tensor, weight: torch.Tensor, eps: float) -> torch.Tensor:
+    variance = x.float().pow(2).mean(dim=-1, keepdim=True)
+    return (x.float() * torch.rsqrt(variance + eps)).to(x.dtype) * weight
+
+
+def gelu_tanh(x: torch.Tensor) -> torch.Tensor:
+    """
+    The tanh approximation of GELU used by T5 and the DiT feed forward layers.
+    """
+    return F.gelu(x, approximate="tanh")
+
+
+def gelu_tanh_reference(x: torch.Tensor) -> torch.Tensor:
+    return 0.5 * x * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * torch.pow(x, 3.0))))
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
-import math
+
+from diffsynth_engine.models.basic.fused_ops import gelu_tanh, modulate, rms_norm
 
 
 class AdaLayerNorm(nn.Module):
@@ -14,11 +15,11 @@ class AdaLayerNorm(nn.Module):
         emb = self.linear(nn.functional.silu(emb))
         if self.single:
             scale, shift = emb.unsqueeze(1).chunk(2, dim=2)
-            x = self.norm(x) * (1 + scale) + shift
+            x = modulate(self.norm(x), shift, scale)
             return x
         else:
             shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = emb.unsqueeze(1).chunk(6, dim=2)
-            x = self.norm(x) * (1 + scale_msa) + shift_msa
+            x = modulate(self.norm(x), shift_msa, scale_msa)
             return x, gate_msa, shift_mlp, scale_mlp, gate_mlp
 
 
@@ -32,7 +33,7 @@ class AdaLayerNormSingle(nn.Module):
     def forward(self, x, emb):
         emb = self.linear(self.silu(emb))
         shift_msa, scale_msa, gate_msa = emb.chunk(3, dim=1)
-        x = self.norm(x) * (1 + scale_msa[:, None]) + shift_msa[:, None]
+        x = modulate(self.norm(x), shift_msa[:, None], scale_msa[:, None])
         return x, gate_msa
 
 
@@ -65,17 +66,14 @@ class RoPEEmbedding(nn.Module):
 
 
 class RMSNorm(nn.Module):
-    def __init__(self, dim, eps, device: str, dtype: torch.dtype):
+    def __init__(self, dim, eps=1e-6, device: str = "cuda:0", dtype: torch.dtype = torch.bfloat16):
         super().__init__()
+        self.dim = dim
         self.weight = nn.Parameter(torch.ones((dim,), device=device, dtype=dtype))
         self.eps = eps
 
     def forward(self, hidden_states):
-        input_dtype = hidden_states.dtype
-        variance = hidden_states.to(torch.float32).square().mean(-1, keepdim=True)
-        hidden_states = hidden_states * torch.rsqrt(variance + self.eps)
-        hidden_states = hidden_states.to(input_dtype) * self.weight
-        return hidden_states
+        return rms_norm(hidden_states, self.weight, self.eps)
 
 
 class NewGELUActivation(nn.Module):
@@ -85,4 +83,4 @@ class NewGELUActivation(nn.Module):
     """
 
     def forward(self, input: "torch.Tensor") -> "torch.Tensor":
-        return 0.5 * input * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (input + 0.044715 * torch.pow(input, 3.0))))
+        return gelu_tanh(input)
@@ -2,7 +2,9 @@ import os
 import json
 import torch
 import torch.nn as nn
-from typing import Dict
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from typing import Callable, Dict, Optional
 
 from diffsynth_engine.models.basic.attention import Attention
 from diffsynth_engine.models.basic.unet_helper import ResnetBlock, UpSampler, DownSampler
@@ -17,6 +19,132 @@ with open(VAE_CONFIG_FILE, "r") as f:
     config = json.load(f)
 
 
+def build_1d_mask(length: int, left_bound: bool, right_bound: bool, border_width: int) -> torch.Tensor:
+    x = torch.ones((length,))
+    if not left_bound:
+        x[:border_width] = (torch.arange(border_width) + 1) / border_width
+    if not right_bound:
+        x[-border_width:] = torch.flip((torch.arange(border_width) + 1) / border_width, dims=(0,))
+    return x
+
+
+def build_mask(height: int, width: int, is_bound, border_width) -> torch.Tensor:
+    h = build_1d_mask(height, is_bound[0], is_bound[1], border_width[0])
+    w = build_1d_mask(width, is_bound[2], is_bound[3], border_width[1])
+    return torch.minimum(h.view(-1, 1), w.view(1, -1)).view(1, 1, height, width)
+
+
+class GroupNormStats:
+    """
+    Group norm statistics shared by all tiles of a sample: the moments of every GroupNorm of module are recorded over
+    the tiles of a first pass and then used to normalize every tile, so that no tile is normalized by its own content.
+    """
+
+    def __init__(self, module: nn.Module):
+        self.norms = [m for m in module.modules() if isinstance(m, nn.GroupNorm)]
+        # norm -> [sum, sum of squares, count] of its groups, then norm -> (mean, rstd)
+        self.moments = {}
+        self.stats = {}
+
+    def _record(self, norm: nn.GroupNorm, x: torch.Tensor) -> torch.Tensor:
+        x_ = x.reshape(x.shape[0], norm.num_groups, -1).float()
+        moments = self.moments.setdefault(norm, [0, 0, 0])
+        moments[0] = moments[0] + x_.sum(dim=2)
+        moments[1] = moments[1] + x_.square().sum(dim=2)
+        moments[2] += x_.shape[2]
+        return norm._forward(x)
+
+    def _apply(self, norm: nn.GroupNorm, x: torch.Tensor) -> torch.Tensor:
+        mean, rstd = self.stats[norm]
+        B, C = x.shape[:2]
+        mean = mean.repeat_interleave(C // norm.num_groups, dim=1)
+        scale = rstd.repeat_interleave(C // norm.num_groups, dim=1)
+        if norm.affine:
+            scale = scale * norm.weight.float()
+        shift = -mean * scale
+        if norm.affine:
+            shift = shift + norm.bias.float()
+        shape = (B, C) + (1,) * (x.dim() - 2)
+        return torch.addcmul(shift.view(shape).to(x.dtype), x, scale.view(shape).to(x.dtype))
+
+    @contextmanager
+    def _patch(self, forward):
+        for norm in self.norms:
+            norm._forward, norm.forward = norm.forward, partial(forward, norm)
+        try:
+            yield
+        finally:
+            for norm in self.norms:
+                del norm.forward, norm._forward
+
+    @contextmanager
+    def recording(self):
+        with self._patch(self._record):
+            yield
+        for norm, (x_sum, x_sq_sum, count) in self.moments.items():
+            mean = x_sum / count
+            var = (x_sq_sum / count - mean.square()).clamp_(min=0)
+            self.stats[norm] = (mean, torch.rsqrt(var + norm.eps))
+        self.moments.clear()
+
+    @contextmanager
+    def applying(self):
+        with self._patch(self._apply):
+            yield
+
+
+def tiled_forward(
+    forward: Callable[[torch.Tensor], torch.Tensor],
+    sample: torch.Tensor,
+    tile_size: int,
+    tile_stride: int,
+    scale_factor: float,
+    out_channels: int,
+    module: Optional[nn.Module] = None,
+) -> torch.Tensor:
+    """
+    Runs forward on overlapping tiles of sample and blends the outputs with masks that fade out over the overlaps,
+    the way WanVideoVAE.tiled_decode does. tile_size and tile_stride are in pixels of sample, scale_factor is the
+    size of the output relative to sample.
+
+    With module, the GroupNorms of module normalize every tile by the statistics of the whole sample, recorded by a
+    first pass over the tiles, at the cost of running every tile twice. The statistics of the overlaps are counted
+    once per tile. Attention still only sees the tokens of a tile.
+    """
+    B, _, H, W = sample.shape
+    tasks = []
+    for h in range(0, H, tile_stride):
+        if h - tile_stride >= 0 and h - tile_stride + tile_size >= H:
+            continue
+        for w in range(0, W, tile_stride):
+            if w - tile_stride >= 0 and w - tile_stride + tile_size >= W:
+                continue
+            tasks.append((h, h + tile_size, w, w + tile_size))
+
+    norm_stats = GroupNormStats(module) if module is not None and len(tasks) > 1 else None
+    if norm_stats is not None:
+        with norm_stats.recording():
+            for h, h_, w, w_ in tasks:
+                forward(sample[:, :, h:h_, w:w_])
+
+    border_width = int((tile_size - tile_stride) * scale_factor)
+    weight = torch.zeros(1, 1, int(H * scale_factor), int(W * scale_factor), device=sample.device)
+    values = torch.zeros(B, out_channels, *weight.shape[2:], device=sample.device)
+    with norm_stats.applying() if norm_stats is not None else nullcontext():
+        for h, h_, w, w_ in tasks:
+            tile = forward(sample[:, :, h:h_, w:w_])
+            mask = build_mask(
+                tile.shape[2],
+                tile.shape[3],
+                is_bound=(h == 0, h_ >= H, w == 0, w_ >= W),
+                border_width=(border_width,) * 2,
+            ).to(sample.device)
+            target_h, target_w = int(h * scale_factor), int(w * scale_factor)
+            values[:, :, target_h : target_h + tile.shape[2], target_w : target_w + tile.shape[3]] += tile * mask
+            weight[:, :, target_h : target_h + tile.shape[2], target_w : target_w + tile.shape[3]] += mask
+    return (values / weight).to(sample.dtype)
+
+
 class VAEStateDictConverter(StateDictConverter):
     def __init__(self, has_encoder: bool = False, has_decoder: bool = False):
         self.has_encoder = has_encoder
@@ -167,10 +295,13 @@ class VAEDecoder(PreTrainedModel):
         self.conv_out = nn.Conv2d(128, 3, kernel_size=3, padding=1, device=device, dtype=dtype)
 
     def forward(self, sample, tiled=False, tile_size=64, tile_stride=32, **kwargs):
+        if tiled:
+            # tile_size and tile_stride in latent pixels
+            return tiled_forward(
+                self.forward, sample, tile_size, tile_stride, scale_factor=8, out_channels=3, module=self
+            )
         original_dtype = sample.dtype
         sample = sample.to(dtype=next(iter(self.parameters())).dtype)
-        if tiled:
-            raise NotImplementedError()
 
         # 1. pre-process
         sample = sample / self.scaling_factor + self.shift_factor
@@ -274,10 +405,19 @@ class VAEEncoder(PreTrainedModel):
         self.conv_out = nn.Conv2d(512, 2 * latent_channels, kernel_size=3, padding=1, device=device, dtype=dtype)
 
     def forward(self, sample, tiled=False, tile_size=64, tile_stride=32, **kwargs):
+        if tiled:
+            # tile_size and tile_stride in latent pixels, the same tiles as decoding
+            return tiled_forward(
+                self.forward,
+                sample,
+                tile_size * 8,
+                tile_stride * 8,
+                scale_factor=1 / 8,
+                out_channels=self.latent_channels,
+                module=self,
+            )
         original_dtype = sample.dtype
         sample = sample.to(dtype=next(iter(self.parameters())).dtype)
-        if tiled:
-            raise NotImplementedError()
 
         # 1. pre-process
         hidden_states = self.conv_in(sample)
@@ -1,16 +1,19 @@
 import json
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from typing import Dict
 from einops import rearrange
 
 from diffsynth_engine.models.basic.transformer_helper import AdaLayerNorm, AdaLayerNormSingle, RoPEEmbedding, RMSNorm
+from diffsynth_engine.models.basic.fused_ops import gate_add, gelu_tanh, modulate
 from diffsynth_engine.models.basic.timestep import TimestepEmbeddings
+from diffsynth_engine.models.basic.attention import attention
+from diffsynth_engine.models.basic.lora import LoRALinear
 from diffsynth_engine.models.base import PreTrainedModel, StateDictConverter
 from diffsynth_engine.models.utils import no_init_weights
-from diffsynth_engine.utils.gguf import gguf_inference
-from diffsynth_engine.utils.fp8_linear import fp8_inference
 from diffsynth_engine.utils.constants import FLUX_DIT_CONFIG_FILE
+from diffsynth_engine.utils.compile import compile_blocks
 from diffsynth_engine.utils import logging
 
 logger = logging.get_logger(__name__)
@@ -18,8 +21,6 @@ logger = logging.get_logger(__name__)
 with open(FLUX_DIT_CONFIG_FILE, "r") as f:
     config = json.load(f)
 
-_attn_func = nn.functional.scaled_dot_product_attention
-
 
 class FluxDiTStateDictConverter(StateDictConverter):
     def __init__(self):
@@ -137,6 +138,7 @@ class FluxJointAttention(nn.Module):
         super().__init__()
         self.num_heads = num_heads
         self.head_dim = head_dim
+        self.attn_implementation = "sdpa"
         self.only_out_a = only_out_a
 
         self.a_to_qkv = nn.Linear(dim_a, dim_a * 3, device=device, dtype=dtype)
@@ -179,7 +181,7 @@ class FluxJointAttention(nn.Module):
 
         q, k = self.apply_rope(q, k, image_rotary_emb)
 
-        hidden_states = _attn_func(q, k, v)
+        hidden_states = attention(q, k, v, attn_impl=self.attn_implementation)
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_dim)
         hidden_states = hidden_states.to(q.dtype)
         hidden_states_b, hidden_states_a = (
@@ -224,14 +226,14 @@ class FluxJointTransformerBlock(nn.Module):
         attn_output_a, attn_output_b = self.attn(norm_hidden_states_a, norm_hidden_states_b, image_rotary_emb)
 
         # Part A
-        hidden_states_a = hidden_states_a + gate_msa_a * attn_output_a
-        norm_hidden_states_a = self.norm2_a(hidden_states_a) * (1 + scale_mlp_a) + shift_mlp_a
-        hidden_states_a = hidden_states_a + gate_mlp_a * self.ff_a(norm_hidden_states_a)
+        hidden_states_a = gate_add(hidden_states_a, gate_msa_a, attn_output_a)
+        norm_hidden_states_a = modulate(self.norm2_a(hidden_states_a), shift_mlp_a, scale_mlp_a)
+        hidden_states_a = gate_add(hidden_states_a, gate_mlp_a, self.ff_a(norm_hidden_states_a))
 
         # Part B
-        hidden_states_b = hidden_states_b + gate_msa_b * attn_output_b
-        norm_hidden_states_b = self.norm2_b(hidden_states_b) * (1 + scale_mlp_b) + shift_mlp_b
-        hidden_states_b = hidden_states_b + gate_mlp_b * self.ff_b(norm_hidden_states_b)
+        hidden_states_b = gate_add(hidden_states_b, gate_msa_b, attn_output_b)
+        norm_hidden_states_b = modulate(self.norm2_b(hidden_states_b), shift_mlp_b, scale_mlp_b)
+        hidden_states_b = gate_add(hidden_states_b, gate_mlp_b, self.ff_b(norm_hidden_states_b))
 
         return hidden_states_a, hidden_states_b
 
@@ -241,6 +243,7 @@ class FluxSingleAttention(nn.Module):
         super().__init__()
         self.num_heads = num_heads
         self.head_dim = head_dim
+        self.attn_implementation = "sdpa"
 
         self.a_to_qkv = nn.Linear(dim_a, dim_a * 3, device=device, dtype=dtype)
 
@@ -264,7 +267,7 @@ class FluxSingleAttention(nn.Module):
 
         q, k = self.apply_rope(q_a, k_a, image_rotary_emb)
 
-        hidden_states = _attn_func(q, k, v)
+        hidden_states = attention(q, k, v, attn_impl=self.attn_implementation)
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_dim)
         hidden_states = hidden_states.to(q.dtype)
         return hidden_states
@@ -275,6 +278,7 @@ class FluxSingleTransformerBlock(nn.Module):
         super().__init__()
         self.num_heads = num_attention_heads
         self.head_dim = dim // num_attention_heads
+        self.attn_implementation = "sdpa"
         self.dim = dim
 
         self.norm = AdaLayerNormSingle(dim, device=device, dtype=dtype)
@@ -283,6 +287,8 @@ class FluxSingleTransformerBlock(nn.Module):
         self.norm_k_a = RMSNorm(self.head_dim, eps=1e-6, device=device, dtype=dtype)
 
         self.proj_out = nn.Linear(dim * 5, dim)
+        self.ffn_chunk_size = None
+        self.chunk_modulation = False
 
     def apply_rope(self, xq, xk, freqs_cis):
         xq_ = xq.float().reshape(*xq.shape[:-1], -1, 1, 2)
@@ -300,23 +306,67 @@ class FluxSingleTransformerBlock(nn.Module):
 
         q, k = self.apply_rope(q, k, image_rotary_emb)
 
-        hidden_states = _attn_func(q, k, v)
+        hidden_states = attention(q, k, v, attn_impl=self.attn_implementation)
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_dim)
         hidden_states = hidden_states.to(q.dtype)
         return hidden_states
 
+    def project_rows(self, x, start, end):
+        # rows [start, end) of to_qkv_mlp, other linears (gguf, fp8) project the whole chunk and keep the rows
+        linear = self.to_qkv_mlp
+        if type(linear) not in (nn.Linear, LoRALinear):
+            return linear(x)[..., start:end]
+        bias = None if linear.bias is None else linear.bias[start:end]
+        w_x = F.linear(x, linear.weight[start:end], bias)
+        for lora in getattr(linear, "_lora_dict", {}).values():
+            w_x += lora(x)[..., start:end]
+        return w_x
+
+    def chunked_forward(self, hidden_states_a, temb, image_rotary_emb):
+        # only the [B, S, 3 * dim] qkv and the attention output exist in full, the mlp branch of to_qkv_mlp, the gelu
+        # and proj_out run on chunks of the sequence after the attention
+        chunk_size = self.ffn_chunk_size
+        shift, scale, gate = self.norm.linear(self.norm.silu(temb))[:, None].chunk(3, dim=2)
+        norm_hidden_states = None if self.chunk_modulation else modulate(self.norm.norm(hidden_states_a), shift, scale)
+
+        def norm_chunk(start):
+            if norm_hidden_states is None:
+                return modulate(self.norm.norm(hidden_states_a[:, start : start + chunk_size]), shift, scale)
+            return norm_hidden_states[:, start : start + chunk_size]
+
+        batch_size, seq_len = hidden_states_a.shape[:2]
+        qkv = None
+        for start in range(0, seq_len, chunk_size):
+            x = self.project_rows(norm_chunk(start), 0, self.dim * 3)
+            if qkv is None:
+                qkv = x.new_empty(batch_size, seq_len, self.dim * 3)
+            qkv[:, start : start + chunk_size] = x
+
+        attn_output = self.process_attention(qkv, image_rotary_emb)
+        del qkv
+        output = None
+        for start in range(0, seq_len, chunk_size):
+            mlp_hidden_states = gelu_tanh(self.project_rows(norm_chunk(start), self.dim * 3, self.dim * 7))
+            x = torch.cat([attn_output[:, start : start + chunk_size], mlp_hidden_states], dim=2)
+            x = gate_add(hidden_states_a[:, start : start + chunk_size], gate, self.proj_out(x))
+            if output is None:
+                output = x.new_empty(batch_size, seq_len, x.shape[2])
+            output[:, start : start + chunk_size] = x
+        return output
+
     def forward(self, hidden_states_a, hidden_states_b, temb, image_rotary_emb):
+        if self.ffn_chunk_size is not None:
+            return self.chunked_forward(hidden_states_a, temb, image_rotary_emb), hidden_states_b
         residual = hidden_states_a
         norm_hidden_states, gate = self.norm(hidden_states_a, emb=temb)
         hidden_states_a = self.to_qkv_mlp(norm_hidden_states)
         attn_output, mlp_hidden_states = hidden_states_a[:, :, : self.dim * 3], hidden_states_a[:, :, self.dim * 3 :]
 
         attn_output = self.process_attention(attn_output, image_rotary_emb)
-        mlp_hidden_states = nn.functional.gelu(mlp_hidden_states, approximate="tanh")
+        mlp_hidden_states = gelu_tanh(mlp_hidden_states)
 
         hidden_states_a = torch.cat([attn_output, mlp_hidden_states], dim=2)
-        hidden_states_a = gate.unsqueeze(1) * self.proj_out(hidden_states_a)
-        hidden_states_a = residual + hidden_states_a
+        hidden_states_a = gate_add(residual, gate.unsqueeze(1), self.proj_out(hidden_states_a))
 
         return hidden_states_a, hidden_states_b
 
@@ -331,7 +381,7 @@ class AdaLayerNormContinuous(nn.Module):
     def forward(self, x, conditioning):
         emb = self.linear(self.silu(conditioning))
         scale, shift = torch.chunk(emb, 2, dim=1)
-        x = self.norm(x) * (1 + scale)[:, None] + shift[:, None]
+        x = modulate(self.norm(x), shift[:, None], scale[:, None])
         return x
 
 
@@ -389,6 +439,26 @@ class FluxDiT(PreTrainedModel):
 
         return latent_image_ids
 
+    def enable_chunked_ffn(self, chunk_size: int = 4096, chunk_modulation: bool = False):
+        """
+        Runs the projections, the gelu and proj_out of the single blocks over `chunk_size` tokens at a time. With
+        `chunk_modulation`, the norm and modulation are chunked as well.
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"ffn chunk size must be positive, but got {chunk_size}")
+        for block in self.single_blocks:
+            block.ffn_chunk_size = chunk_size
+            block.chunk_modulation = chunk_modulation
+
+    def disable_chunked_ffn(self):
+        for block in self.single_blocks:
+            block.ffn_chunk_size = None
+            block.chunk_modulation = False
+
+    def compile_repeated_blocks(self, **compile_kwargs):
+        compile_blocks(self.blocks, **compile_kwargs)
+        compile_blocks(self.single_blocks, **compile_kwargs)
+
     def forward(
         self,
         hidden_states,
@@ -401,64 +471,62 @@ class FluxDiT(PreTrainedModel):
         use_gradient_checkpointing=False,
         **kwargs,
     ):
-        fp8_linear_enabled = getattr(self, "fp8_linear_enabled", False)
-        with fp8_inference(fp8_linear_enabled), gguf_inference():
-            if image_ids is None:
-                image_ids = self.prepare_image_ids(hidden_states)
-
-            # warning: keep the order of time_embedding + guidance_embedding + pooled_text_embedding
-            # addition of floating point numbers does not meet commutative law
-            conditioning = self.time_embedder(timestep, hidden_states.dtype)
-            if self.guidance_embedder is not None:
-                guidance = guidance * 1000
-                conditioning += self.guidance_embedder(guidance, hidden_states.dtype)
-            conditioning += self.pooled_text_embedder(pooled_prompt_emb)
-            prompt_emb = self.context_embedder(prompt_emb)
-            image_rotary_emb = self.pos_embedder(torch.cat((text_ids, image_ids), dim=1))
-
-            height, width = hidden_states.shape[-2:]
-            hidden_states = self.patchify(hidden_states)
-            hidden_states = self.x_embedder(hidden_states)
-
-            def create_custom_forward(module):
-                def custom_forward(*inputs):
-                    return module(*inputs)
-
-                return custom_forward
-
-            for block in self.blocks:
-                if self.training and use_gradient_checkpointing:
-                    hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
-                        create_custom_forward(block),
-                        hidden_states,
-                        prompt_emb,
-                        conditioning,
-                        image_rotary_emb,
-                        use_reentrant=False,
-                    )
-                else:
-                    hidden_states, prompt_emb = block(hidden_states, prompt_emb, conditioning, image_rotary_emb)
-
-            hidden_states = torch.cat([prompt_emb, hidden_states], dim=1)
-            for block in self.single_blocks:
-                if self.training and use_gradient_checkpointing:
-                    hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
-                        create_custom_forward(block),
-                        hidden_states,
-                        prompt_emb,
-                        conditioning,
-                        image_rotary_emb,
-                        use_reentrant=False,
-                    )
-                else:
-                    hidden_states, prompt_emb = block(hidden_states, prompt_emb, conditioning, image_rotary_emb)
-            hidden_states = hidden_states[:, prompt_emb.shape[1] :]
+        if image_ids is None:
+            image_ids = self.prepare_image_ids(hidden_states)
+
+        # warning: keep the order of time_embedding + guidance_embedding + pooled_text_embedding
+        # addition of floating point numbers does not meet commutative law
+        conditioning = self.time_embedder(timestep, hidden_states.dtype)
+        if self.guidance_embedder is not None:
+            guidance = guidance * 1000
+            conditioning += self.guidance_embedder(guidance, hidden_states.dtype)
+        conditioning += self.pooled_text_embedder(pooled_prompt_emb)
+        prompt_emb = self.context_embedder(prompt_emb)
+        image_rotary_emb = self.pos_embedder(torch.cat((text_ids, image_ids), dim=1))
+
+        height, width = hidden_states.shape[-2:]
+        hidden_states = self.patchify(hidden_states)
+        hidden_states = self.x_embedder(hidden_states)
+
+        def create_custom_forward(module):
+            def custom_forward(*inputs):
+                return module(*inputs)
+
+            return custom_forward
+
+        for block in self.blocks:
+            if self.training and use_gradient_checkpointing:
+                hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
+                    create_custom_forward(block),
+                    hidden_states,
+                    prompt_emb,
+                    conditioning,
+                    image_rotary_emb,
+                    use_reentrant=False,
+                )
+            else:
+                hidden_states, prompt_emb = block(hidden_states, prompt_emb, conditioning, image_rotary_emb)
+
+        hidden_states = torch.cat([prompt_emb, hidden_states], dim=1)
+        for block in self.single_blocks:
+            if self.training and use_gradient_checkpointing:
+                hidden_states, prompt_emb = torch.utils.checkpoint.checkpoint(
+                    create_custom_forward(block),
+                    hidden_states,
+                    prompt_emb,
+                    conditioning,
+                    image_rotary_emb,
+                    use_reentrant=False,
+                )
+            else:
+                hidden_states, prompt_emb = block(hidden_states, prompt_emb, conditioning, image_rotary_emb)
+        hidden_states = hidden_states[:, prompt_emb.shape[1] :]
 
-            hidden_states = self.final_norm_out(hidden_states, conditioning)
-            hidden_states = self.final_proj_out(hidden_states)
-            hidden_states = self.unpatchify(hidden_states, height, width)
+        hidden_states = self.final_norm_out(hidden_states, conditioning)
+        hidden_states = self.final_proj_out(hidden_states)
+        hidden_states = self.unpatchify(hidden_states, height, width)
 
-            return hidden_states
+        return hidden_states
 
     @classmethod
     def from_state_dict(
@@ -476,29 +544,3 @@ class FluxDiT(PreTrainedModel):
         model.load_state_dict(state_dict, assign=True)
         model.to(device=device, dtype=dtype, non_blocking=True)
         return model
-
-    @staticmethod
-    def set_attn_implementation(attn_implementation: str):
-        supported_implementations = ("sdpa", "sage_attn", "sparge_attn")
-        if attn_implementation not in supported_implementations:
-            raise ValueError(
-                f"attn_implementation must be one of {supported_implementations}, but got '{attn_implementation}'"
-            )
-
-        global _attn_func
-        if attn_implementation == "sage_attn":
-            try:
-                from sageattention import sageattn
-
-                _attn_func = sageattn
-            except ImportError:
-                raise ImportError("sageattn is not installed")
-        elif attn_implementation == "sparge_attn":
-            try:
-                from spas_sage_attn import spas_sage2_attn_meansim_cuda
-
-                _attn_func = spas_sage2_attn_meansim_cuda
-            except ImportError:
-                raise ImportError("spas_sage_attn is not installed")
-        else:
-            _attn_func = nn.functional.scaled_dot_product_attention
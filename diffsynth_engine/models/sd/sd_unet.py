@@ -15,6 +15,7 @@ from diffsynth_engine.models.basic.unet_helper import (
     UpSampler,
 )
 from diffsynth_engine.utils.constants import SD_UNET_CONFIG_FILE
+from diffsynth_engine.utils.compile import compile_blocks
 from diffsynth_engine.utils import logging
 
 logger = logging.get_logger(__name__)
@@ -264,6 +265,9 @@ class SDUNet(PreTrainedModel):
         self.conv_act = nn.SiLU()
         self.conv_out = nn.Conv2d(320, 4, kernel_size=3, padding=1, device=device, dtype=dtype)
 
+    def compile_repeated_blocks(self, **compile_kwargs):
+        compile_blocks(self.blocks, **compile_kwargs)
+
     def forward(self, x, timestep, context, **kwargs):
         # 1. time
         time_emb = self.time_embedding(timestep, dtype=x.dtype)
@@ -6,6 +6,8 @@ from einops import rearrange
 
 from diffsynth_engine.models.basic.timestep import TimestepEmbeddings
 from diffsynth_engine.models.basic.transformer_helper import AdaLayerNorm
+from diffsynth_engine.models.basic.fused_ops import gate_add, modulate
+from diffsynth_engine.models.basic.attention import attention
 from diffsynth_engine.models.base import PreTrainedModel, StateDictConverter
 from diffsynth_engine.models.utils import no_init_weights
 from diffsynth_engine.utils.constants import SD3_DIT_CONFIG_FILE
@@ -126,6 +128,7 @@ class JointAttention(nn.Module):
         self.num_heads = num_heads
         self.head_dim = head_dim
         self.only_out_a = only_out_a
+        self.attn_implementation = "sdpa"
 
         self.a_to_qkv = nn.Linear(dim_a, dim_a * 3, device=device, dtype=dtype)
         self.b_to_qkv = nn.Linear(dim_b, dim_b * 3, device=device, dtype=dtype)
@@ -141,7 +144,7 @@ class JointAttention(nn.Module):
         qkv = qkv.view(batch_size, -1, 3 * self.num_heads, self.head_dim).transpose(1, 2)
         q, k, v = qkv.chunk(3, dim=1)
 
-        hidden_states = nn.functional.scaled_dot_product_attention(q, k, v)
+        hidden_states = attention(q, k, v, attn_impl=self.attn_implementation)
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_dim)
         hidden_states = hidden_states.to(q.dtype)
         hidden_states_a, hidden_states_b = (
@@ -188,14 +191,14 @@ class JointTransformerBlock(nn.Module):
         attn_output_a, attn_output_b = self.attn(norm_hidden_states_a, norm_hidden_states_b)
 
         # Part A
-        hidden_states_a = hidden_states_a + gate_msa_a * attn_output_a
-        norm_hidden_states_a = self.norm2_a(hidden_states_a) * (1 + scale_mlp_a) + shift_mlp_a
-        hidden_states_a = hidden_states_a + gate_mlp_a * self.ff_a(norm_hidden_states_a)
+        hidden_states_a = gate_add(hidden_states_a, gate_msa_a, attn_output_a)
+        norm_hidden_states_a = modulate(self.norm2_a(hidden_states_a), shift_mlp_a, scale_mlp_a)
+        hidden_states_a = gate_add(hidden_states_a, gate_mlp_a, self.ff_a(norm_hidden_states_a))
 
         # Part B
-        hidden_states_b = hidden_states_b + gate_msa_b * attn_output_b
-        norm_hidden_states_b = self.norm2_b(hidden_states_b) * (1 + scale_mlp_b) + shift_mlp_b
-        hidden_states_b = hidden_states_b + gate_mlp_b * self.ff_b(norm_hidden_states_b)
+        hidden_states_b = gate_add(hidden_states_b, gate_msa_b, attn_output_b)
+        norm_hidden_states_b = modulate(self.norm2_b(hidden_states_b), shift_mlp_b, scale_mlp_b)
+        hidden_states_b = gate_add(hidden_states_b, gate_mlp_b, self.ff_b(norm_hidden_states_b))
 
         return hidden_states_a, hidden_states_b
 
@@ -225,9 +228,9 @@ class JointTransformerFinalBlock(nn.Module):
         attn_output_a = self.attn(norm_hidden_states_a, norm_hidden_states_b)
 
         # Part A
-        hidden_states_a = hidden_states_a + gate_msa_a * attn_output_a
-        norm_hidden_states_a = self.norm2_a(hidden_states_a) * (1 + scale_mlp_a) + shift_mlp_a
-        hidden_states_a = hidden_states_a + gate_mlp_a * self.ff_a(norm_hidden_states_a)
+        hidden_states_a = gate_add(hidden_states_a, gate_msa_a, attn_output_a)
+        norm_hidden_states_a = modulate(self.norm2_a(hidden_states_a), shift_mlp_a, scale_mlp_a)
+        hidden_states_a = gate_add(hidden_states_a, gate_mlp_a, self.ff_a(norm_hidden_states_a))
 
         return hidden_states_a, hidden_states_b
 
@@ -15,6 +15,7 @@ from diffsynth_engine.models.basic.unet_helper import (
 from diffsynth_engine.models.base import PreTrainedModel, StateDictConverter, split_suffix
 from diffsynth_engine.models.utils import no_init_weights
 from diffsynth_engine.utils.constants import SDXL_UNET_CONFIG_FILE
+from diffsynth_engine.utils.compile import compile_blocks
 from diffsynth_engine.utils import logging
 
 logger = logging.get_logger(__name__)
@@ -246,6 +247,9 @@ class SDXLUNet(PreTrainedModel):
 
         self.is_kolors = is_kolors
 
+    def compile_repeated_blocks(self, **compile_kwargs):
+        compile_blocks(self.blocks, **compile_kwargs)
+
     def forward(self, x, timestep, context, y, **kwargs):
         # 1. time embedding
         t_emb = self.time_embedding(timestep, dtype=x.dtype)
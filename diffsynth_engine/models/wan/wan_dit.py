@@ -8,29 +8,33 @@ from typing import Dict, Tuple, Optional
 from einops import rearrange
 
 from diffsynth_engine.models.base import StateDictConverter, PreTrainedModel
+from diffsynth_engine.models.basic import attention as attention_ops
+from diffsynth_engine.models.basic.fused_ops import gate_add, modulate
+from diffsynth_engine.models.basic.transformer_helper import RMSNorm
 from diffsynth_engine.models.utils import no_init_weights
+from diffsynth_engine.utils.compile import compile_blocks
 from diffsynth_engine.utils.constants import (
     WAN_DIT_1_3B_T2V_CONFIG_FILE,
     WAN_DIT_14B_I2V_CONFIG_FILE,
     WAN_DIT_14B_T2V_CONFIG_FILE,
 )
-from diffsynth_engine.utils.fp8_linear import fp8_inference
 
 
-def attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, num_heads: int):
-    q, k, v = (rearrange(t, "b s (n d) -> b n s d ", n=num_heads) for t in (q, k, v))
-
-    from sageattention import sageattn
-
-    x = sageattn(q, k, v)
+def attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    num_heads: int,
+    attn_implementation: str = "sage_attn",
+    attn_mask: Optional[torch.Tensor] = None,
+    attn_kwargs: Optional[Dict] = None,
+):
+    q, k, v = (rearrange(t, "b s (n d) -> b n s d", n=num_heads) for t in (q, k, v))
+    x = attention_ops.attention(q, k, v, attn_impl=attn_implementation, attn_mask=attn_mask, **(attn_kwargs or {}))
     x = rearrange(x, "b n s d -> b s (n d)", n=num_heads)
     return x
 
 
-def modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor):
-    return x * (1 + scale) + shift
-
-
 def sinusoidal_embedding_1d(dim, position):
     sinusoid = torch.outer(
         position.type(torch.float64),
@@ -63,26 +67,6 @@ def rope_apply(x, freqs, num_heads):
     return x_out.to(x.dtype)
 
 
-class RMSNorm(nn.Module):
-    def __init__(
-        self,
-        dim,
-        eps=1e-5,
-        device: str = "cuda:0",
-        dtype: torch.dtype = torch.bfloat16,
-    ):
-        super().__init__()
-        self.eps = eps
-        self.dim = dim
-        self.weight = nn.Parameter(torch.ones(dim, device=device, dtype=dtype))
-
-    def norm(self, x):
-        return x * torch.rsqrt(x.pow(2).mean(dim=-1, keepdim=True) + self.eps)
-
-    def forward(self, x):
-        return self.norm(x.float()).to(x.dtype) * self.weight
-
-
 class SelfAttention(nn.Module):
     def __init__(
         self,
@@ -95,6 +79,7 @@ class SelfAttention(nn.Module):
         super().__init__()
         self.dim = dim
         self.head_dim = dim // num_heads
+        self.attn_implementation = "sage_attn"
 
         self.q = nn.Linear(dim, dim, device=device, dtype=dtype)
         self.k = nn.Linear(dim, dim, device=device, dtype=dtype)
@@ -134,7 +119,6 @@ class SelfAttention(nn.Module):
 
         return self.feta_score(query_image, key_image, C, weight, num_frames)
 
-    @torch.compiler.disable()
     def feta_score(self, query_image, key_image, head_dim, weight, num_frames):
         scale = head_dim**-0.5
         query_image = query_image * scale
@@ -161,7 +145,7 @@ class SelfAttention(nn.Module):
         enhance_scores = enhance_scores.clamp(min=1)
         return enhance_scores
 
-    def forward(self, x, freqs, num_frames):
+    def forward(self, x, freqs, num_frames, attn_kwargs: Optional[Dict] = None):
         q = self.norm_q(self.q(x))
         k = self.norm_k(self.k(x))
         v = self.v(x)
@@ -169,7 +153,16 @@ class SelfAttention(nn.Module):
         q = rope_apply(q, freqs, num_heads)
         k = rope_apply(k, freqs, num_heads)
         # feta_scores = self.get_feta_scores(q, k, num_heads, 2.0, (num_frames - 1) // 4 + 1)  # WARNING: Don't forget to modify in case of FLF2V-14B
-        x = attention(q=q, k=k, v=v, num_heads=num_heads)
+        # sparse attention arguments are only given by WanDiT after the dense steps
+        attn_implementation = self.attn_implementation if attn_kwargs is None else "sliding_tile"
+        x = attention(
+            q=q,
+            k=k,
+            v=v,
+            num_heads=num_heads,
+            attn_implementation=attn_implementation,
+            attn_kwargs=attn_kwargs,
+        )
         # x *= feta_scores
         return self.o(x)
 
@@ -187,6 +180,7 @@ class CrossAttention(nn.Module):
         super().__init__()
         self.dim = dim
         self.head_dim = dim // num_heads
+        self.attn_implementation = "sage_attn"
 
         self.q = nn.Linear(dim, dim, device=device, dtype=dtype)
         self.k = nn.Linear(dim, dim, device=device, dtype=dtype)
@@ -200,7 +194,7 @@ class CrossAttention(nn.Module):
             self.v_img = nn.Linear(dim, dim, device=device, dtype=dtype)
             self.norm_k_img = RMSNorm(dim, eps=eps, device=device, dtype=dtype)
 
-    def forward(self, x: torch.Tensor, y: torch.Tensor):
+    def forward(self, x: torch.Tensor, y: torch.Tensor, context_mask: Optional[torch.Tensor] = None):
         if self.has_image_input:
             img = y[:, :257]
             ctx = y[:, 257:]
@@ -210,11 +204,13 @@ class CrossAttention(nn.Module):
         k = self.norm_k(self.k(ctx))
         v = self.v(ctx)
         num_heads = q.shape[2] // self.head_dim
-        x = attention(q, k, v, num_heads=num_heads)
+        x = attention(
+            q, k, v, num_heads=num_heads, attn_implementation=self.attn_implementation, attn_mask=context_mask
+        )
         if self.has_image_input:
             k_img = self.norm_k_img(self.k_img(img))
             v_img = self.v_img(img)
-            y = attention(q, k_img, v_img, num_heads=num_heads)
+            y = attention(q, k_img, v_img, num_heads=num_heads, attn_implementation=self.attn_implementation)
             x = x + y
         return self.o(x)
 
@@ -248,15 +244,42 @@ class DiTBlock(nn.Module):
             nn.Linear(ffn_dim, dim, device=device, dtype=dtype),
         )
         self.modulation = nn.Parameter(torch.randn(1, 6, dim, device=device, dtype=dtype) / dim**0.5)
+        self.ffn_chunk_size = None
+        self.chunk_modulation = False
+
+    def chunked_ffn(self, x, shift_mlp, scale_mlp, gate_mlp):
+        # the ffn is pointwise along the sequence, only a chunk of the [B, S, ffn_dim] hidden states is alive at a time
+        input_x = None if self.chunk_modulation else modulate(self.norm2(x), shift_mlp, scale_mlp)
+        # x is the fresh output of the cross attention residual and can be updated in place
+        x = x.to(torch.promote_types(x.dtype, gate_mlp.dtype))
+        for start in range(0, x.shape[1], self.ffn_chunk_size):
+            x_chunk = x[:, start : start + self.ffn_chunk_size]
+            if input_x is None:
+                input_chunk = modulate(self.norm2(x_chunk), shift_mlp, scale_mlp)
+            else:
+                input_chunk = input_x[:, start : start + self.ffn_chunk_size]
+            x_chunk.addcmul_(gate_mlp, self.ffn(input_chunk))
+        return x
 
-    def forward(self, x, context, t_mod, freqs, num_frames):
+    def forward(
+        self,
+        x,
+        context,
+        t_mod,
+        freqs,
+        num_frames,
+        context_mask: Optional[torch.Tensor] = None,
+        attn_kwargs: Optional[Dict] = None,
+    ):
         # msa: multi-head self-attention  mlp: multi-layer perceptron
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (self.modulation + t_mod).chunk(6, dim=1)
         input_x = modulate(self.norm1(x), shift_msa, scale_msa)
-        x = x + gate_msa * self.self_attn(input_x, freqs, num_frames)
-        x = x + self.cross_attn(self.norm3(x), context)
+        x = gate_add(x, gate_msa, self.self_attn(input_x, freqs, num_frames, attn_kwargs))
+        x = x + self.cross_attn(self.norm3(x), context, context_mask)
+        if self.ffn_chunk_size is not None:
+            return self.chunked_ffn(x, shift_mlp, scale_mlp, gate_mlp)
         input_x = modulate(self.norm2(x), shift_mlp, scale_mlp)
-        x = x + gate_mlp * self.ffn(input_x)
+        x = gate_add(x, gate_mlp, self.ffn(input_x))
         return x
 
 
@@ -299,8 +322,9 @@ class Head(nn.Module):
         self.modulation = nn.Parameter(torch.randn(1, 2, dim, device=device, dtype=dtype) / dim**0.5)
 
     def forward(self, x, t_mod):
-        shift, scale = (self.modulation + t_mod).chunk(2, dim=1)
-        x = self.head(self.norm(x) * (1 + scale) + shift)
+        # t_mod: [B, dim] -> shift, scale: [B, 1, dim]
+        shift, scale = (self.modulation + t_mod.unsqueeze(1)).chunk(2, dim=1)
+        x = self.head(modulate(self.norm(x), shift, scale))
         return x
 
 
@@ -325,6 +349,7 @@ class WanDiT(PreTrainedModel):
         num_heads: int,
         num_layers: int,
         has_image_input: bool,
+        text_len: int = 512,
         device: str = "cuda:0",
         dtype: torch.dtype = torch.bfloat16,
     ):
@@ -332,6 +357,7 @@ class WanDiT(PreTrainedModel):
 
         self.dim = dim
         self.freq_dim = freq_dim
+        self.text_len = text_len
         self.has_image_input = has_image_input
         self.patch_size = patch_size
 
@@ -365,6 +391,73 @@ class WanDiT(PreTrainedModel):
         if has_image_input:
             self.img_emb = MLP(1280, dim, device=device, dtype=dtype)  # clip_feature_dim = 1280
 
+        self.sliding_tile_kwargs = None
+        self.sliding_tile_dense_steps = 0
+
+    def enable_sliding_tile_attention(
+        self,
+        tile_size: Tuple[int, int, int] = (4, 8, 8),
+        window_size: Tuple[int, int, int] = (3, 3, 3),
+        num_global_tokens: int = 64,
+        dense_steps: int = 10,
+    ):
+        """
+        Replaces dense self-attention with block sparse sliding tile attention over the (f, h, w) latent grid after
+        the first `dense_steps` denoising steps. Tile and window sizes are counted in patchified tokens and tiles.
+        """
+        self.sliding_tile_kwargs = dict(
+            tile_size=tile_size, window_size=window_size, num_global_tokens=num_global_tokens
+        )
+        self.sliding_tile_dense_steps = dense_steps
+
+    def disable_sliding_tile_attention(self):
+        self.sliding_tile_kwargs = None
+        self.sliding_tile_dense_steps = 0
+
+    def enable_chunked_ffn(self, chunk_size: int = 4096, chunk_modulation: bool = False):
+        """
+        Runs the feed forward layers of the blocks over `chunk_size` tokens at a time, so that the [B, S, ffn_dim]
+        hidden states never exist in full. With `chunk_modulation`, the norm and modulation before the feed forward
+        layers are chunked as well, saving two more [B, S, dim] temporaries.
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"ffn chunk size must be positive, but got {chunk_size}")
+        for block in self.blocks:
+            block.ffn_chunk_size = chunk_size
+            block.chunk_modulation = chunk_modulation
+
+    def disable_chunked_ffn(self):
+        for block in self.blocks:
+            block.ffn_chunk_size = None
+            block.chunk_modulation = False
+
+    def get_self_attn_kwargs(self, grid_size: Tuple[int, int, int], step_index: Optional[int] = None) -> Optional[Dict]:
+        # calls without a denoising step index run dense attention
+        if self.sliding_tile_kwargs is None or step_index is None or step_index < self.sliding_tile_dense_steps:
+            return None
+        return dict(grid_size=tuple(grid_size), **self.sliding_tile_kwargs)
+
+    def embed_context(self, context: torch.Tensor, context_lens: Optional[torch.Tensor] = None):
+        """
+        The model is trained with text embeddings zero padded to text_len tokens, which all become the same key and
+        value after text_embedding. A shorter context gets a single padding token instead, whose attention logit is
+        offset by log(num_padding_tokens) in the returned mask, giving the same result with far fewer tokens.
+        Tokens of a sample beyond its context_lens (padding within a batch) are masked out. The mask stays float32,
+        the offset would move the weight of the padding token by a few percent if rounded to bfloat16.
+        """
+        b, length = context.shape[:2]
+        if length >= self.text_len:
+            return self.text_embedding(context), None
+        if context_lens is None:
+            context_lens = torch.full((b,), length, device=context.device)
+        context_lens = context_lens.to(context.device)
+        context = torch.cat([context, context.new_zeros(b, 1, context.shape[2])], dim=1)
+        positions = torch.arange(length + 1, device=context.device)
+        context_mask = torch.zeros(b, length + 1, device=context.device)
+        context_mask.masked_fill_(positions[None, :] >= context_lens[:, None], float("-inf"))
+        context_mask[:, length] = torch.log((self.text_len - context_lens).float())
+        return self.text_embedding(context), context_mask[:, None, None, :]
+
     def patchify(self, x: torch.Tensor):
         x = self.patch_embedding(x)  # b c f h w -> b 4c f h/2 w/2
         grid_size = x.shape[2:]
@@ -383,6 +476,24 @@ class WanDiT(PreTrainedModel):
             z=self.patch_size[2],
         )
 
+    @staticmethod
+    def teacache_reusable(modulated_input: torch.Tensor, previous_modulated_input: Optional[torch.Tensor]) -> bool:
+        # the cached residual belongs to the previous call, it can not be reused by a batch of another size
+        return previous_modulated_input is not None and previous_modulated_input.shape == modulated_input.shape
+
+    @staticmethod
+    def teacache_distance(modulated_input: torch.Tensor, previous_modulated_input: torch.Tensor) -> float:
+        """
+        The relative L1 change of the timestep modulation since the previous step. TeaCache decides for the whole
+        batch, which is recomputed as soon as any sample changed enough. Samples denoised with the same timestep have
+        the same modulation, so the decision is the same as for each of them alone.
+        """
+        diff = (modulated_input - previous_modulated_input).abs().flatten(1).mean(dim=1)
+        return (diff / previous_modulated_input.abs().flatten(1).mean(dim=1)).max().cpu().item()
+
+    def compile_repeated_blocks(self, **compile_kwargs):
+        compile_blocks(self.blocks, **compile_kwargs)
+
     def forward(
         self,
         x: torch.Tensor,
@@ -392,15 +503,21 @@ class WanDiT(PreTrainedModel):
         clip_feature: Optional[torch.Tensor] = None,  # clip_vision_encoder(img)
         y: Optional[torch.Tensor] = None,  # vae_encoder(img)
         slg_layers: Optional[list[int]] = [],
+        context_lens: Optional[torch.Tensor] = None,  # real text lengths of a padded batch of context
+        step_index: Optional[int] = None,  # denoising step, selects dense or sliding tile self-attention
     ):
         t = self.time_embedding(sinusoidal_embedding_1d(self.freq_dim, timestep))
         t_mod = self.time_projection(t).unflatten(1, (6, self.dim))
-        context = self.text_embedding(context)
+        context, context_mask = self.embed_context(context, context_lens)
         if self.has_image_input:
             x = torch.cat([x, y], dim=1)  # (b, c_x + c_y, f, h, w)
             clip_embdding = self.img_emb(clip_feature)
             context = torch.cat([clip_embdding, context], dim=1)  # (b, s1 + s2, d)
         x, (f, h, w) = self.patchify(x)
+        # prompts of any length reuse the blocks compiled for a resolution
+        torch._dynamo.maybe_mark_dynamic(context, 1)
+        if context_mask is not None:
+            torch._dynamo.maybe_mark_dynamic(context_mask, 3)
         freqs = (
             torch.cat(
                 [
@@ -414,16 +531,24 @@ class WanDiT(PreTrainedModel):
             .to(x.device)
         )
 
+        self_attn_kwargs = self.get_self_attn_kwargs((f, h, w), step_index)
+
         # https://github.com/ali-vilab/TeaCache
         modulated_input = t_mod if self.use_ref_steps else t
         if self.cnt % 2 == 0:  # Even -> Conditional
             self.is_even = True
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
+            if (
+                self.cnt < self.ret_steps
+                or self.cnt >= self.cutoff_steps
+                or not self.teacache_reusable(modulated_input, self.previous_e0_even)
+            ):
                     should_calc_even = True
                     self.accumulated_rel_l1_distance_even = 0
             else:
                 rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_even += rescale_func(((modulated_input - self.previous_e0_even).abs().mean() / self.previous_e0_even.abs().mean()).cpu().item())
+                self.accumulated_rel_l1_distance_even += rescale_func(
+                    self.teacache_distance(modulated_input, self.previous_e0_even)
+                )
                 if self.accumulated_rel_l1_distance_even < self.teacache_thresh:
                     should_calc_even = False
                 else:
@@ -433,12 +558,18 @@ class WanDiT(PreTrainedModel):
 
         else:  # Odd -> Unconditional
             self.is_even = False
-            if self.cnt < self.ret_steps or self.cnt >= self.cutoff_steps:
+            if (
+                self.cnt < self.ret_steps
+                or self.cnt >= self.cutoff_steps
+                or not self.teacache_reusable(modulated_input, self.previous_e0_odd)
+            ):
                     should_calc_odd = True
                     self.accumulated_rel_l1_distance_odd = 0
             else:
                 rescale_func = np.poly1d(self.coefficients)
-                self.accumulated_rel_l1_distance_odd += rescale_func(((modulated_input - self.previous_e0_odd).abs().mean() / self.previous_e0_odd.abs().mean()).cpu().item())
+                self.accumulated_rel_l1_distance_odd += rescale_func(
+                    self.teacache_distance(modulated_input, self.previous_e0_odd)
+                )
                 if self.accumulated_rel_l1_distance_odd < self.teacache_thresh:
                     should_calc_odd = False
                 else:
@@ -452,11 +583,10 @@ class WanDiT(PreTrainedModel):
             else:
                 ori_x = x.clone()
 
-                with fp8_inference():
-                    for block_idx, block in enumerate(self.blocks):
-                        if block_idx in slg_layers:
-                            continue
-                        x = block(x, context, t_mod, freqs, num_frames)
+                for block_idx, block in enumerate(self.blocks):
+                    if block_idx in slg_layers:
+                        continue
+                    x = block(x, context, t_mod, freqs, num_frames, context_mask, self_attn_kwargs)
                 self.previous_residual_even = x - ori_x
         else:
             if not should_calc_odd:
@@ -464,11 +594,10 @@ class WanDiT(PreTrainedModel):
             else:
                 ori_x = x.clone()
 
-                with fp8_inference():
-                    for block_idx, block in enumerate(self.blocks):
-                        if block_idx in slg_layers:
-                            continue
-                        x = block(x, context, t_mod, freqs, num_frames)
+                for block_idx, block in enumerate(self.blocks):
+                    if block_idx in slg_layers:
+                        continue
+                    x = block(x, context, t_mod, freqs, num_frames, context_mask, self_attn_kwargs)
                 self.previous_residual_odd = x - ori_x
         #
 
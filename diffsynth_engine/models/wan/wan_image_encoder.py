@@ -7,7 +7,7 @@ import torchvision.transforms as T
 
 from diffsynth_engine.models.base import StateDictConverter, PreTrainedModel
 from diffsynth_engine.models.utils import no_init_weights
-from .attention import attention
+from diffsynth_engine.models.basic.attention import attention
 
 
 def pos_interpolate(pos, seq_len):
@@ -48,6 +48,7 @@ class SelfAttention(nn.Module):
         self.causal = causal
         self.attn_dropout = attn_dropout
         self.proj_dropout = proj_dropout
+        self.attn_implementation = "flash_attn_2"
 
         # layers
         self.to_qkv = nn.Linear(dim, dim * 3)
@@ -60,12 +61,12 @@ class SelfAttention(nn.Module):
         b, s, c, n, d = *x.size(), self.num_heads, self.head_dim
 
         # compute query, key, value
-        q, k, v = self.to_qkv(x).view(b, s, 3, n, d).unbind(2)
+        q, k, v = self.to_qkv(x).view(b, s, 3, n, d).permute(2, 0, 3, 1, 4).unbind(0)
 
         # compute attention
-        p = self.attn_dropout if self.training else 0.0
-        x = attention(q, k, v, dropout_p=p, causal=self.causal, fa_version=2)
-        x = x.reshape(b, s, c)
+        attn_mask = torch.ones(s, s, dtype=torch.bool, device=x.device).tril() if self.causal else None
+        x = attention(q, k, v, attn_impl=self.attn_implementation, attn_mask=attn_mask)
+        x = x.transpose(1, 2).reshape(b, s, c)
 
         # output
         x = self.proj(x)
@@ -146,6 +147,7 @@ class AttentionPool(nn.Module):
         self.head_dim = dim // num_heads
         self.proj_dropout = proj_dropout
         self.norm_eps = norm_eps
+        self.attn_implementation = "flash_attn_2"
 
         # layers
         gain = 1.0 / math.sqrt(dim)
@@ -168,12 +170,12 @@ class AttentionPool(nn.Module):
         b, s, c, n, d = *x.size(), self.num_heads, self.head_dim
 
         # compute query, key, value
-        q = self.to_q(self.cls_embedding).view(1, 1, n, d).expand(b, -1, -1, -1)
-        k, v = self.to_kv(x).view(b, s, 2, n, d).unbind(2)
+        q = self.to_q(self.cls_embedding).view(1, 1, n, d).transpose(1, 2).expand(b, -1, -1, -1)
+        k, v = self.to_kv(x).view(b, s, 2, n, d).permute(2, 0, 3, 1, 4).unbind(0)
 
         # compute attention
-        x = attention(q, k, v, fa_version=2)
-        x = x.reshape(b, 1, c)
+        x = attention(q, k, v, attn_impl=self.attn_implementation)
+        x = x.transpose(1, 2).reshape(b, 1, c)
 
         # output
         x = self.proj(x)
@@ -1,11 +1,15 @@
 import math
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from typing import Dict
 
 from diffsynth_engine.models.base import StateDictConverter, PreTrainedModel
+from diffsynth_engine.models.basic.attention import attention
+from diffsynth_engine.models.basic.fused_ops import gelu_tanh
 from diffsynth_engine.models.utils import no_init_weights
+from diffsynth_engine.utils import logging
+
+logger = logging.get_logger(__name__)
 
 
 def fp16_clamp(x):
@@ -17,7 +21,7 @@ def fp16_clamp(x):
 
 class GELU(nn.Module):
     def forward(self, x):
-        return 0.5 * x * (1.0 + torch.tanh(math.sqrt(2.0 / math.pi) * (x + 0.044715 * torch.pow(x, 3.0))))
+        return gelu_tanh(x)
 
 
 class T5LayerNorm(nn.Module):
@@ -42,6 +46,7 @@ class T5Attention(nn.Module):
         self.dim_attn = dim_attn
         self.num_heads = num_heads
         self.head_dim = dim_attn // num_heads
+        self.attn_implementation = "sdpa"
 
         # layers
         self.q = nn.Linear(dim, dim_attn, bias=False)
@@ -61,12 +66,12 @@ class T5Attention(nn.Module):
         b, n, c = x.size(0), self.num_heads, self.head_dim
 
         # compute query, key, value
-        q = self.q(x).view(b, -1, n, c)
-        k = self.k(context).view(b, -1, n, c)
-        v = self.v(context).view(b, -1, n, c)
+        q = self.q(x).view(b, -1, n, c).transpose(1, 2)
+        k = self.k(context).view(b, -1, n, c).transpose(1, 2)
+        v = self.v(context).view(b, -1, n, c).transpose(1, 2)
 
         # attention bias
-        attn_bias = x.new_zeros(b, n, q.size(1), k.size(1))
+        attn_bias = x.new_zeros(b, n, q.size(2), k.size(2))
         if pos_bias is not None:
             attn_bias += pos_bias
         if mask is not None:
@@ -75,12 +80,10 @@ class T5Attention(nn.Module):
             attn_bias.masked_fill_(mask == 0, torch.finfo(x.dtype).min)
 
         # compute attention (T5 does not use scaling)
-        attn = torch.einsum("binc,bjnc->bnij", q, k) + attn_bias
-        attn = F.softmax(attn.float(), dim=-1).type_as(attn)
-        x = torch.einsum("bnij,bjnc->binc", attn, v)
+        x = attention(q, k, v, attn_impl=self.attn_implementation, attn_mask=attn_bias, scale=1.0)
 
         # output
-        x = x.reshape(b, -1, n * c)
+        x = x.transpose(1, 2).reshape(b, -1, n * c)
         x = self.o(x)
         x = self.dropout(x)
         return x
@@ -196,9 +199,37 @@ class WanTextEncoderStateDictConverter(StateDictConverter):
         return state_dict
 
     def from_civitai(self, state_dict):
-        return state_dict
+        # llama.cpp names used by UMT5 GGUF files
+        rename_dict = {
+            "token_embd.weight": "token_embedding.weight",
+            "enc.output_norm.weight": "norm.weight",
+        }
+        block_rename_dict = {
+            "attn_norm": "norm1",
+            "attn_q": "attn.q",
+            "attn_k": "attn.k",
+            "attn_v": "attn.v",
+            "attn_o": "attn.o",
+            "attn_rel_b": "pos_embedding.embedding",
+            "ffn_norm": "norm2",
+            "ffn_gate": "ffn.gate.0",
+            "ffn_up": "ffn.fc1",
+            "ffn_down": "ffn.fc2",
+        }
+        new_state_dict = {}
+        for key, param in state_dict.items():
+            if key in rename_dict:
+                new_state_dict[rename_dict[key]] = param
+                continue
+            names = key.split(".")  # enc.blk.{i}.{name}.weight
+            if len(names) == 5 and names[:2] == ["enc", "blk"] and names[3] in block_rename_dict:
+                new_state_dict[f"blocks.{names[2]}.{block_rename_dict[names[3]]}.{names[4]}"] = param
+        return new_state_dict
 
     def convert(self, state_dict):
+        if "enc.blk.0.attn_q.weight" in state_dict:
+            state_dict = self.from_civitai(state_dict)
+            logger.info("use civitai format state dict")
         return state_dict
 
 
@@ -1,10 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from collections import defaultdict
 from einops import rearrange, repeat
 from tqdm import tqdm
 
 from diffsynth_engine.models.base import StateDictConverter, PreTrainedModel
+from diffsynth_engine.models.basic.attention import attention
 from diffsynth_engine.models.utils import no_init_weights
 
 CACHE_T = 2
@@ -52,6 +54,64 @@ class CausalConv3d(nn.Conv3d):
         return super().forward(x)
 
 
+def update_cache(cache, x):
+    """
+    Keeps the last CACHE_T frames of the chunks x in the fixed buffer cache, which is allocated on the first chunk and
+    zero filled like the causal padding before it.
+    """
+    if cache is None:
+        cache = x.new_zeros(*x.shape[:2], CACHE_T, *x.shape[3:])
+    t = min(x.shape[2], CACHE_T)
+    # frames still in the window move to the front, the slices are disjoint for CACHE_T = 2
+    cache[:, :, : CACHE_T - t] = cache[:, :, t:]
+    cache[:, :, CACHE_T - t :] = x[:, :, -t:]
+    return cache
+
+
+def offload_cache(feat_cache, host_cache):
+    """
+    Moves the causal caches in feat_cache to the host, into the (pinned) buffers of host_cache which are allocated on
+    the first call and reused after.
+    """
+    for key, cache in feat_cache.items():
+        if key not in host_cache:
+            host_cache[key] = torch.empty(
+                cache.shape, dtype=cache.dtype, device="cpu", pin_memory=cache.device.type == "cuda"
+            )
+        feat_cache[key] = host_cache[key].copy_(cache, non_blocking=True)
+
+
+def load_cache(feat_cache, device):
+    # moves the causal caches in feat_cache back to the device for the next chunk
+    for key, cache in feat_cache.items():
+        feat_cache[key] = cache.to(device, non_blocking=True)
+
+
+def causal_conv_cached(layer, x, feat_cache):
+    # runs the causal conv on the chunk x after the frames cached from the previous chunks
+    key = id(layer)
+    cache = feat_cache.get(key)
+    out = layer(x, cache)
+    feat_cache[key] = update_cache(cache, x)
+    return out
+
+
+def repeat_last_frame(x, num_frames):
+    """
+    Pads x to num_frames frames with copies of its last frame.
+    """
+    if x.shape[2] >= num_frames:
+        return x[:, :, :num_frames]
+    return torch.cat([x, x[:, :, -1:].expand(-1, -1, num_frames - x.shape[2], -1, -1)], dim=2)
+
+
+def causal_conv_repeated(layer, x, feat_cache, num_frames):
+    # outputs past x.shape[2] + causal padding - 1 only see copies of the last frame of x and equal the last output
+    x = repeat_last_frame(x, min(x.shape[2] + layer._padding[4], num_frames))
+    key = id(layer)
+    return layer(x, feat_cache[key] if key in feat_cache else None)
+
+
 class RMS_norm(nn.Module):
     def __init__(self, dim, channel_first=True, images=True, bias=False):
         super().__init__()
@@ -108,19 +168,12 @@ class Resample(nn.Module):
             if feat_cache is not None:
                 key = id(self.resample)
                 if key not in feat_cache:
-                    feat_cache[key] = "Rep"
+                    # the first chunk is not upsampled in time, the second one follows zero frames
+                    feat_cache[key] = x.new_zeros(b, c, CACHE_T, h, w)
                 else:
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if cache_x.shape[2] < 2 and feat_cache[key] != "Rep":
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat([feat_cache[key][:, :, -1:, :, :].to(cache_x.device), cache_x], dim=2)
-                    if cache_x.shape[2] < 2 and feat_cache[key] == "Rep":
-                        cache_x = torch.cat([torch.zeros_like(cache_x).to(cache_x.device), cache_x], dim=2)
-                    if feat_cache[key] == "Rep":
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[key])
-                    feat_cache[key] = cache_x
+                    cache = feat_cache[key]
+                    x, x_in = self.time_conv(x, cache), x
+                    update_cache(cache, x_in)
 
                     x = x.reshape(b, 2, c, t, h, w)
                     x = torch.stack((x[:, 0, :, :, :, :], x[:, 1, :, :, :, :]), 3)
@@ -135,13 +188,31 @@ class Resample(nn.Module):
             if feat_cache is not None:
                 key = id(self.time_conv)
                 if key not in feat_cache:
-                    feat_cache[key] = x.clone()
+                    feat_cache[key] = x[:, :, -1:, :, :].clone()
                 else:
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    x = self.time_conv(torch.cat([feat_cache[key][:, :, -1:, :, :], x], 2))
-                    feat_cache[key] = cache_x
+                    cache = feat_cache[key]
+                    x, x_in = self.time_conv(torch.cat([cache, x], 2)), x
+                    cache.copy_(x_in[:, :, -1:, :, :])
         return x
 
+    def forward_repeated(self, x, feat_cache, num_frames):
+        """
+        See Encoder3d.forward_repeated, returns the frames and the number of frames they stand for.
+        """
+        assert self.mode in ("none", "downsample2d", "downsample3d")
+        t = x.shape[2]
+        x = rearrange(x, "b c t h w -> (b t) c h w")
+        x = self.resample(x)
+        x = rearrange(x, "(b t) c h w -> b c t h w", t=t)
+
+        if self.mode == "downsample3d":
+            num_frames //= 2
+            # outputs from ceil(t / 2) on only see copies of the last frame of x
+            t = min((t + 1) // 2 + 1, num_frames)
+            x = repeat_last_frame(x, 2 * t)
+            x = self.time_conv(torch.cat([feat_cache[id(self.time_conv)][:, :, -1:, :, :], x], 2))
+        return x, num_frames
+
 
 class ResidualBlock(nn.Module):
     def __init__(self, in_dim, out_dim, dropout=0.0):
@@ -165,17 +236,23 @@ class ResidualBlock(nn.Module):
         h = self.shortcut(x)
         for layer in self.residual:
             if check_is_instance(layer, CausalConv3d) and feat_cache is not None:
-                key = id(layer)
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and key in feat_cache:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([feat_cache[key][:, :, -1:, :, :].to(cache_x.device), cache_x], dim=2)
-                x = layer(x, feat_cache[key] if key in feat_cache else None)
-                feat_cache[key] = cache_x
+                x = causal_conv_cached(layer, x, feat_cache)
             else:
                 x = layer(x)
         return x + h
 
+    def forward_repeated(self, x, feat_cache, num_frames):
+        """
+        See Encoder3d.forward_repeated.
+        """
+        h = self.shortcut(x)
+        for layer in self.residual:
+            if check_is_instance(layer, CausalConv3d):
+                x = causal_conv_repeated(layer, x, feat_cache, num_frames)
+            else:
+                x = layer(x)
+        return x + repeat_last_frame(h, x.shape[2])
+
 
 class AttentionBlock(nn.Module):
     """
@@ -185,6 +262,7 @@ class AttentionBlock(nn.Module):
     def __init__(self, dim):
         super().__init__()
         self.dim = dim
+        self.attn_implementation = "sdpa"
 
         # layers
         self.norm = RMS_norm(dim)
@@ -203,12 +281,7 @@ class AttentionBlock(nn.Module):
         q, k, v = self.to_qkv(x).reshape(b * t, 1, c * 3, -1).permute(0, 1, 3, 2).contiguous().chunk(3, dim=-1)
 
         # apply attention
-        x = F.scaled_dot_product_attention(
-            q,
-            k,
-            v,
-            # attn_mask=block_causal_mask(q, block_size=h * w)
-        )
+        x = attention(q, k, v, attn_impl=self.attn_implementation)
         x = x.squeeze(1).permute(0, 2, 1).reshape(b * t, c, h, w)
 
         # output
@@ -272,13 +345,7 @@ class Encoder3d(nn.Module):
 
     def forward(self, x, feat_cache=None):
         if feat_cache is not None:
-            key = id(self.conv1)
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and key in feat_cache:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([feat_cache[key][:, :, -1:, :, :].to(cache_x.device), cache_x], dim=2)
-            x = self.conv1(x, feat_cache[key] if key in feat_cache else None)
-            feat_cache[key] = cache_x
+            x = causal_conv_cached(self.conv1, x, feat_cache)
         else:
             x = self.conv1(x)
 
@@ -299,17 +366,33 @@ class Encoder3d(nn.Module):
         ## head
         for layer in self.head:
             if check_is_instance(layer, CausalConv3d) and feat_cache is not None:
-                key = id(layer)
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and key in feat_cache:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([feat_cache[key][:, :, -1:, :, :].to(cache_x.device), cache_x], dim=2)
-                x = layer(x, feat_cache[key] if key in feat_cache else None)
-                feat_cache[key] = cache_x
+                x = causal_conv_cached(layer, x, feat_cache)
             else:
                 x = layer(x)
         return x
 
+    def forward_repeated(self, x, feat_cache, num_frames):
+        """
+        Continues a chunked encode with num_frames frames that all equal the last frame of x, in one pass instead of
+        chunk by chunk. The convolutions are causal, so past the first few frames every layer gives the same output
+        for each of the repeated frames: only the frames that still differ and one of the repeated ones are computed,
+        the returned frames stand for the returned number of frames with the last one repeated.
+        """
+        x = causal_conv_repeated(self.conv1, x, feat_cache, num_frames)
+        for layer in [*self.downsamples, *self.middle]:
+            if check_is_instance(layer, Resample):
+                x, num_frames = layer.forward_repeated(x, feat_cache, num_frames)
+            elif check_is_instance(layer, ResidualBlock):
+                x = layer.forward_repeated(x, feat_cache, num_frames)
+            else:
+                x = layer(x)
+        for layer in self.head:
+            if check_is_instance(layer, CausalConv3d):
+                x = causal_conv_repeated(layer, x, feat_cache, num_frames)
+            else:
+                x = layer(x)
+        return x, num_frames
+
 
 class Decoder3d(nn.Module):
     def __init__(
@@ -367,13 +450,7 @@ class Decoder3d(nn.Module):
     def forward(self, x, feat_cache=None):
         ## conv1
         if feat_cache is not None:
-            key = id(self.conv1)
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and key in feat_cache:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([feat_cache[key][:, :, -1:, :, :].to(cache_x.device), cache_x], dim=2)
-            x = self.conv1(x, feat_cache[key] if key in feat_cache else None)
-            feat_cache[key] = cache_x
+            x = causal_conv_cached(self.conv1, x, feat_cache)
         else:
             x = self.conv1(x)
 
@@ -394,13 +471,7 @@ class Decoder3d(nn.Module):
         ## head
         for layer in self.head:
             if check_is_instance(layer, CausalConv3d) and feat_cache is not None:
-                key = id(layer)
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and key in feat_cache:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([feat_cache[key][:, :, -1:, :, :].to(cache_x.device), cache_x], dim=2)
-                x = layer(x, feat_cache[key] if key in feat_cache else None)
-                feat_cache[key] = cache_x
+                x = causal_conv_cached(layer, x, feat_cache)
             else:
                 x = layer(x)
         return x
@@ -440,20 +511,36 @@ class VideoVAE(nn.Module):
         x_recon = self.decode(z)
         return x_recon, mu, log_var
 
-    def encode(self, x, scale):
+    def encode(self, x, scale, chunk_size=1):
+        """
+        Encodes the first frame and then chunk_size latent frames of 4 frames each per encoder call, larger chunks
+        trade memory for fewer calls and give the same latents.
+        """
         feat_cache = {}
-        t = x.shape[2]
-        iter_ = 1 + (t - 1) // 4
+        num_latent_frames = 1 + (x.shape[2] - 1) // 4
 
-        for i in range(iter_):
-            if i == 0:
-                out = self.encoder(x[:, :, :1, :, :], feat_cache=feat_cache)
-            else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1) : 1 + 4 * i, :, :],
-                    feat_cache=feat_cache,
-                )
-                out = torch.cat([out, out_], 2)
+        first = self.encoder(x[:, :, :1, :, :], feat_cache=feat_cache)
+        out = first.new_empty(*first.shape[:2], num_latent_frames, *first.shape[3:])
+        out[:, :, :1] = first
+        for i in range(1, num_latent_frames, chunk_size):
+            j = min(i + chunk_size, num_latent_frames)
+            out[:, :, i:j] = self.encoder(x[:, :, 1 + 4 * (i - 1) : 1 + 4 * (j - 1), :, :], feat_cache=feat_cache)
+        return self.normalize_mu(out, scale)
+
+    def encode_first_frame(self, x, num_frames, scale):
+        """
+        Encodes the frame x followed by num_frames - 1 zero frames, the same latents as encode on the zero padded
+        video without running the encoder chunk by chunk over the zero frames.
+        """
+        feat_cache = {}
+        out = self.encoder(x, feat_cache=feat_cache)
+        num_tail_frames = (num_frames - 1) // 4 * 4
+        if num_tail_frames > 0:
+            tail, num_tail_frames = self.encoder.forward_repeated(torch.zeros_like(x), feat_cache, num_tail_frames)
+            out = torch.cat([out, repeat_last_frame(tail, num_tail_frames)], 2)
+        return self.normalize_mu(out, scale)
+
+    def normalize_mu(self, out, scale):
         mu, log_var = self.conv1(out).chunk(2, dim=1)
         if isinstance(scale[0], torch.Tensor):
             scale = [s.to(dtype=mu.dtype, device=mu.device) for s in scale]
@@ -463,8 +550,25 @@ class VideoVAE(nn.Module):
             mu = (mu - scale[0]) * scale[1]
         return mu
 
-    def decode(self, z, scale):
-        feat_cache = {}
+    def decode(self, z, scale, chunk_size=1):
+        """
+        Decodes the first latent frame and then chunk_size latent frames per decoder call, larger chunks trade memory
+        for fewer calls and give the same frames.
+        """
+        out, t = None, 0
+        for frames in self.decode_chunks(z, scale, chunk_size):
+            if out is None:
+                out = frames.new_empty(*frames.shape[:2], 4 * z.shape[2] - 3, *frames.shape[3:])
+            out[:, :, t : t + frames.shape[2]] = frames
+            t += frames.shape[2]
+        return out
+
+    def decode_chunks(self, z, scale, chunk_size=1, feat_cache=None):
+        """
+        Yields the frames of the first latent frame and then of chunk_size latent frames at a time, see decode. The
+        causal caches are kept in feat_cache, which the caller may move between the chunks.
+        """
+        feat_cache = {} if feat_cache is None else feat_cache
         # z: [b,c,t,h,w]
         if isinstance(scale[0], torch.Tensor):
             scale = [s.to(dtype=z.dtype, device=z.device) for s in scale]
@@ -472,15 +576,12 @@ class VideoVAE(nn.Module):
         else:
             scale = scale.to(dtype=z.dtype, device=z.device)
             z = z / scale[1] + scale[0]
-        iter_ = z.shape[2]
+        num_latent_frames = z.shape[2]
         x = self.conv2(z)
-        for i in range(iter_):
-            if i == 0:
-                out = self.decoder(x[:, :, i : i + 1, :, :], feat_cache=feat_cache)
-            else:
-                out_ = self.decoder(x[:, :, i : i + 1, :, :], feat_cache=feat_cache)
-                out = torch.cat([out, out_], 2)  # may add tensor offload
-        return out
+
+        yield self.decoder(x[:, :, :1, :, :], feat_cache=feat_cache)
+        for i in range(1, num_latent_frames, chunk_size):
+            yield self.decoder(x[:, :, i : i + chunk_size, :, :], feat_cache=feat_cache)
 
     def reparameterize(self, mu, log_var):
         std = torch.exp(0.5 * log_var)
@@ -560,6 +661,7 @@ class WanVideoVAE(PreTrainedModel):
         # init model
         self.model = VideoVAE(z_dim=z_dim).eval().requires_grad_(False)
         self.upsampling_factor = 8
+        self._masks = {}
 
     @classmethod
     def from_state_dict(cls, state_dict, device="cuda:0", dtype=torch.float32) -> "WanVideoVAE":
@@ -579,193 +681,339 @@ class WanVideoVAE(PreTrainedModel):
 
     def build_mask(self, data, is_bound, border_width):
         _, _, _, H, W = data.shape
-        h = self.build_1d_mask(H, is_bound[0], is_bound[1], border_width[0])
-        w = self.build_1d_mask(W, is_bound[2], is_bound[3], border_width[1])
+        # interior tiles share the same mask, it is built once for every shape, bounds and border on the device of data
+        key = (H, W, is_bound, border_width, data.device, data.dtype)
+        if key not in self._masks:
+            h = self.build_1d_mask(H, is_bound[0], is_bound[1], border_width[0])
+            w = self.build_1d_mask(W, is_bound[2], is_bound[3], border_width[1])
+
+            h = repeat(h, "H -> H W", H=H, W=W)
+            w = repeat(w, "W -> H W", H=H, W=W)
 
-        h = repeat(h, "H -> H W", H=H, W=W)
-        w = repeat(w, "W -> H W", H=H, W=W)
+            mask = torch.stack([h, w]).min(dim=0).values
+            self._masks[key] = rearrange(mask, "H W -> 1 1 1 H W").to(device=data.device, dtype=data.dtype)
+        return self._masks[key]
 
-        mask = torch.stack([h, w]).min(dim=0).values
-        mask = rearrange(mask, "H W -> 1 1 1 H W")
-        return mask
+    def blend_device(self, num_bytes, device):
+        """
+        Blends tiles on the device if the accumulators of num_bytes fit into a quarter of the free device memory,
+        otherwise on the host.
+        """
+        device = torch.device(device)
+        if device.type != "cuda":
+            return "cpu"
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        return device if num_bytes <= free_memory // 4 else "cpu"
 
-    def tiled_decode(self, hidden_states, device, tile_size, tile_stride, progress_callback=None):
-        _, _, T, H, W = hidden_states.shape
+    def tile_batch_size(self, batch_size, num_frames, height, width, device, dtype):
+        """
+        The number of tiles of batch_size videos of num_frames x height x width pixels that are run together within
+        half of the free device memory, tiles are run one by one on the cpu.
+        """
+        device = torch.device(device)
+        if device.type != "cuda":
+            return 1
+        free_memory, _ = torch.cuda.mem_get_info(device)
+        # the pixels of a tile and the activations of a chunk of 4 frames at full resolution, where they are largest
+        tile_bytes = batch_size * (3 * num_frames + 4 * 8 * self.model.dim) * height * width * dtype.itemsize
+        return max(1, free_memory // 2 // tile_bytes)
+
+    def split_tiles(self, H, W, tile_size, tile_stride):
+        # tiles grouped by shape, tiles of the same shape can be run as one batch
         size_h, size_w = tile_size
         stride_h, stride_w = tile_stride
-
-        # Split tasks
-        tasks = []
+        tasks = defaultdict(list)
         for h in range(0, H, stride_h):
             if h - stride_h >= 0 and h - stride_h + size_h >= H:
                 continue
             for w in range(0, W, stride_w):
                 if w - stride_w >= 0 and w - stride_w + size_w >= W:
                     continue
-                h_, w_ = h + size_h, w + size_w
-                tasks.append((h, h_, w, w_))
-
-        data_device = "cpu"
-        computation_device = device
-
-        out_T = T * 4 - 3
-        weight = torch.zeros(
-            (1, 1, out_T, H * self.upsampling_factor, W * self.upsampling_factor),
-            dtype=hidden_states.dtype,
-            device=data_device,
-        )
-        values = torch.zeros(
-            (1, 3, out_T, H * self.upsampling_factor, W * self.upsampling_factor),
-            dtype=hidden_states.dtype,
-            device=data_device,
-        )
-
-        for i, (h, h_, w, w_) in enumerate(tqdm(tasks, desc="VAE DECODING")):
-            hidden_states_batch = hidden_states[:, :, :, h:h_, w:w_].to(computation_device)
-            hidden_states_batch = self.model.decode(hidden_states_batch, self.scale).to(data_device)
-
-            mask = self.build_mask(
-                hidden_states_batch,
-                is_bound=(h == 0, h_ >= H, w == 0, w_ >= W),
-                border_width=(
-                    (size_h - stride_h) * self.upsampling_factor,
-                    (size_w - stride_w) * self.upsampling_factor,
-                ),
-            ).to(dtype=hidden_states.dtype, device=data_device)
-
-            target_h = h * self.upsampling_factor
-            target_w = w * self.upsampling_factor
-            values[
-                :,
-                :,
-                :,
-                target_h : target_h + hidden_states_batch.shape[3],
-                target_w : target_w + hidden_states_batch.shape[4],
-            ] += hidden_states_batch * mask
-            weight[
-                :,
-                :,
-                :,
-                target_h : target_h + hidden_states_batch.shape[3],
-                target_w : target_w + hidden_states_batch.shape[4],
-            ] += mask
-            if progress_callback is not None:
-                progress_callback(i + 1, len(tasks), "VAE DECODING")
-        values = values / weight
-        values = values.float().clamp_(-1, 1)
-        return values
+                h_, w_ = min(h + size_h, H), min(w + size_w, W)
+                tasks[(h_ - h, w_ - w)].append((h, h_, w, w_))
+        return tasks
 
-    def tiled_encode(self, video, device, tile_size, tile_stride, progress_callback=None):
-        _, _, T, H, W = video.shape
+    def tiled_forward(
+        self,
+        data,
+        forward,
+        device,
+        tile_size,
+        tile_stride,
+        scale_factor,
+        out_channels,
+        out_T,
+        desc,
+        progress_callback=None,
+        tile_batch_size=None,
+        data_device=None,
+    ):
+        """
+        Runs forward on overlapping tiles of data and blends the outputs. Tiles of the same shape are run in batches
+        of tile_batch_size, by default as many as fit into half of the free device memory. The outputs are blended on
+        data_device, by default on the computation device if the accumulators fit. Batches blended on the host are
+        blended while the device runs the next batch.
+        """
+        B, _, T, H, W = data.shape
         size_h, size_w = tile_size
         stride_h, stride_w = tile_stride
 
-        # Split tasks
-        tasks = []
-        for h in range(0, H, stride_h):
-            if h - stride_h >= 0 and h - stride_h + size_h >= H:
-                continue
-            for w in range(0, W, stride_w):
-                if w - stride_w >= 0 and w - stride_w + size_w >= W:
-                    continue
-                h_, w_ = h + size_h, w + size_w
-                tasks.append((h, h_, w, w_))
+        tasks = self.split_tiles(H, W, tile_size, tile_stride)
+        num_tasks = sum(len(group) for group in tasks.values())
 
-        data_device = "cpu"
+        out_H, out_W = int(H * scale_factor), int(W * scale_factor)
         computation_device = device
-
-        out_T = (T + 3) // 4
-        weight = torch.zeros(
-            (1, 1, out_T, H // self.upsampling_factor, W // self.upsampling_factor),
-            dtype=video.dtype,
-            device=data_device,
-        )
-        values = torch.zeros(
-            (1, 16, out_T, H // self.upsampling_factor, W // self.upsampling_factor),
-            dtype=video.dtype,
-            device=data_device,
+        if data_device is None:
+            num_bytes = (B * out_channels * out_T + 1) * out_H * out_W * data.dtype.itemsize
+            data_device = self.blend_device(num_bytes, computation_device)
+        # the masks of a tile are the same for all frames
+        weight = torch.zeros((1, 1, 1, out_H, out_W), dtype=data.dtype, device=data_device)
+        values = torch.zeros((B, out_channels, out_T, out_H, out_W), dtype=data.dtype, device=data_device)
+
+        if tile_batch_size is None:
+            # the size of a tile at full resolution, the output of decoding and the input of encoding
+            upsampling = max(scale_factor, 1)
+            tile_batch_size = self.tile_batch_size(
+                B, max(T, out_T), size_h * upsampling, size_w * upsampling, device, data.dtype
+            )
+        batches = [
+            group[i : i + tile_batch_size] for group in tasks.values() for i in range(0, len(group), tile_batch_size)
+        ]
+        border_width = (int((size_h - stride_h) * scale_factor), int((size_w - stride_w) * scale_factor))
+
+        num_done = 0
+
+        def blend(batch, outputs, event):
+            nonlocal num_done
+            if event is not None:
+                event.synchronize()
+            for (h, h_, w, w_), output in zip(batch, outputs.split(B)):
+                mask = self.build_mask(output, is_bound=(h == 0, h_ >= H, w == 0, w_ >= W), border_width=border_width)
+                target_h, target_w = int(h * scale_factor), int(w * scale_factor)
+                values[:, :, :, target_h : target_h + output.shape[3], target_w : target_w + output.shape[4]] += (
+                    output * mask
+                )
+                weight[:, :, :, target_h : target_h + output.shape[3], target_w : target_w + output.shape[4]] += mask
+            num_done += len(batch)
+            if progress_callback is not None:
+                progress_callback(num_done, num_tasks, desc)
+
+        pending = None
+        for batch in tqdm(batches, desc=desc):
+            tiles = torch.cat([data[:, :, :, h:h_, w:w_] for h, h_, w, w_ in batch]).to(computation_device)
+            outputs = forward(tiles).to(dtype=data.dtype)
+            event = None
+            if outputs.device != torch.device(data_device):
+                outputs = outputs.to(data_device, non_blocking=True)
+                if torch.device(computation_device).type == "cuda":
+                    event = torch.cuda.Event()
+                    event.record()
+            # the previous batch is blended on the host while the device runs this one, blending on the device is
+            # queued behind it
+            if pending is not None:
+                blend(*pending)
+            pending = (batch, outputs, event)
+        if pending is not None:
+            blend(*pending)
+        return (values / weight).to("cpu")
+
+    def tiled_decode(
+        self, hidden_states, device, tile_size, tile_stride, progress_callback=None, tile_batch_size=None, chunk_size=1
+    ):
+        values = self.tiled_forward(
+            hidden_states,
+            lambda x: self.model.decode(x, self.scale, chunk_size=chunk_size),
+            device,
+            tile_size,
+            tile_stride,
+            scale_factor=self.upsampling_factor,
+            out_channels=3,
+            out_T=hidden_states.shape[2] * 4 - 3,
+            desc="VAE DECODING",
+            progress_callback=progress_callback,
+            tile_batch_size=tile_batch_size,
         )
+        values = values.float().clamp_(-1, 1)
+        return values
 
-        for i, (h, h_, w, w_) in enumerate(tqdm(tasks, desc="VAE ENCODING")):
-            hidden_states_batch = video[:, :, :, h:h_, w:w_].to(computation_device)
-            hidden_states_batch = self.model.encode(hidden_states_batch, self.scale).to(data_device)
-
-            mask = self.build_mask(
-                hidden_states_batch,
-                is_bound=(h == 0, h_ >= H, w == 0, w_ >= W),
-                border_width=(
-                    (size_h - stride_h) // self.upsampling_factor,
-                    (size_w - stride_w) // self.upsampling_factor,
-                ),
-            ).to(dtype=video.dtype, device=data_device)
-
-            target_h = h // self.upsampling_factor
-            target_w = w // self.upsampling_factor
-            values[
-                :,
-                :,
-                :,
-                target_h : target_h + hidden_states_batch.shape[3],
-                target_w : target_w + hidden_states_batch.shape[4],
-            ] += hidden_states_batch * mask
-            weight[
-                :,
-                :,
-                :,
-                target_h : target_h + hidden_states_batch.shape[3],
-                target_w : target_w + hidden_states_batch.shape[4],
-            ] += mask
-            if progress_callback is not None:
-                progress_callback(i + 1, len(tasks), "VAE ENCODING")
-        values = values / weight
+    def tiled_encode(
+        self, video, device, tile_size, tile_stride, progress_callback=None, tile_batch_size=None, chunk_size=1
+    ):
+        values = self.tiled_forward(
+            video,
+            lambda x: self.model.encode(x, self.scale, chunk_size=chunk_size),
+            device,
+            tile_size,
+            tile_stride,
+            scale_factor=1 / self.upsampling_factor,
+            out_channels=16,
+            out_T=(video.shape[2] + 3) // 4,
+            desc="VAE ENCODING",
+            progress_callback=progress_callback,
+            tile_batch_size=tile_batch_size,
+        )
         values = values.float()
         return values
 
-    def single_encode(self, video, device, progress_callback=None):
+    def single_encode(self, video, device, progress_callback=None, chunk_size=1):
         video = video.to(device)
-        x = self.model.encode(video, self.scale)
+        x = self.model.encode(video, self.scale, chunk_size=chunk_size)
         if progress_callback is not None:
             progress_callback(1, 1, "VAE ENCODING")
         return x.float()
 
-    def single_decode(self, hidden_state, device, progress_callback=None):
+    def encode_first_frame(self, images, num_frames, device, progress_callback=None):
+        """
+        Encodes images of shape [C, 1, H, W] each followed by num_frames - 1 zero frames, the image to video
+        condition of Wan, without encoding the zero frames chunk by chunk.
+        """
+        images = torch.stack([image.to("cpu") for image in images]).to(device)
+        hidden_states = self.model.encode_first_frame(images, num_frames, self.scale)
+        if progress_callback is not None:
+            progress_callback(1, 1, "VAE ENCODING")
+        return hidden_states.float()
+
+    def single_decode(self, hidden_state, device, progress_callback=None, chunk_size=1):
         hidden_state = hidden_state.to(device)
-        video = self.model.decode(hidden_state, self.scale)
+        video = self.model.decode(hidden_state, self.scale, chunk_size=chunk_size)
         if progress_callback is not None:
             progress_callback(1, 1, "VAE DECODING")
         return video.float().clamp_(-1, 1)
 
-    def encode(self, videos, device, tiled=False, tile_size=(34, 34), tile_stride=(18, 16), progress_callback=None):
-        videos = [video.to("cpu") for video in videos]
-        hidden_states = []
-        for video in videos:
-            video = video.unsqueeze(0)
-            if tiled:
-                tile_size = (tile_size[0] * 8, tile_size[1] * 8)
-                tile_stride = (tile_stride[0] * 8, tile_stride[1] * 8)
-                hidden_state = self.tiled_encode(
-                    video, device, tile_size, tile_stride, progress_callback=progress_callback
-                )
-            else:
-                hidden_state = self.single_encode(video, device, progress_callback=progress_callback)
-            hidden_state = hidden_state.squeeze(0)
-            hidden_states.append(hidden_state)
-        hidden_states = torch.stack(hidden_states)
+    def encode(
+        self,
+        videos,
+        device,
+        tiled=False,
+        tile_size=(34, 34),
+        tile_stride=(18, 16),
+        progress_callback=None,
+        tile_batch_size=None,
+        chunk_size=1,
+    ):
+        # videos of the same size are encoded as one batch, each tile runs once for all of them
+        videos = torch.stack([video.to("cpu") for video in videos])
+        if tiled:
+            tile_size = (tile_size[0] * 8, tile_size[1] * 8)
+            tile_stride = (tile_stride[0] * 8, tile_stride[1] * 8)
+            hidden_states = self.tiled_encode(
+                videos,
+                device,
+                tile_size,
+                tile_stride,
+                progress_callback=progress_callback,
+                tile_batch_size=tile_batch_size,
+                chunk_size=chunk_size,
+            )
+        else:
+            hidden_states = self.single_encode(
+                videos, device, progress_callback=progress_callback, chunk_size=chunk_size
+            )
         return hidden_states
 
     def decode(
-        self, hidden_states, device, tiled=False, tile_size=(34, 34), tile_stride=(18, 16), progress_callback=None
+        self,
+        hidden_states,
+        device,
+        tiled=False,
+        tile_size=(34, 34),
+        tile_stride=(18, 16),
+        progress_callback=None,
+        tile_batch_size=None,
+        chunk_size=1,
     ):
-        hidden_states = [hidden_state.to("cpu") for hidden_state in hidden_states]
-        videos = []
-        for i, hidden_state in enumerate(hidden_states):
-            hidden_state = hidden_state.unsqueeze(0)
-            if tiled:
-                video = self.tiled_decode(
-                    hidden_state, device, tile_size, tile_stride, progress_callback=progress_callback
-                )
-            else:
-                video = self.single_decode(hidden_state, device, progress_callback=progress_callback)
-            video = video.squeeze(0)
-            videos.append(video)
-        return videos
+        # latents of the same size are decoded as one batch, each tile runs once for all of them
+        hidden_states = torch.stack([hidden_state.to("cpu") for hidden_state in hidden_states])
+        if tiled:
+            videos = self.tiled_decode(
+                hidden_states,
+                device,
+                tile_size,
+                tile_stride,
+                progress_callback=progress_callback,
+                tile_batch_size=tile_batch_size,
+                chunk_size=chunk_size,
+            )
+        else:
+            videos = self.single_decode(
+                hidden_states, device, progress_callback=progress_callback, chunk_size=chunk_size
+            )
+        return list(videos.unbind(0))
+
+    def decode_stream(
+        self,
+        hidden_states,
+        device,
+        tiled=False,
+        tile_size=(34, 34),
+        tile_stride=(18, 16),
+        tile_batch_size=None,
+        chunk_size=1,
+    ):
+        """
+        Decodes like decode, but yields the [B, C, T, H, W] frames of all videos as soon as they are decoded: the first
+        frame and then 4 * chunk_size frames at a time. Tiled decoding keeps the causal caches of all tiles in between,
+        on the host for all but the running batch of tiles, so the device memory is bounded by one batch like decode.
+        """
+        hidden_states = torch.stack([hidden_state.to("cpu") for hidden_state in hidden_states])
+        if not tiled:
+            for frames in self.model.decode_chunks(hidden_states.to(device), self.scale, chunk_size):
+                yield frames.float().clamp_(-1, 1)
+            return
+
+        B, _, T, H, W = hidden_states.shape
+        size_h, size_w = tile_size
+        stride_h, stride_w = tile_stride
+        tasks = self.split_tiles(H, W, tile_size, tile_stride)
+        if tile_batch_size is None:
+            tile_batch_size = self.tile_batch_size(
+                B,
+                4 * chunk_size,
+                size_h * self.upsampling_factor,
+                size_w * self.upsampling_factor,
+                device,
+                hidden_states.dtype,
+            )
+        batches = [
+            group[i : i + tile_batch_size] for group in tasks.values() for i in range(0, len(group), tile_batch_size)
+        ]
+        border_width = ((size_h - stride_h) * self.upsampling_factor, (size_w - stride_w) * self.upsampling_factor)
+        out_H, out_W = H * self.upsampling_factor, W * self.upsampling_factor
+
+        # every batch of tiles is decoded by its own generator with its own causal caches, with several batches the
+        # caches of the batches that are not running wait on the host so that only one batch is on the device
+        offload = len(batches) > 1 and torch.device(device).type != "cpu"
+        streams, feat_caches, host_caches = [], [], []
+        for batch in batches:
+            tiles = torch.cat([hidden_states[:, :, :, h:h_, w:w_] for h, h_, w, w_ in batch]).to(device)
+            feat_caches.append({})
+            host_caches.append({})
+            streams.append(self.model.decode_chunks(tiles, self.scale, chunk_size, feat_cache=feat_caches[-1]))
+
+        weight = None
+        for _ in range(1 + len(range(1, T, chunk_size))):
+            values, new_weight = None, weight is None
+            for batch, stream, feat_cache, host_cache in zip(batches, streams, feat_caches, host_caches):
+                if offload:
+                    load_cache(feat_cache, device)
+                outputs = next(stream)
+                if offload:
+                    offload_cache(feat_cache, host_cache)
+                if values is None:
+                    values = torch.zeros((B, 3, outputs.shape[2], out_H, out_W), dtype=outputs.dtype, device=device)
+                    # the masks of a tile are the same for all frames and chunks
+                    if new_weight:
+                        weight = torch.zeros((1, 1, 1, out_H, out_W), dtype=outputs.dtype, device=device)
+                for (h, h_, w, w_), output in zip(batch, outputs.split(B)):
+                    mask = self.build_mask(
+                        output, is_bound=(h == 0, h_ >= H, w == 0, w_ >= W), border_width=border_width
+                    )
+                    target_h, target_w = h * self.upsampling_factor, w * self.upsampling_factor
+                    values[:, :, :, target_h : target_h + output.shape[3], target_w : target_w + output.shape[4]] += (
+                        output * mask
+                    )
+                    if new_weight:
+                        weight[
+                            :, :, :, target_h : target_h + output.shape[3], target_w : target_w + output.shape[4]
+                        ] += mask
+            yield (values / weight).float().clamp_(-1, 1)
@@ -1,14 +1,16 @@
 import os
 import torch
 import numpy as np
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 from PIL import Image, ImageOps
 from einops import repeat
 from dataclasses import dataclass
 from safetensors.torch import load_file
 
 from diffsynth_engine.utils.offload import enable_sequential_cpu_offload
+from diffsynth_engine.utils.compile import set_compile_cache_dir, set_compile_cache_size
 from diffsynth_engine.utils.gguf import load_gguf_checkpoint
+from diffsynth_engine.utils.tensor_cache import TensorCache, image_fingerprint, lora_fingerprint, model_fingerprint
 from diffsynth_engine.utils import logging
 
 logger = logging.get_logger(__name__)
@@ -26,6 +28,8 @@ class BasePipeline:
         self.dtype = dtype
         self.offload_mode = None
         self.model_names = []
+        self.prompt_cache = None
+        self.condition_cache = None
 
     @classmethod
     def from_pretrained(
@@ -91,14 +95,169 @@ class BasePipeline:
 
     @staticmethod
     def generate_noise(shape, seed=None, device="cpu", dtype=torch.float16):
+        if isinstance(seed, (list, tuple)):
+            # one generator per sample, each image of a batch is the same as generated alone with its seed
+            if len(seed) != shape[0]:
+                raise ValueError(f"expects {shape[0]} seeds for a batch of {shape[0]}, but got {len(seed)}")
+            return torch.cat([BasePipeline.generate_noise((1, *shape[1:]), s, device, dtype) for s in seed])
         generator = None if seed is None else torch.Generator(device).manual_seed(seed)
         noise = torch.randn(shape, generator=generator, device=device, dtype=dtype)
         return noise
 
+    @staticmethod
+    def prepare_batch(
+        prompt: str | List[str],
+        negative_prompt: str | List[str] = "",
+        seed: int | List[int] | None = None,
+        num_images_per_prompt: int = 1,
+    ) -> Tuple[List[str], List[str], List[int | None]]:
+        """
+        Expands the inputs of a pipeline call to one prompt, negative prompt and seed per image. Every prompt is
+        repeated `num_images_per_prompt` times, a single prompt is repeated for every seed of a seed list, and an int
+        seed gives the images seed, seed + 1, ... so that the first image is the same as without batching.
+        """
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        if isinstance(negative_prompt, str):
+            negative_prompts = [negative_prompt] * len(prompts)
+        else:
+            negative_prompts = list(negative_prompt)
+        if len(negative_prompts) != len(prompts):
+            raise ValueError(f"expects {len(prompts)} negative prompts, but got {len(negative_prompts)}")
+        if num_images_per_prompt < 1:
+            raise ValueError(f"num_images_per_prompt must be positive, but got {num_images_per_prompt}")
+        prompts = [p for p in prompts for _ in range(num_images_per_prompt)]
+        negative_prompts = [p for p in negative_prompts for _ in range(num_images_per_prompt)]
+
+        if isinstance(seed, (list, tuple)):
+            if len(prompts) == 1:
+                prompts, negative_prompts = prompts * len(seed), negative_prompts * len(seed)
+            if len(seed) != len(prompts):
+                raise ValueError(f"expects {len(prompts)} seeds, but got {len(seed)}")
+            seeds = list(seed)
+        else:
+            seeds = [None if seed is None else seed + i for i in range(len(prompts))]
+        return prompts, negative_prompts, seeds
+
+    @staticmethod
+    def is_batch_call(prompt: str | List[str], seed: int | List[int] | None, num_images_per_prompt: int) -> bool:
+        # calls with a single prompt and seed keep returning a single image
+        return not isinstance(prompt, str) or isinstance(seed, (list, tuple)) or num_images_per_prompt > 1
+
+    @staticmethod
+    def unique_prompts(prompts: List[str]) -> Tuple[List[str], torch.Tensor]:
+        """
+        Returns the distinct prompts to encode once and the index of each prompt among them.
+        """
+        unique = list(dict.fromkeys(prompts))
+        index = torch.tensor([unique.index(prompt) for prompt in prompts], dtype=torch.long)
+        return unique, index
+
+    def enable_prompt_cache(self, max_memory_bytes: int = 1 << 30, cache_dir: Optional[str] = None):
+        """
+        Caches the text embeddings of every encoded prompt, in memory within `max_memory_bytes` and with `cache_dir`
+        also on disk for other processes. Cached prompts are not encoded again, and with cpu_offload the text encoders
+        are not loaded to the device at all when every prompt of a call is cached.
+        """
+        self.prompt_cache = TensorCache(max_memory_bytes, cache_dir)
+
+    def disable_prompt_cache(self):
+        self.prompt_cache = None
+
+    def encode_prompt_with_cache(
+        self,
+        model_names: List[str],
+        input_ids: List[torch.Tensor],
+        encode: Callable[[List[int]], Dict[str, torch.Tensor]],
+        **key_kwargs,
+    ) -> List[Dict[str, torch.Tensor]]:
+        """
+        Returns the embeddings of each prompt of a batch as a dict of tensors with batch size 1. `input_ids` holds the
+        token ids of every tokenizer with a row per prompt, and `encode(indices)` runs the text encoders `model_names`
+        on the given rows. A prompt is cached by the weights and LoRA of the text encoders, `key_kwargs` like
+        clip_skip and its token ids.
+        """
+        num_prompts = input_ids[0].shape[0]
+        if self.prompt_cache is None:
+            self.load_models_to_device(model_names)
+            embs = encode(list(range(num_prompts)))
+            return [{name: emb[i : i + 1] for name, emb in embs.items()} for i in range(num_prompts)]
+
+        encoders = self.model_cache_keys(model_names)
+        keys = [
+            TensorCache.make_key(encoders, sorted(key_kwargs.items()), *[ids[i].cpu() for ids in input_ids])
+            for i in range(num_prompts)
+        ]
+        rows = [self.prompt_cache.get(key) for key in keys]
+        rows = [None if row is None else {name: emb.to(self.device) for name, emb in row.items()} for row in rows]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if len(missing) > 0:
+            self.load_models_to_device(model_names)
+            embs = encode(missing)
+            for j, i in enumerate(missing):
+                rows[i] = {name: emb[j : j + 1] for name, emb in embs.items()}
+                self.prompt_cache.put(keys[i], rows[i])
+        return rows
+
+    def enable_condition_cache(self, max_memory_bytes: int = 1 << 30, cache_dir: Optional[str] = None):
+        """
+        Caches the encoded input images of img2img, inpainting and image to video, VAE latents and CLIP image
+        features, in memory within `max_memory_bytes` and with `cache_dir` also on disk. An image reused with other
+        prompts, seeds or strengths is not encoded again.
+        """
+        self.condition_cache = TensorCache(max_memory_bytes, cache_dir)
+
+    def disable_condition_cache(self):
+        self.condition_cache = None
+
+    def encode_condition_with_cache(
+        self,
+        model_names: List[str],
+        images: List[Image.Image],
+        encode: Callable[[], Dict[str, torch.Tensor]],
+        **key_kwargs,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Returns `encode()`, the conditioning computed from `images` by the models `model_names`, from the condition
+        cache when enabled. It is cached by the content of the images, the weights and LoRA of the models and
+        `key_kwargs` like the resolution and tiling.
+        """
+        if self.condition_cache is None:
+            self.load_models_to_device(model_names)
+            return encode()
+        key = TensorCache.make_key(
+            self.model_cache_keys(model_names), image_fingerprint(images), sorted(key_kwargs.items())
+        )
+        condition = self.condition_cache.get(key)
+        if condition is not None:
+            return {name: tensor.to(self.device) for name, tensor in condition.items()}
+        self.load_models_to_device(model_names)
+        condition = encode()
+        self.condition_cache.put(key, condition)
+        return condition
+
+    def model_cache_keys(self, model_names: List[str]) -> List[Tuple[str, str]]:
+        return [(model_fingerprint(getattr(self, name)), lora_fingerprint(getattr(self, name))) for name in model_names]
+
     def encode_image(self, image: torch.Tensor, tiled=False, tile_size=64, tile_stride=32) -> torch.Tensor:
         latents = self.vae_encoder(image, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
         return latents
 
+    def encode_input_image(self, input_image: Image.Image, tiled=False, tile_size=64, tile_stride=32) -> torch.Tensor:
+        def encode():
+            image = self.preprocess_image(input_image).to(device=self.device, dtype=self.dtype)
+            return {"latents": self.encode_image(image, tiled, tile_size, tile_stride)}
+
+        condition = self.encode_condition_with_cache(
+            ["vae_encoder"],
+            [input_image],
+            encode,
+            dtype=self.dtype,
+            tiled=tiled,
+            tile_size=tile_size,
+            tile_stride=tile_stride,
+        )
+        return condition["latents"]
+
     def decode_image(self, latent: torch.Tensor, tiled=False, tile_size=64, tile_stride=32) -> torch.Tensor:
         vae_dtype = self.vae_decoder.conv_in.weight.dtype
         image = self.vae_decoder(latent.to(vae_dtype), tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
@@ -139,10 +298,8 @@ class BasePipeline:
             sigma_start, sigmas = sigmas[t_start - 1], sigmas[t_start - 1 :]
             timesteps = timesteps[t_start - 1 :]
 
-            self.load_models_to_device(["vae_encoder"])
             noise = latents
-            image = self.preprocess_image(input_image).to(device=self.device, dtype=self.dtype)
-            latents = self.encode_image(image, tiled, tile_size, tile_stride)
+            latents = self.encode_input_image(input_image, tiled, tile_size, tile_stride)
             init_latents = latents.clone()
             latents = self.sampler.add_noise(latents, noise, sigma_start)
         else:
@@ -164,6 +321,38 @@ class BasePipeline:
     def enable_fp8_linear(self):
         raise NotImplementedError()
 
+    def enable_compile(
+        self,
+        resolution_buckets: Optional[List[Tuple[int, ...]]] = None,
+        cache_dir: Optional[str] = None,
+        **compile_kwargs,
+    ):
+        """
+        Compiles the repeated blocks of the denoising model and warms up every resolution bucket, (height, width) for
+        image pipelines and (height, width, num_frames) for video pipelines. Other resolutions compile on first use.
+        With `cache_dir`, compiled kernels are persisted and reused after a restart.
+        """
+        if cache_dir is not None:
+            set_compile_cache_dir(cache_dir)
+        resolution_buckets = resolution_buckets or []
+        set_compile_cache_size(len(resolution_buckets))
+        self._compile_models(**compile_kwargs)
+        for bucket in resolution_buckets:
+            logger.info(f"warming up compiled models for resolution {bucket} ...")
+            self._warmup_compile(*bucket)
+
+    def _compile_models(self, **compile_kwargs):
+        raise NotImplementedError()
+
+    def _warmup_compile(self, height: int, width: int):
+        self(prompt="", height=height, width=width, num_inference_steps=1)
+
+    @staticmethod
+    def validate_int8_mode(int8_mode: str | None):
+        valid_int8_mode = (None, "dynamic", "weight_only")
+        if int8_mode not in valid_int8_mode:
+            raise ValueError(f"int8 mode must be one of {valid_int8_mode}, but got {int8_mode}")
+
     @staticmethod
     def validate_offload_mode(offload_mode: str | None):
         valid_offload_mode = (None, "cpu_offload", "sequential_cpu_offload")
@@ -25,6 +25,8 @@ from diffsynth_engine.algorithm.sampler import FlowMatchEulerSampler
 from diffsynth_engine.utils.constants import FLUX_TOKENIZER_1_CONF_PATH, FLUX_TOKENIZER_2_CONF_PATH
 from diffsynth_engine.utils import logging
 from diffsynth_engine.utils.fp8_linear import enable_fp8_linear
+from diffsynth_engine.utils.gguf import enable_gguf_linear
+from diffsynth_engine.utils.int8_linear import enable_int8_linear
 from diffsynth_engine.utils.download import fetch_model
 
 logger = logging.get_logger(__name__)
@@ -176,6 +178,9 @@ def calculate_shift(
     return mu
 
 
+T5_MAX_LENGTH = 512
+
+
 @dataclass
 class FluxModelConfig:
     dit_path: str | os.PathLike
@@ -187,6 +192,11 @@ class FluxModelConfig:
     clip_dtype: torch.dtype = torch.bfloat16
     t5_dtype: torch.dtype = torch.bfloat16
     vae_dtype: torch.dtype = torch.float32
+    # int8 quantization of T5 linear layers, "dynamic" (int8 activations and matmul) or "weight_only"
+    t5_int8: Optional[str] = None
+    # quantize DiT / T5 linear layers to GGUF blocks ("Q8_0", "Q6_K" or "Q4_K") when loading
+    dit_gguf_quant: Optional[str] = None
+    t5_gguf_quant: Optional[str] = None
 
 
 class FluxImagePipeline(BasePipeline):
@@ -219,6 +229,7 @@ class FluxImagePipeline(BasePipeline):
         self.vae_encoder = vae_encoder
         self.use_cfg = use_cfg
         self.batch_cfg = batch_cfg
+        self.t5_length_buckets = None
         self.model_names = [
             "text_encoder_1",
             "text_encoder_2",
@@ -242,6 +253,7 @@ class FluxImagePipeline(BasePipeline):
             if isinstance(model_path_or_config, FluxModelConfig)
             else FluxModelConfig(dit_path=model_path_or_config, dit_dtype=dtype, t5_dtype=dtype, clip_dtype=dtype)
         )
+        cls.validate_int8_mode(model_config.t5_int8)
 
         if model_config.clip_path is None:
             model_config.clip_path = fetch_model(
@@ -266,14 +278,23 @@ class FluxImagePipeline(BasePipeline):
         init_device = "cpu" if offload_mode else device
         tokenizer = CLIPTokenizer.from_pretrained(FLUX_TOKENIZER_1_CONF_PATH)
         tokenizer_2 = T5TokenizerFast.from_pretrained(FLUX_TOKENIZER_2_CONF_PATH)
+        # quantize on cpu, so that only quantized weights are moved to the device
+        dit_device = "cpu" if model_config.dit_gguf_quant is not None else init_device
+        t5_device = "cpu" if model_config.t5_gguf_quant is not None else init_device
         with LoRAContext():
-            dit = FluxDiT.from_state_dict(dit_state_dict, device=init_device, dtype=model_config.dit_dtype)
+            dit = FluxDiT.from_state_dict(dit_state_dict, device=dit_device, dtype=model_config.dit_dtype)
             text_encoder_1 = FluxTextEncoder1.from_state_dict(
                 clip_state_dict, device=init_device, dtype=model_config.clip_dtype
             )
-        text_encoder_2 = FluxTextEncoder2.from_state_dict(
-            t5_state_dict, device=init_device, dtype=model_config.t5_dtype
-        )
+        text_encoder_2 = FluxTextEncoder2.from_state_dict(t5_state_dict, device=t5_device, dtype=model_config.t5_dtype)
+        if model_config.dit_gguf_quant is not None:
+            enable_gguf_linear(dit, model_config.dit_gguf_quant)
+            dit.to(init_device)
+        if model_config.t5_gguf_quant is not None:
+            enable_gguf_linear(text_encoder_2, model_config.t5_gguf_quant)
+            text_encoder_2.to(init_device)
+        if model_config.t5_int8 is not None:
+            enable_int8_linear(text_encoder_2, dynamic=model_config.t5_int8 == "dynamic")
         vae_decoder = FluxVAEDecoder.from_state_dict(vae_state_dict, device=init_device, dtype=model_config.vae_dtype)
         vae_encoder = FluxVAEEncoder.from_state_dict(vae_state_dict, device=init_device, dtype=model_config.vae_dtype)
 
@@ -340,19 +361,53 @@ class FluxImagePipeline(BasePipeline):
     def denoising_model(self):
         return self.dit
 
-    def encode_prompt(self, prompt, clip_skip: int = 2):
-        input_ids = self.tokenizer(prompt, max_length=77)["input_ids"].to(device=self.device)
-        _, add_text_embeds = self.text_encoder_1(input_ids, clip_skip=clip_skip)
-
-        input_ids = self.tokenizer_2(prompt, max_length=512)["input_ids"].to(device=self.device)
-        prompt_emb = self.text_encoder_2(input_ids)
-
+    def enable_t5_truncation(self, length_buckets: Tuple[int, ...] = (128, 256)):
+        """
+        Trims the T5 padding to the real prompt length rounded up to one of `length_buckets`, which shortens the joint
+        sequence of every DiT block. T5 attends to its padding in Flux, so images differ slightly from the default.
+        """
+        self.t5_length_buckets = tuple(sorted(length_buckets))
+
+    def disable_t5_truncation(self):
+        self.t5_length_buckets = None
+
+    def enable_chunked_ffn(self, chunk_size: int = 4096, chunk_modulation: bool = False):
+        self.dit.enable_chunked_ffn(chunk_size, chunk_modulation)
+
+    def disable_chunked_ffn(self):
+        self.dit.disable_chunked_ffn()
+
+    def get_t5_max_length(self, prompts: List[str]) -> int:
+        if self.t5_length_buckets is None:
+            return T5_MAX_LENGTH
+        attention_mask = self.tokenizer_2(prompts, max_length=T5_MAX_LENGTH)["attention_mask"]
+        seq_len = int(attention_mask.sum(dim=1).max())
+        for bucket in self.t5_length_buckets:
+            if seq_len <= bucket <= T5_MAX_LENGTH:
+                return bucket
+        return T5_MAX_LENGTH
+
+    def encode_prompt(self, prompt, clip_skip: int = 2, t5_max_length: int = T5_MAX_LENGTH):
+        input_ids = self.tokenizer(prompt, max_length=77)["input_ids"]
+        input_ids_2 = self.tokenizer_2(prompt, max_length=t5_max_length)["input_ids"]
+
+        def encode(indices):
+            _, add_text_embeds = self.text_encoder_1(input_ids[indices].to(self.device), clip_skip=clip_skip)
+            prompt_emb = self.text_encoder_2(input_ids_2[indices].to(self.device))
+            return {"prompt_emb": prompt_emb, "add_text_embeds": add_text_embeds}
+
+        embs = self.encode_prompt_with_cache(
+            ["text_encoder_1", "text_encoder_2"], [input_ids, input_ids_2], encode, clip_skip=clip_skip
+        )
+        prompt_emb = torch.cat([emb["prompt_emb"] for emb in embs])
+        add_text_embeds = torch.cat([emb["add_text_embeds"] for emb in embs])
         return prompt_emb, add_text_embeds
 
     def prepare_extra_input(self, latents, positive_prompt_emb, guidance=1.0):
-        image_ids = self.dit.prepare_image_ids(latents)
+        # positions are the same for every sample, the rotary embedding of a single sample broadcasts over the batch
+        image_ids = self.dit.prepare_image_ids(latents[:1])
         guidance = torch.tensor([guidance] * latents.shape[0], device=latents.device, dtype=latents.dtype)
-        text_ids = torch.zeros(positive_prompt_emb.shape[0], positive_prompt_emb.shape[1], 3).to(
+        text_ids = torch.zeros(1, positive_prompt_emb.shape[1], 3).to(
             device=self.device, dtype=positive_prompt_emb.dtype
         )
         return image_ids, text_ids, guidance
@@ -392,9 +447,10 @@ class FluxImagePipeline(BasePipeline):
             add_text_embeds = torch.cat([positive_add_text_embeds, negative_add_text_embeds], dim=0)
             latents = torch.cat([latents, latents], dim=0)
             timestep = torch.cat([timestep, timestep], dim=0)
+            guidance = torch.cat([guidance, guidance], dim=0)
             positive_noise_pred, negative_noise_pred = self.predict_noise(
                 latents, timestep, prompt_emb, add_text_embeds, image_ids, text_ids, guidance
-            )
+            ).chunk(2)
             noise_pred = negative_noise_pred + cfg_scale * (positive_noise_pred - negative_noise_pred)
             return noise_pred
 
@@ -440,10 +496,8 @@ class FluxImagePipeline(BasePipeline):
             sigma_start, sigmas = sigmas[t_start - 1], sigmas[t_start - 1 :]
             timesteps = timesteps[t_start - 1 :]
 
-            self.load_models_to_device(["vae_encoder"])
             noise = latents
-            image = self.preprocess_image(input_image).to(device=self.device, dtype=self.dtype)
-            latents = self.encode_image(image, tiled, tile_size, tile_stride)
+            latents = self.encode_input_image(input_image, tiled, tile_size, tile_stride)
             init_latents = latents.clone()
             latents = self.sampler.add_noise(latents, noise, sigma_start)
         else:
@@ -457,6 +511,9 @@ class FluxImagePipeline(BasePipeline):
     def enable_fp8_linear(self):
         enable_fp8_linear(self.dit)
 
+    def _compile_models(self, **compile_kwargs):
+        self.dit.compile_repeated_blocks(**compile_kwargs)
+
     def use_sage_attn(self):
         self.dit.set_attn_implementation("sage_attn")
 
@@ -466,8 +523,8 @@ class FluxImagePipeline(BasePipeline):
     @torch.no_grad()
     def __call__(
         self,
-        prompt: str,
-        negative_prompt: str = "",
+        prompt: str | List[str],
+        negative_prompt: str | List[str] = "",
         cfg_scale: float = 1.0,
         clip_skip: int = 2,
         input_image: Image.Image | None = None,
@@ -479,15 +536,23 @@ class FluxImagePipeline(BasePipeline):
         tiled: bool = False,
         tile_size: int = 128,
         tile_stride: int = 64,
-        seed: int | None = None,
+        seed: int | List[int] | None = None,
+        num_images_per_prompt: int = 1,
         progress_callback: Optional[Callable] = None,  # def progress_callback(current, total, status)
     ):
+        """
+        A list of prompts, a list of seeds or `num_images_per_prompt` > 1 generates a batch in one DiT forward per
+        step and returns a list of images, see `BasePipeline.prepare_batch`.
+        """
+        is_batch = self.is_batch_call(prompt, seed, num_images_per_prompt)
+        prompts, negative_prompts, seeds = self.prepare_batch(prompt, negative_prompt, seed, num_images_per_prompt)
+        batch_size = len(prompts)
         if input_image is not None:
             width, height = input_image.size
         self.validate_image_size(height, width, minimum=64, multiple_of=16)
-        noise = self.generate_noise((1, 16, height // 8, width // 8), seed=seed, device="cpu", dtype=self.dtype).to(
-            device=self.device
-        )
+        noise = self.generate_noise(
+            (batch_size, 16, height // 8, width // 8), seed=seeds, device="cpu", dtype=self.dtype
+        ).to(device=self.device)
 
         image_seq_len = math.ceil(height // 16) * math.ceil(width // 16)
         mu = calculate_shift(image_seq_len)
@@ -500,10 +565,17 @@ class FluxImagePipeline(BasePipeline):
         # Initialize sampler
         self.sampler.initialize(init_latents=init_latents, timesteps=timesteps, sigmas=sigmas, mask=mask)
 
-        # Encode prompts
-        self.load_models_to_device(["text_encoder_1", "text_encoder_2"])
-        positive_prompt_emb, positive_add_text_embeds = self.encode_prompt(prompt, clip_skip=clip_skip)
-        negative_prompt_emb, negative_add_text_embeds = self.encode_prompt(negative_prompt, clip_skip=clip_skip)
+        # Encode prompts, every distinct prompt is encoded once and all prompts share the T5 length for batch cfg
+        use_cfg = self.use_cfg and cfg_scale > 1.0
+        unique_prompts, index = self.unique_prompts(prompts + negative_prompts if use_cfg else prompts)
+        t5_max_length = self.get_t5_max_length(unique_prompts)
+        prompt_emb, add_text_embeds = self.encode_prompt(
+            unique_prompts, clip_skip=clip_skip, t5_max_length=t5_max_length
+        )
+        prompt_emb, add_text_embeds = prompt_emb[index.to(self.device)], add_text_embeds[index.to(self.device)]
+        # negative prompts are not encoded without cfg
+        positive_prompt_emb, negative_prompt_emb = prompt_emb[:batch_size], prompt_emb[batch_size:]
+        positive_add_text_embeds, negative_add_text_embeds = add_text_embeds[:batch_size], add_text_embeds[batch_size:]
 
         # Extra input
         image_ids, text_ids, guidance = self.prepare_extra_input(latents, positive_prompt_emb, guidance=3.5)
@@ -511,7 +583,7 @@ class FluxImagePipeline(BasePipeline):
         # Denoise
         self.load_models_to_device(["dit"])
         for i, timestep in enumerate(tqdm(timesteps)):
-            timestep = timestep.unsqueeze(0).to(dtype=self.dtype)
+            timestep = timestep.to(dtype=self.dtype).expand(batch_size)
             noise_pred = self.predict_noise_with_cfg(
                 latents=latents,
                 timestep=timestep,
@@ -536,13 +608,17 @@ class FluxImagePipeline(BasePipeline):
                 progress_callback(i, len(timesteps), "DENOISING")
         # Decode image
         self.load_models_to_device(["vae_decoder"])
-        vae_output = self.decode_image(latents, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
-        image = self.vae_output_to_image(vae_output)
-        # Paste Overlay Image
-        if mask_image is not None:
-            image = image.convert("RGBA")
-            image.alpha_composite(overlay_image)
-            image = image.convert("RGB")
+        images = []
+        # decode one image at a time, the VAE peak memory does not grow with the batch
+        for latent in latents.split(1):
+            vae_output = self.decode_image(latent, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
+            image = self.vae_output_to_image(vae_output)
+            # Paste Overlay Image
+            if mask_image is not None:
+                image = image.convert("RGBA")
+                image.alpha_composite(overlay_image)
+                image = image.convert("RGB")
+            images.append(image)
         # Offload all models
         self.load_models_to_device([])
-        return image
+        return images if is_batch else images[0]
@@ -236,9 +236,13 @@ class SDImagePipeline(BasePipeline):
         return self.unet
 
     def encode_prompt(self, prompt, clip_skip):
-        input_ids = tokenize_long_prompt(self.tokenizer, prompt).to(self.device)
-        prompt_emb = self.text_encoder(input_ids, clip_skip=clip_skip)
-        return prompt_emb
+        input_ids = tokenize_long_prompt(self.tokenizer, prompt)
+
+        def encode(indices):
+            return {"prompt_emb": self.text_encoder(input_ids[indices].to(self.device), clip_skip=clip_skip)}
+
+        embs = self.encode_prompt_with_cache(["text_encoder"], [input_ids], encode, clip_skip=clip_skip)
+        return torch.cat([emb["prompt_emb"] for emb in embs])
 
     def predict_noise_with_cfg(
         self,
@@ -312,11 +316,14 @@ class SDImagePipeline(BasePipeline):
             if isinstance(module, (LoRALinear, LoRAConv2d)):
                 module.clear()
 
+    def _compile_models(self, **compile_kwargs):
+        self.unet.compile_repeated_blocks(**compile_kwargs)
+
     @torch.no_grad()
     def __call__(
         self,
-        prompt: str,
-        negative_prompt: str = "",
+        prompt: str | List[str],
+        negative_prompt: str | List[str] = "",
         cfg_scale: float = 7.5,
         clip_skip: int = 1,
         input_image: Optional[Image.Image] = None,
@@ -328,13 +335,23 @@ class SDImagePipeline(BasePipeline):
         tiled: bool = False,
         tile_size: int = 64,
         tile_stride: int = 32,
-        seed: int | None = None,
+        seed: int | List[int] | None = None,
+        num_images_per_prompt: int = 1,
         progress_callback: Optional[Callable] = None,  # def progress_callback(current, total, status)
     ):
+        """
+        A list of prompts, a list of seeds or `num_images_per_prompt` > 1 generates a batch in one UNet forward per
+        step and returns a list of images, see `BasePipeline.prepare_batch`.
+        """
+        is_batch = self.is_batch_call(prompt, seed, num_images_per_prompt)
+        prompts, negative_prompts, seeds = self.prepare_batch(prompt, negative_prompt, seed, num_images_per_prompt)
+        batch_size = len(prompts)
         if input_image is not None:
             width, height = input_image.size
         self.validate_image_size(height, width, minimum=64, multiple_of=8)
-        noise = self.generate_noise((1, 4, height // 8, width // 8), seed=seed, device=self.device, dtype=self.dtype)
+        noise = self.generate_noise(
+            (batch_size, 4, height // 8, width // 8), seed=seeds, device=self.device, dtype=self.dtype
+        )
 
         init_latents, latents, sigmas, timesteps = self.prepare_latents(
             noise, input_image, denoising_strength, num_inference_steps, tiled, tile_size, tile_stride
@@ -345,15 +362,15 @@ class SDImagePipeline(BasePipeline):
         # Initialize sampler
         self.sampler.initialize(init_latents=init_latents, timesteps=timesteps, sigmas=sigmas, mask=mask)
 
-        # Encode prompts
-        self.load_models_to_device(["text_encoder"])
-        positive_prompt_emb = self.encode_prompt(prompt, clip_skip=clip_skip)
-        negative_prompt_emb = self.encode_prompt(negative_prompt, clip_skip=clip_skip)
+        # Encode prompts, every distinct prompt is encoded once
+        unique_prompts, index = self.unique_prompts(prompts + negative_prompts)
+        prompt_emb = self.encode_prompt(unique_prompts, clip_skip=clip_skip)[index.to(self.device)]
+        positive_prompt_emb, negative_prompt_emb = prompt_emb.chunk(2)
 
         # Denoise
         self.load_models_to_device(["unet"])
         for i, timestep in enumerate(tqdm(timesteps)):
-            timestep = timestep.unsqueeze(0).to(self.device)
+            timestep = timestep.to(self.device).expand(batch_size)
             # Classifier-free guidance
             noise_pred = self.predict_noise_with_cfg(
                 latents=latents,
@@ -374,13 +391,17 @@ class SDImagePipeline(BasePipeline):
             latents = latents * mask + init_latents * (1 - mask)
         # Decode image
         self.load_models_to_device(["vae_decoder"])
-        vae_output = self.decode_image(latents, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
-        image = self.vae_output_to_image(vae_output)
-        # Paste Overlay Image
-        if mask_image is not None:
-            image = image.convert("RGBA")
-            image.alpha_composite(overlay_image)
-            image = image.convert("RGB")
+        images = []
+        # decode one image at a time, the VAE peak memory does not grow with the batch
+        for latent in latents.split(1):
+            vae_output = self.decode_image(latent, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
+            image = self.vae_output_to_image(vae_output)
+            # Paste Overlay Image
+            if mask_image is not None:
+                image = image.convert("RGBA")
+                image.alpha_composite(overlay_image)
+                image = image.convert("RGB")
+            images.append(image)
         # offload all models
         self.load_models_to_device([])
-        return image
+        return images if is_batch else images[0]
@@ -223,23 +223,23 @@ class SDXLImagePipeline(BasePipeline):
         return self.unet
 
     def encode_prompt(self, prompt, clip_skip):
-        input_ids = tokenize_long_prompt(self.tokenizer, prompt).to(self.device)
-        prompt_emb_1 = self.text_encoder(input_ids, clip_skip=clip_skip)
+        input_ids = tokenize_long_prompt(self.tokenizer, prompt)
+        input_ids_2 = tokenize_long_prompt(self.tokenizer_2, prompt)
 
-        input_ids_2 = tokenize_long_prompt(self.tokenizer_2, prompt).to(self.device)
-        prompt_emb_2, add_text_embeds = self.text_encoder_2(input_ids_2, clip_skip=clip_skip)
-
-        # Merge
-        if prompt_emb_1.shape[0] != prompt_emb_2.shape[0]:
-            max_batch_size = min(prompt_emb_1.shape[0], prompt_emb_2.shape[0])
-            prompt_emb_1 = prompt_emb_1[:max_batch_size]
-            prompt_emb_2 = prompt_emb_2[:max_batch_size]
-        prompt_emb = torch.concatenate([prompt_emb_1, prompt_emb_2], dim=-1)
-
-        # For very long prompt, we only use the first 77 tokens to compute `add_text_embeds`.
-        add_text_embeds = add_text_embeds[0:1]
-        prompt_emb = prompt_emb.reshape((1, prompt_emb.shape[0] * prompt_emb.shape[1], -1))
+        def encode(indices):
+            prompt_emb_1 = self.text_encoder(input_ids[indices].to(self.device), clip_skip=clip_skip)
+            prompt_emb_2, add_text_embeds = self.text_encoder_2(
+                input_ids_2[indices].to(self.device), clip_skip=clip_skip
+            )
+            # Merge
+            prompt_emb = torch.concatenate([prompt_emb_1, prompt_emb_2], dim=-1)
+            return {"prompt_emb": prompt_emb, "add_text_embeds": add_text_embeds}
 
+        embs = self.encode_prompt_with_cache(
+            ["text_encoder", "text_encoder_2"], [input_ids, input_ids_2], encode, clip_skip=clip_skip
+        )
+        prompt_emb = torch.cat([emb["prompt_emb"] for emb in embs])
+        add_text_embeds = torch.cat([emb["add_text_embeds"] for emb in embs])
         return prompt_emb, add_text_embeds
 
     def prepare_add_time_id(self, latents):
@@ -270,7 +270,7 @@ class SDXLImagePipeline(BasePipeline):
         batch_cfg: bool = True,
     ):
         if cfg_scale <= 1.0:
-            return self.predict_noise(latents, timestep, positive_prompt_emb, add_time_id)
+            return self.predict_noise(latents, timestep, positive_prompt_emb, positive_add_text_embeds, add_time_id)
         if not batch_cfg:
             # cfg by predict noise one by one
             positive_noise_pred = self.predict_noise(
@@ -290,7 +290,7 @@ class SDXLImagePipeline(BasePipeline):
             timestep = torch.cat([timestep, timestep], dim=0)
             positive_noise_pred, negative_noise_pred = self.predict_noise(
                 latents, timestep, prompt_emb, add_text_embeds, add_time_ids
-            )
+            ).chunk(2)
             noise_pred = negative_noise_pred + cfg_scale * (positive_noise_pred - negative_noise_pred)
             return noise_pred
 
@@ -345,11 +345,14 @@ class SDXLImagePipeline(BasePipeline):
             if isinstance(module, (LoRALinear, LoRAConv2d)):
                 module.clear()
 
+    def _compile_models(self, **compile_kwargs):
+        self.unet.compile_repeated_blocks(**compile_kwargs)
+
     @torch.no_grad()
     def __call__(
         self,
-        prompt: str,
-        negative_prompt: str = "",
+        prompt: str | List[str],
+        negative_prompt: str | List[str] = "",
         cfg_scale: float = 7.5,
         clip_skip: int = 2,
         input_image: Image.Image | None = None,
@@ -361,13 +364,23 @@ class SDXLImagePipeline(BasePipeline):
         tiled: bool = False,
         tile_size: int = 64,
         tile_stride: int = 32,
-        seed: int | None = None,
+        seed: int | List[int] | None = None,
+        num_images_per_prompt: int = 1,
         progress_callback: Optional[Callable] = None,  # def progress_callback(current, total, status)
     ):
+        """
+        A list of prompts, a list of seeds or `num_images_per_prompt` > 1 generates a batch in one UNet forward per
+        step and returns a list of images, see `BasePipeline.prepare_batch`.
+        """
+        is_batch = self.is_batch_call(prompt, seed, num_images_per_prompt)
+        prompts, negative_prompts, seeds = self.prepare_batch(prompt, negative_prompt, seed, num_images_per_prompt)
+        batch_size = len(prompts)
         if input_image is not None:
             width, height = input_image.size
         self.validate_image_size(height, width, minimum=64, multiple_of=8)
-        noise = self.generate_noise((1, 4, height // 8, width // 8), seed=seed, device=self.device, dtype=self.dtype)
+        noise = self.generate_noise(
+            (batch_size, 4, height // 8, width // 8), seed=seeds, device=self.device, dtype=self.dtype
+        )
 
         init_latents, latents, sigmas, timesteps = self.prepare_latents(
             noise, input_image, denoising_strength, num_inference_steps, tiled, tile_size, tile_stride
@@ -378,17 +391,16 @@ class SDXLImagePipeline(BasePipeline):
         # Initialize sampler
         self.sampler.initialize(init_latents=init_latents, timesteps=timesteps, sigmas=sigmas, mask=mask)
 
-        # Encode prompts
-        self.load_models_to_device(["text_encoder", "text_encoder_2"])
-        positive_prompt_emb, positive_add_text_embeds = self.encode_prompt(prompt, clip_skip=clip_skip)
-        if negative_prompt != "":
-            negative_prompt_emb, negative_add_text_embeds = self.encode_prompt(negative_prompt, clip_skip=clip_skip)
-        else:
-            # from automatic1111/stable-diffusion-webui
-            negative_prompt_emb, negative_add_text_embeds = (
-                torch.zeros_like(positive_prompt_emb),
-                torch.zeros_like(positive_add_text_embeds),
-            )
+        # Encode prompts, every distinct prompt is encoded once
+        unique_prompts, index = self.unique_prompts(prompts + negative_prompts)
+        prompt_emb, add_text_embeds = self.encode_prompt(unique_prompts, clip_skip=clip_skip)
+        prompt_emb, add_text_embeds = prompt_emb[index.to(self.device)], add_text_embeds[index.to(self.device)]
+        # empty negative prompts are zero embeddings, from automatic1111/stable-diffusion-webui
+        is_empty = torch.tensor([p == "" for p in negative_prompts], device=self.device)
+        positive_prompt_emb, negative_prompt_emb = prompt_emb.chunk(2)
+        positive_add_text_embeds, negative_add_text_embeds = add_text_embeds.chunk(2)
+        negative_prompt_emb = negative_prompt_emb.masked_fill(is_empty[:, None, None], 0)
+        negative_add_text_embeds = negative_add_text_embeds.masked_fill(is_empty[:, None], 0)
 
         # Prepare extra input
         add_time_id = self.prepare_add_time_id(latents)
@@ -396,7 +408,7 @@ class SDXLImagePipeline(BasePipeline):
         # Denoise
         self.load_models_to_device(["unet"])
         for i, timestep in enumerate(tqdm(timesteps)):
-            timestep = timestep.unsqueeze(0).to(dtype=self.dtype)
+            timestep = timestep.to(dtype=self.dtype).expand(batch_size)
             # Classifier-free guidance
             noise_pred = self.predict_noise_with_cfg(
                 latents=latents,
@@ -418,13 +430,16 @@ class SDXLImagePipeline(BasePipeline):
             latents = latents * mask + init_latents * (1 - mask)
         # Decode image
         self.load_models_to_device(["vae_decoder"])
-        vae_output = self.decode_image(latents, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
-        image = self.vae_output_to_image(vae_output)
-
-        if mask_image is not None:
-            image = image.convert("RGBA")
-            image.alpha_composite(overlay_image)
-            image = image.convert("RGB")
+        images = []
+        # decode one image at a time, the VAE peak memory does not grow with the batch
+        for latent in latents.split(1):
+            vae_output = self.decode_image(latent, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)
+            image = self.vae_output_to_image(vae_output)
+            if mask_image is not None:
+                image = image.convert("RGBA")
+                image.alpha_composite(overlay_image)
+                image = image.convert("RGB")
+            images.append(image)
         # offload all models
         self.load_models_to_device([])
-        return image
+        return images if is_batch else images[0]
@@ -1,9 +1,10 @@
 import logging
 import torch
+import torch.nn.functional as F
 import numpy as np
 from einops import rearrange
 from dataclasses import dataclass
-from typing import Callable, List, Tuple, Optional
+from typing import Callable, Iterator, List, Tuple, Optional
 from tqdm import tqdm
 from PIL import Image
 
@@ -18,6 +19,9 @@ from diffsynth_engine.models.base import LoRAStateDictConverter
 from diffsynth_engine.tokenizers import WanT5Tokenizer
 from diffsynth_engine.pipelines import BasePipeline
 from diffsynth_engine.utils.constants import WAN_TOKENIZER_CONF_PATH
+from diffsynth_engine.utils.fp8_linear import _scaled_mm_support, enable_fp8_linear
+from diffsynth_engine.utils.gguf import enable_gguf_linear
+from diffsynth_engine.utils.int8_linear import enable_int8_linear
 from diffsynth_engine.utils.download import fetch_model
 from diffsynth_engine.utils.loader import load_file
 from diffsynth_engine.utils.parallel import ParallelModel
@@ -53,6 +57,13 @@ class WanModelConfig:
     dit_dtype: torch.dtype = torch.bfloat16
     t5_dtype: torch.dtype = torch.bfloat16
     image_encoder_dtype: torch.dtype = torch.bfloat16
+    # run the linear layers of DiT blocks with scaled fp8 weights, None enables it on devices with fp8 matmul
+    dit_fp8_linear: Optional[bool] = None
+    # int8 quantization of T5 linear layers, "dynamic" (int8 activations and matmul) or "weight_only"
+    t5_int8: Optional[str] = None
+    # quantize DiT / T5 linear layers to GGUF blocks ("Q8_0", "Q6_K" or "Q4_K") when loading
+    dit_gguf_quant: Optional[str] = None
+    t5_gguf_quant: Optional[str] = None
 
 
 class WanLoRAConverter(LoRAStateDictConverter):
@@ -176,50 +187,130 @@ class WanVideoPipeline(BasePipeline):
     def denoising_model(self):
         return self.dit
 
+    def enable_fp8_linear(self):
+        enable_fp8_linear(self.dit.blocks)
+
+    def _compile_models(self, **compile_kwargs):
+        if isinstance(self.dit, ParallelModel):
+            raise ValueError("enable_compile is not supported with parallelism > 1")
+        self.dit.compile_repeated_blocks(**compile_kwargs)
+
+    @torch.no_grad()
+    def _warmup_compile(self, height: int, width: int, num_frames: int = 81):
+        # runs the dit once on dummy inputs of the bucket, the prompt length is dynamic
+        self.load_models_to_device(["dit"])
+        batch_size = 2 if self.batch_cfg else 1
+        dtype = self.config.dit_dtype
+        latents = torch.zeros(
+            (batch_size, 16, (num_frames - 1) // 4 + 1, height // 8, width // 8), device=self.device, dtype=dtype
+        )
+        timestep = torch.zeros((batch_size,), device=self.device, dtype=dtype)
+        context = torch.zeros(
+            (batch_size, 16, self.dit.text_embedding[0].in_features), device=self.device, dtype=dtype
+        )
+        clip_feature, y = None, None
+        if self.dit.has_image_input:
+            # 257 tokens of the clip image encoder
+            clip_feature = torch.zeros((batch_size, 257, 1280), device=self.device, dtype=dtype)
+            y = torch.zeros(
+                (batch_size, self.dit.patch_embedding.in_channels - 16, *latents.shape[2:]),
+                device=self.device,
+                dtype=dtype,
+            )
+        # the warmup is not a denoising step of TeaCache, and the first steps always run all blocks
+        cnt = self.dit.cnt
+        self.dit.cnt = 0
+        self.dit(x=latents, context=context, timestep=timestep, num_frames=num_frames, clip_feature=clip_feature, y=y)
+        self.dit.cnt = cnt
+
+    def enable_sliding_tile_attention(
+        self,
+        tile_size: Tuple[int, int, int] = (4, 8, 8),
+        window_size: Tuple[int, int, int] = (3, 3, 3),
+        num_global_tokens: int = 64,
+        dense_steps: int = 10,
+    ):
+        self.dit.enable_sliding_tile_attention(tile_size, window_size, num_global_tokens, dense_steps)
+
+    def disable_sliding_tile_attention(self):
+        self.dit.disable_sliding_tile_attention()
+
+    def enable_chunked_ffn(self, chunk_size: int = 4096, chunk_modulation: bool = False):
+        """
+        Lowers the peak activation memory of the DiT by running its feed forward layers over `chunk_size` tokens at a
+        time, e.g. 81 frames of 480P video have 32760 tokens whose [32760, 13824] hidden states take 0.9GB in 14B.
+        """
+        self.dit.enable_chunked_ffn(chunk_size, chunk_modulation)
+
+    def disable_chunked_ffn(self):
+        self.dit.disable_chunked_ffn()
+
     def encode_prompt(self, prompt):
         ids, mask = self.tokenizer(prompt, return_mask=True, add_special_tokens=True)
-        ids = ids.to(self.device)
-        mask = mask.to(self.device)
-        prompt_emb = self.text_encoder(ids, mask)
-        prompt_emb = prompt_emb.masked_fill(mask.unsqueeze(-1).expand_as(prompt_emb) == 0, 0)
+        seq_lens = mask.sum(dim=1)
+
+        def encode(indices):
+            # only encode real tokens, the DiT accounts for the padding to text_len
+            seq_len = int(seq_lens[indices].max())
+            prompt_emb = self.text_encoder(
+                ids[indices, :seq_len].to(self.device), mask[indices, :seq_len].to(self.device)
+            )
+            return {"prompt_emb": prompt_emb}
+
+        embs = self.encode_prompt_with_cache(["text_encoder"], [ids], encode)
+        # each prompt is zero padded from its real length to the longest of the batch
+        prompt_emb, _ = self.pad_prompt_embs(
+            [emb["prompt_emb"][:, : int(seq_len)] for emb, seq_len in zip(embs, seq_lens)]
+        )
         return prompt_emb
 
+    @staticmethod
+    def pad_prompt_embs(prompt_embs: List[torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+        # concat prompt embeddings of different lengths into a zero padded batch and their real lengths
+        max_len = max(prompt_emb.shape[1] for prompt_emb in prompt_embs)
+        context_lens = torch.tensor(
+            [prompt_emb.shape[1] for prompt_emb in prompt_embs for _ in range(prompt_emb.shape[0])],
+            device=prompt_embs[0].device,
+        )
+        prompt_emb = torch.cat(
+            [F.pad(prompt_emb, (0, 0, 0, max_len - prompt_emb.shape[1])) for prompt_emb in prompt_embs], dim=0
+        )
+        return prompt_emb, context_lens
+
     def encode_image(self, image, num_frames, height, width):
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+        def encode():
+            rgb_image = image.convert("RGB") if image.mode != "RGB" else image
+            pixels = self.preprocess_image(rgb_image.resize((width, height), Image.Resampling.LANCZOS)).to(
+                self.device, self.config.image_encoder_dtype
+            )
 
-        image = self.preprocess_image(image.resize((width, height), Image.Resampling.LANCZOS)).to(
-            self.device, self.config.image_encoder_dtype
+            clip_context = self.image_encoder.encode_image([pixels])
+            msk = torch.ones(
+                1, num_frames, height // 8, width // 8, device=self.device, dtype=self.config.image_encoder_dtype
+            )
+            msk[:, 1:] = 0
+            msk = torch.concat([torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]], dim=1)
+            msk = msk.view(1, msk.shape[1] // 4, 4, height // 8, width // 8)
+            msk = msk.transpose(1, 2)[0]
+            # the same latents as encoding the image followed by num_frames - 1 zero frames
+            y = self.vae.encode_first_frame(
+                [pixels.transpose(0, 1).to(self.config.vae_dtype)], num_frames, device=self.device
+            )[0]
+            y = torch.concat([msk, y]).to(dtype=self.dtype)
+            return {"clip_context": clip_context, "y": torch.unsqueeze(y, 0)}
+
+        # an image reused with other prompts or seeds is encoded once with the condition cache
+        condition = self.encode_condition_with_cache(
+            ["image_encoder", "vae"], [image], encode, num_frames=num_frames, height=height, width=width
         )
+        return condition["clip_context"], condition["y"]
 
-        clip_context = self.image_encoder.encode_image([image])
-        msk = torch.ones(
-            1, num_frames, height // 8, width // 8, device=self.device, dtype=self.config.image_encoder_dtype
-        )
-        msk[:, 1:] = 0
-        msk = torch.concat([torch.repeat_interleave(msk[:, 0:1], repeats=4, dim=1), msk[:, 1:]], dim=1)
-        msk = msk.view(1, msk.shape[1] // 4, 4, height // 8, width // 8)
-        msk = msk.transpose(1, 2)[0]
-        y = self.vae.encode(
-            [
-                torch.concat(
-                    [
-                        image.transpose(0, 1),
-                        torch.zeros(3, num_frames - 1, height, width).to(image.device, self.config.vae_dtype),
-                    ],
-                    dim=1,
-                )
-            ],
-            device=self.device,
-        )[0]
-        y = torch.concat([msk, y]).to(dtype=self.dtype)
-        return clip_context, torch.unsqueeze(y, 0)
+    def tensor2frames(self, frames) -> np.ndarray:
+        frames = rearrange(frames, "C T H W -> T H W C")
+        return ((frames.float() + 1) * 127.5).clip(0, 255).to(torch.uint8).cpu().numpy()
 
     def tensor2video(self, frames):
-        frames = rearrange(frames, "C T H W -> T H W C")
-        frames = ((frames.float() + 1) * 127.5).clip(0, 255).cpu().numpy().astype(np.uint8)
-        frames = [Image.fromarray(frame) for frame in frames]
-        return frames
+        return [Image.fromarray(frame) for frame in self.tensor2frames(frames)]
 
     def encode_video(self, videos: torch.Tensor, tiled=True, tile_size=(34, 34), tile_stride=(18, 16)):
         videos = videos.to(dtype=self.config.vae_dtype, device=self.device)
@@ -255,6 +346,8 @@ class WanVideoPipeline(BasePipeline):
         use_cfg_zero_star: bool,
         slg_layers: list[int],
         num_frames: int,
+        step_index: int = 0,
+        cfg_zero_steps: int = 0,
     ):
         if cfg_scale <= 1.0:
             return self.predict_noise(
@@ -264,6 +357,7 @@ class WanVideoPipeline(BasePipeline):
                 timestep=timestep,
                 context=positive_prompt_emb,
                 num_frames=num_frames,
+                step_index=step_index,
             )
         if not batch_cfg:
             # cfg by predict noise one by one
@@ -274,6 +368,7 @@ class WanVideoPipeline(BasePipeline):
                 timestep=timestep,
                 context=positive_prompt_emb,
                 num_frames=num_frames,
+                step_index=step_index,
             )
             negative_noise_pred = self.predict_noise(
                 latents=latents,
@@ -283,12 +378,13 @@ class WanVideoPipeline(BasePipeline):
                 context=negative_prompt_emb,
                 slg_layers=slg_layers,
                 num_frames=num_frames,
+                step_index=step_index,
             )
             noise_pred = negative_noise_pred + cfg_scale * (positive_noise_pred - negative_noise_pred)
             return noise_pred
         else:
             # cfg by predict noise in one batch
-            prompt_emb = torch.cat([positive_prompt_emb, negative_prompt_emb], dim=0)
+            prompt_emb, context_lens = self.pad_prompt_embs([positive_prompt_emb, negative_prompt_emb])
             latents = torch.cat([latents, latents], dim=0)
             timestep = torch.cat([timestep, timestep], dim=0)
             if image_y is not None:
@@ -302,16 +398,19 @@ class WanVideoPipeline(BasePipeline):
                 timestep=timestep,
                 context=prompt_emb,
                 num_frames=num_frames,
-            )
+                context_lens=context_lens,
+                step_index=step_index,
+            ).chunk(2)
             # https://github.com/WeichenFan/CFG-Zero-star
             if use_cfg_zero_star:
-                positive_flat = positive_noise_pred.view(1, -1)
-                negative_flat = negative_noise_pred.view(1, -1)
+                # one scale per sample of the batch
+                positive_flat = positive_noise_pred.flatten(1)
+                negative_flat = negative_noise_pred.flatten(1)
 
                 alpha = optimized_scale(positive_flat, negative_flat)
-                alpha = alpha.view(1, 1, 1, 1)
+                alpha = alpha.view(-1, 1, 1, 1, 1)
 
-                if (i <= cfg_zero_steps):
+                if step_index <= cfg_zero_steps:
                     positive_noise_pred = positive_noise_pred * 0.
                 else:
                     negative_noise_pred *= alpha
@@ -319,7 +418,18 @@ class WanVideoPipeline(BasePipeline):
             noise_pred = negative_noise_pred + cfg_scale * (positive_noise_pred - negative_noise_pred)
             return noise_pred
 
-    def predict_noise(self, latents, image_clip_feature, image_y, timestep, context, num_frames, slg_layers = []):
+    def predict_noise(
+        self,
+        latents,
+        image_clip_feature,
+        image_y,
+        timestep,
+        context,
+        num_frames,
+        slg_layers=[],
+        context_lens=None,
+        step_index=None,
+    ):
         latents = latents.to(dtype=self.config.dit_dtype, device=self.device)
 
         return self.dit(
@@ -330,6 +440,8 @@ class WanVideoPipeline(BasePipeline):
             y=image_y,
             slg_layers=slg_layers,
             num_frames=num_frames,
+            context_lens=context_lens,
+            step_index=step_index,
         )
 
     def prepare_latents(
@@ -349,11 +461,16 @@ class WanVideoPipeline(BasePipeline):
             timesteps = timesteps[t_start - 1 :]
 
             noise = latents
-            input_video = self.preprocess_images(input_video)
-            input_video = torch.stack(input_video, dim=2)
-            latents = self.encode_video(input_video, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride).to(
-                dtype=latents.dtype, device=latents.device
-            )
+
+            def encode():
+                videos = torch.stack(self.preprocess_images(input_video), dim=2)
+                return {"latents": self.encode_video(videos, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride)}
+
+            latents = self.encode_condition_with_cache(
+                ["vae"], input_video, encode, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride
+            )["latents"].to(dtype=latents.dtype, device=latents.device)
+            # the input video is encoded once and noised with the noise of each sample
+            latents = latents.expand_as(noise)
             init_latents = latents.clone()
             latents = self.sampler.add_noise(latents, noise, sigma_start)
         else:
@@ -363,14 +480,14 @@ class WanVideoPipeline(BasePipeline):
         return init_latents, latents, sigmas, timesteps
 
     @torch.no_grad()
-    def __call__(
+    def generate_latents(
         self,
-        prompt,
-        negative_prompt="色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走",
+        prompt: str | List[str],
+        negative_prompt: str | List[str] = "色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走",
         input_image=None,
         input_video=None,
         denoising_strength=1.0,
-        seed=None,
+        seed: int | List[int] | None = None,
         height=480,
         width=832,
         num_frames=81,
@@ -383,9 +500,16 @@ class WanVideoPipeline(BasePipeline):
         slg_start=0.0,
         slg_end=1.0,
         progress_callback: Optional[Callable] = None,  # def progress_callback(current, total, status)
-    ):
+        num_videos_per_prompt: int = 1,
+    ) -> Tuple[torch.Tensor, bool]:
+        """
+        Denoises the latents of __call__ and returns them with whether the call generates a batch.
+        """
         assert height % 16 == 0 and width % 16 == 0, "height and width must be divisible by 16"
         assert (num_frames - 1) % 4 == 0, "num_frames must be 4X+1"
+        is_batch = self.is_batch_call(prompt, seed, num_videos_per_prompt)
+        prompts, negative_prompts, seeds = self.prepare_batch(prompt, negative_prompt, seed, num_videos_per_prompt)
+        batch_size = len(prompts)
 
         # Adjust aspect ratio
         if input_image is not None:
@@ -401,7 +525,10 @@ class WanVideoPipeline(BasePipeline):
 
         # Initialize noise
         noise = self.generate_noise(
-            (1, 16, (num_frames - 1) // 4 + 1, height // 8, width // 8), seed=seed, device="cpu", dtype=torch.float32
+            (batch_size, 16, (num_frames - 1) // 4 + 1, height // 8, width // 8),
+            seed=seeds,
+            device="cpu",
+            dtype=torch.float32,
         ).to(self.device)
         init_latents, latents, sigmas, timesteps = self.prepare_latents(
             noise,
@@ -413,15 +540,18 @@ class WanVideoPipeline(BasePipeline):
         )
         self.sampler.initialize(init_latents=init_latents, timesteps=timesteps, sigmas=sigmas)
 
-        # Encode prompts
-        self.load_models_to_device(["text_encoder"])
-        prompt_emb_posi = self.encode_prompt(prompt)
-        prompt_emb_nega = None if cfg_scale <= 1.0 else self.encode_prompt(negative_prompt)
+        # Encode prompts, every distinct prompt is encoded once and the shorter ones are zero padded like the text_len
+        # padding of training
+        unique_prompts, index = self.unique_prompts(prompts if cfg_scale <= 1.0 else prompts + negative_prompts)
+        prompt_emb = self.encode_prompt(unique_prompts)[index.to(self.device)]
+        prompt_emb_posi = prompt_emb[:batch_size]
+        prompt_emb_nega = None if cfg_scale <= 1.0 else prompt_emb[batch_size:]
 
         # Encode image
         if input_image is not None and self.image_encoder is not None:
-            self.load_models_to_device(["image_encoder", "vae"])
             image_clip_feature, image_y = self.encode_image(input_image, num_frames, height, width)
+            image_clip_feature = image_clip_feature.expand(batch_size, -1, -1)
+            image_y = image_y.expand(batch_size, -1, -1, -1, -1)
         else:
             image_clip_feature, image_y = None, None
 
@@ -433,7 +563,7 @@ class WanVideoPipeline(BasePipeline):
                 if int(slg_start * self.num_inference_steps) <= i < int(slg_end * self.num_inference_steps):
                     current_slg_layers = [int(x) for x in slg_layers.split(",")]
 
-            timestep = timestep.unsqueeze(0).to(dtype=self.config.dit_dtype, device=self.device)
+            timestep = timestep.to(dtype=self.config.dit_dtype, device=self.device).expand(batch_size)
             # Classifier-free guidance
             noise_pred = self.predict_noise_with_cfg(
                 latents=latents,
@@ -447,19 +577,107 @@ class WanVideoPipeline(BasePipeline):
                 use_cfg_zero_star=use_cfg_zero_star,
                 slg_layers=current_slg_layers,
                 num_frames=num_frames,
+                step_index=i,
             )
             # Scheduler
             latents = self.sampler.step(latents, noise_pred, i)
             if progress_callback is not None:
                 progress_callback(i + 1, len(timesteps), "DENOISING")
 
+        return latents, is_batch
+
+    @torch.no_grad()
+    def __call__(
+        self,
+        prompt: str | List[str],
+        negative_prompt: str | List[str] = "色调艳丽，过曝，静态，细节模糊不清，字幕，风格，作品，画作，画面，静止，整体发灰，最差质量，低质量，JPEG压缩残留，丑陋的，残缺的，多余的手指，画得不好的手部，画得不好的脸部，畸形的，毁容的，形态畸形的肢体，手指融合，静止不动的画面，杂乱的背景，三条腿，背景人很多，倒着走",
+        input_image=None,
+        input_video=None,
+        denoising_strength=1.0,
+        seed: int | List[int] | None = None,
+        height=480,
+        width=832,
+        num_frames=81,
+        cfg_scale=5.0,
+        tiled=True,
+        tile_size=(34, 34),
+        tile_stride=(18, 16),
+        use_cfg_zero_star=True,
+        slg_layers="",
+        slg_start=0.0,
+        slg_end=1.0,
+        progress_callback: Optional[Callable] = None,  # def progress_callback(current, total, status)
+        num_videos_per_prompt: int = 1,
+    ):
+        """
+        A list of prompts, a list of seeds or `num_videos_per_prompt` > 1 generates a batch in one DiT forward per
+        step and returns a list of videos, see `BasePipeline.prepare_batch`. All videos share the input image or
+        video.
+        """
+        latents, is_batch = self.generate_latents(
+            prompt,
+            negative_prompt,
+            input_image=input_image,
+            input_video=input_video,
+            denoising_strength=denoising_strength,
+            seed=seed,
+            height=height,
+            width=width,
+            num_frames=num_frames,
+            cfg_scale=cfg_scale,
+            tiled=tiled,
+            tile_size=tile_size,
+            tile_stride=tile_stride,
+            use_cfg_zero_star=use_cfg_zero_star,
+            slg_layers=slg_layers,
+            slg_start=slg_start,
+            slg_end=slg_end,
+            progress_callback=progress_callback,
+            num_videos_per_prompt=num_videos_per_prompt,
+        )
+
         # Decode
         self.load_models_to_device(["vae"])
-        frames = self.decode_video(
+        videos = self.decode_video(
             latents, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride, progress_callback=progress_callback
         )
-        frames = self.tensor2video(frames[0])
-        return frames
+        videos = [self.tensor2video(frames) for frames in videos]
+        return videos if is_batch else videos[0]
+
+    @torch.no_grad()
+    def stream(
+        self,
+        prompt: str | List[str],
+        *,
+        tiled=True,
+        tile_size=(34, 34),
+        tile_stride=(18, 16),
+        chunk_size: int = 1,
+        **kwargs,
+    ) -> Iterator[np.ndarray | List[np.ndarray]]:
+        """
+        Generates like __call__ with the same keyword arguments, but yields the frames as soon as the VAE decodes them:
+        [T, H, W, C] uint8 arrays of the first frame and then of 4 * chunk_size frames, a list of them for a batch. The
+        float video is never held on the host, the chunks can be written as they come by `save_video`, for a batch
+        with one `VideoWriter` per video.
+        """
+        latents, is_batch = self.generate_latents(
+            prompt, tiled=tiled, tile_size=tile_size, tile_stride=tile_stride, **kwargs
+        )
+
+        # Decode
+        self.load_models_to_device(["vae"])
+        latents = latents.to(dtype=self.config.vae_dtype, device=self.device)
+        for chunk in self.vae.decode_stream(
+            latents,
+            device=self.device,
+            tiled=tiled,
+            tile_size=tile_size,
+            tile_stride=tile_stride,
+            chunk_size=chunk_size,
+        ):
+            frames = [self.tensor2frames(video) for video in chunk]
+            yield frames if is_batch else frames[0]
 
     @classmethod
     def from_pretrained(
@@ -481,6 +699,9 @@ class WanVideoPipeline(BasePipeline):
             model_config = WanModelConfig(model_path=model_path_or_config)
         else:
             model_config = model_path_or_config
+        cls.validate_int8_mode(model_config.t5_int8)
+        if model_config.dit_gguf_quant is not None and parallelism > 1:
+            raise ValueError("dit_gguf_quant is not supported with parallelism > 1")
 
         logger.info(f"Loading state dict from {model_config.model_path} ...")
         dit_state_dict = cls.load_model_checkpoint(model_config.model_path, device="cpu", dtype=model_config.dit_dtype)
@@ -493,7 +714,17 @@ class WanVideoPipeline(BasePipeline):
 
         init_device = "cpu" if offload_mode else device
         tokenizer = WanT5Tokenizer(WAN_TOKENIZER_CONF_PATH, seq_len=512, clean="whitespace")
-        text_encoder = WanTextEncoder.from_state_dict(t5_state_dict, device=init_device, dtype=model_config.t5_dtype)
+        if model_config.t5_gguf_quant is not None:
+            # quantize on cpu, so that only quantized weights are moved to the device
+            text_encoder = WanTextEncoder.from_state_dict(t5_state_dict, device="cpu", dtype=model_config.t5_dtype)
+            enable_gguf_linear(text_encoder, model_config.t5_gguf_quant)
+            text_encoder.to(init_device)
+        else:
+            text_encoder = WanTextEncoder.from_state_dict(
+                t5_state_dict, device=init_device, dtype=model_config.t5_dtype
+            )
+        if model_config.t5_int8 is not None:
+            enable_int8_linear(text_encoder, dynamic=model_config.t5_int8 == "dynamic")
 
         vae = WanVideoVAE.from_state_dict(vae_state_dict, device=init_device, dtype=model_config.vae_dtype)
 
@@ -550,12 +781,14 @@ class WanVideoPipeline(BasePipeline):
                 dit = WanDiT.from_state_dict(
                     dit_state_dict,
                     model_type=model_type,
-                    device=init_device,
+                    device="cpu" if model_config.dit_gguf_quant is not None else init_device,
                     dtype=model_config.dit_dtype,
                     num_inference_steps=num_inference_steps,
                     teacache_thresh=teacache_thresh,
                 )
-                # dit = torch.compile(dit)  # -20s
+            if model_config.dit_gguf_quant is not None:
+                enable_gguf_linear(dit, model_config.dit_gguf_quant)
+                dit.to(init_device)
 
         pipe = cls(
             config=model_config,
@@ -571,8 +804,17 @@ class WanVideoPipeline(BasePipeline):
             shift=shift,
         )
         pipe.eval()
+        dit_fp8_linear = model_config.dit_fp8_linear
+        if dit_fp8_linear is None:
+            # without fp8 matmul every linear dequantizes its weight, which is slower than bf16
+            dit_fp8_linear = _scaled_mm_support(torch.device(device))[0]
+            if not dit_fp8_linear:
+                logger.info(f"no fp8 matmul on {device}, keep DiT linear layers in {model_config.dit_dtype}")
+        if dit_fp8_linear and parallelism == 1:
+            pipe.enable_fp8_linear()
         if offload_mode == "cpu_offload":
             pipe.enable_cpu_offload()
         elif offload_mode == "sequential_cpu_offload":
             pipe.enable_sequential_cpu_offload()
         return pipe
+
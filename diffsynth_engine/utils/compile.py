@@ -0,0 +1,49 @@
+import os
+import torch
+import torch.nn as nn
+from typing import Iterable
+
+from diffsynth_engine.models.basic.attention import list_attention_backends
+from diffsynth_engine.utils import logging
+
+logger = logging.get_logger(__name__)
+
+# compiled graphs of a block class kept per resolution bucket, the first graph of a shape often needs a recompile
+# once parameters are seen as inputs
+COMPILE_CACHE_SIZE_PER_BUCKET = 4
+
+
+def set_compile_cache_dir(cache_dir: str):
+    """
+    Persists inductor, triton and AOTAutograd artifacts of compiled graphs in `cache_dir`, so that a restarted process
+    only traces the blocks again instead of generating and autotuning kernels.
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    torch._inductor.config.fx_graph_cache = True
+    torch._functorch.config.enable_autograd_cache = True
+    logger.info(f"compile cache dir: {cache_dir}")
+
+
+def set_compile_cache_size(num_buckets: int):
+    # every resolution bucket compiles its own static graphs of the same block code
+    cache_size_limit = COMPILE_CACHE_SIZE_PER_BUCKET * max(num_buckets, 1)
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, cache_size_limit)
+
+
+def compile_blocks(blocks: Iterable[nn.Module], **compile_kwargs):
+    """
+    Compiles each block in place with `nn.Module.compile`, so that state dict keys, LoRA patching and offloading keep
+    working on the original modules. Blocks of the same class share compiled graphs, while the Python control flow
+    around them (TeaCache, CFG, sampling) stays eager. Shapes are static by default, a new resolution compiles once.
+    """
+    compile_kwargs.setdefault("dynamic", False)
+    # check the optional attention kernels eagerly, compiled blocks then read the availability as constants
+    list_attention_backends(available_only=True)
+    for block in blocks:
+        # blocks without parameters like the UNet skip connection pushes are not worth a graph
+        if next(block.parameters(), None) is None:
+            continue
+        block.compile(**compile_kwargs)
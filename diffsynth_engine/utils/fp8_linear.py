@@ -1,78 +1,259 @@
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
 
+from diffsynth_engine.models.basic.lora import LoRA, LoRALinear
 
-def enable_fp8_linear(module: nn.Module):
-    _enable_fp8_linear(module)
-    setattr(module, "fp8_linear_enabled", True)
+FP8_DTYPE = torch.float8_e4m3fn
+FP8_MAX = torch.finfo(FP8_DTYPE).max
+# avoid zero scales of all zero channels / tokens
+FP8_MIN_SCALE = 1.0 / (FP8_MAX * 512.0)
+
+
+def quantize_fp8(weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantizes a [out, in] weight to float8_e4m3fn with per output channel scales.
+    Returns the fp8 weight and the [out, 1] float32 scale, weight ≈ fp8_weight * scale.
+    """
+    weight = weight.float()
+    scale = (weight.abs().amax(dim=1, keepdim=True) / FP8_MAX).clamp(min=FP8_MIN_SCALE)
+    weight = (weight / scale).clamp(-FP8_MAX, FP8_MAX).to(FP8_DTYPE)
+    return weight, scale
+
+
+def dequantize_fp8(weight: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    return (weight.float() * scale).to(dtype)
+
+
+def quantize_fp8_activation(
+    x: torch.Tensor, input_scale: Optional[torch.Tensor] = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantizes a [M, K] activation with a per token scale ([M, 1]) computed on the fly, or with a calibrated per tensor
+    `input_scale`.
+    """
+    if input_scale is None:
+        x_scale = (x.abs().amax(dim=-1, keepdim=True).float() / FP8_MAX).clamp(min=FP8_MIN_SCALE)
+    else:
+        x_scale = input_scale
+    x = (x.float() / x_scale).clamp(-FP8_MAX, FP8_MAX).to(FP8_DTYPE)
+    return x, x_scale
+
+
+@functools.lru_cache(maxsize=None)
+def _scaled_mm_support(device: torch.device) -> Tuple[bool, bool]:
+    # (tensorwise, rowwise) scaling support of torch._scaled_mm
+    if device.type != "cuda" or not hasattr(torch, "_scaled_mm"):
+        return False, False
+    capability = torch.cuda.get_device_capability(device)
+    return capability >= (8, 9), capability >= (9, 0)
+
+
+_unit_scales: Dict[torch.device, torch.Tensor] = {}
+
+
+def _unit_scale(device: torch.device) -> torch.Tensor:
+    if device not in _unit_scales:
+        _unit_scales[device] = torch.ones((), dtype=torch.float32, device=device)
+    return _unit_scales[device]
+
+
+def _unwrap_scaled_mm(result) -> torch.Tensor:
+    # old versions of torch return (result, amax)
+    return result[0] if isinstance(result, tuple) else result
+
+
+def fp8_linear_reference(
+    input: torch.Tensor,
+    weight: torch.Tensor,
+    weight_scale: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    input_scale: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Dequantizes weight and activation and computes in the input dtype, used on devices without fp8 matmul and as the
+    reference of the fp8 kernels.
+    """
+    x, x_scale = quantize_fp8_activation(input.reshape(-1, input.shape[-1]), input_scale)
+    x = (x.float() * x_scale).to(input.dtype)
+    bias = bias.to(input.dtype) if bias is not None else None
+    result = F.linear(x, dequantize_fp8(weight, weight_scale, input.dtype), bias)
+    return result.reshape(*input.shape[:-1], -1)
 
 
-def _enable_fp8_linear(module: nn.Module):
-    if isinstance(module, nn.Linear) and torch.is_floating_point(module.weight.data):
-        # avoid conversion for int weights like GGUF
-        module.weight.data = module.weight.data.to(torch.float8_e4m3fn)
-    for submodule in module.children():
-        _enable_fp8_linear(submodule)
+def fp8_linear(
+    input: torch.Tensor,
+    weight: torch.Tensor,
+    weight_scale: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    input_scale: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    input:          [..., in].
+    weight:         [out, in] float8_e4m3fn.
+    weight_scale:   [out, 1] float32 per output channel scale.
+    input_scale:    calibrated per tensor activation scale, activations are scaled per token if None.
+    """
+    tensorwise, rowwise = _scaled_mm_support(input.device)
+    out_features, in_features = weight.shape
+    if not tensorwise or in_features % 16 != 0 or out_features % 16 != 0:
+        return fp8_linear_reference(input, weight, weight_scale, bias, input_scale)
+
+    origin_shape, origin_dtype = input.shape, input.dtype
+    x, x_scale = quantize_fp8_activation(input.reshape(-1, in_features), input_scale)
+    if rowwise and input_scale is None and origin_dtype == torch.bfloat16:
+        result = _unwrap_scaled_mm(
+            torch._scaled_mm(x, weight.T, scale_a=x_scale, scale_b=weight_scale.T, bias=bias, out_dtype=origin_dtype)
+        )
+    else:
+        unit_scale = _unit_scale(input.device)
+        result = _unwrap_scaled_mm(
+            torch._scaled_mm(x, weight.T, scale_a=unit_scale, scale_b=unit_scale, out_dtype=torch.float32)
+        )
+        result = result * x_scale * weight_scale.T
+        if bias is not None:
+            result = result + bias
+        result = result.to(origin_dtype)
+    return result.reshape(*origin_shape[:-1], out_features)
+
+
+class FP8Linear(LoRALinear):
+    """
+    Linear with float8_e4m3fn weight and per output channel float32 scales. Activations are quantized per token on the
+    fly, or with the per tensor `input_scale` once it is calibrated by `fp8_calibration`. Scales are buffers so that
+    they are saved and loaded with the model.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bias: bool = True,
+        device=None,
+        dtype=None,
+    ) -> None:
+        super().__init__(in_features, out_features, bias, device, dtype)
+        self.compute_dtype = self.weight.dtype
+        self.weight.data = self.weight.data.to(FP8_DTYPE)
+        self.register_buffer("weight_scale", torch.ones(out_features, 1, device=device, dtype=torch.float32))
+        self.register_buffer("input_scale", None)
+        self.register_buffer("_original_weight_scale", None)
+
+    @staticmethod
+    def from_linear(linear: nn.Linear):
+        fp8_linear = torch.nn.utils.skip_init(
+            FP8Linear,
+            linear.in_features,
+            linear.out_features,
+            linear.bias is not None,
+            device=linear.weight.device,
+            dtype=linear.weight.dtype,
+        )
+        weight, weight_scale = quantize_fp8(linear.weight.data)
+        fp8_linear.weight = nn.Parameter(weight, requires_grad=False)
+        fp8_linear.weight_scale = weight_scale
+        fp8_linear.bias = linear.bias
+        if isinstance(linear, LoRALinear):
+            fp8_linear._lora_dict = linear._lora_dict
+        return fp8_linear
+
+    def add_frozen_lora(
+        self,
+        name: str,
+        scale: float,
+        rank: int,
+        alpha: int,
+        up: torch.Tensor,
+        down: torch.Tensor,
+        device: str,
+        dtype: torch.dtype,
+        save_original_weight: bool = True,
+    ):
+        # fp8 weights cannot be patched in place, patch the dequantized weight and quantize it again
+        if save_original_weight and self._original_weight is None:
+            self._original_weight = self.weight.data.clone()
+            self._original_weight_scale = self.weight_scale.clone()
+        weight = dequantize_fp8(self.weight.data, self.weight_scale)
+        lora = LoRA(scale, rank, alpha, up, down, device, dtype)
+        lora.apply_to(weight)
+        self.weight.data, self.weight_scale = quantize_fp8(weight)
+        self._frozen_lora_list.append(lora)
+
+    def clear(self):
+        original_weight_scale = self._original_weight_scale
+        super().clear()
+        if original_weight_scale is not None:
+            self.weight_scale = original_weight_scale
+            self._original_weight_scale = None
+
+    def _apply(self, fn, recurse=True):
+        weight = self.weight.data
+        buffers = {
+            name: getattr(self, name)
+            for name in ("weight_scale", "input_scale", "_original_weight", "_original_weight_scale")
+        }
+        super()._apply(fn, recurse)
+        # dtype conversions like model.to(torch.bfloat16) only change the compute dtype
+        if self.weight.dtype != FP8_DTYPE:
+            self.compute_dtype = self.weight.dtype
+            device = self.weight.device
+            self.weight.data = weight.to(device)
+            for name, buffer in buffers.items():
+                setattr(self, name, buffer.to(device) if buffer is not None else None)
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        weight = state_dict.get(prefix + "weight")
+        if weight is not None and weight.dtype != FP8_DTYPE and torch.is_floating_point(weight):
+            # float checkpoint, quantize on load
+            state_dict[prefix + "weight"], state_dict[prefix + "weight_scale"] = quantize_fp8(weight)
+        if prefix + "input_scale" in state_dict and self.input_scale is None:
+            self.input_scale = torch.empty((), dtype=torch.float32, device=self.weight.device)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x):
+        w_x = fp8_linear(x, self.weight, self.weight_scale, self.bias, self.input_scale)
+        for name, lora in self._lora_dict.items():
+            w_x += lora(x)
+        return w_x
+
+
+def enable_fp8_linear(module: nn.Module):
+    """
+    Replaces the float linear layers of `module` with FP8Linear layers holding per channel scaled fp8 weights.
+    """
+    for name, child in module.named_children():
+        if (
+            isinstance(child, nn.Linear)
+            and not isinstance(child, FP8Linear)
+            and torch.is_floating_point(child.weight.data)  # avoid conversion for int weights like GGUF
+        ):
+            setattr(module, name, FP8Linear.from_linear(child))
+        else:
+            enable_fp8_linear(child)
 
 
 @contextmanager
-def fp8_inference(enabled=True):
-    if not enabled:
+def fp8_calibration(module: nn.Module):
+    """
+    Records the max abs input of every FP8Linear in `module` during the forwards run inside the context, and sets
+    their per tensor `input_scale` for static activation quantization on exit.
+    """
+    input_amax = {}
+
+    def record_input_amax(layer, args):
+        amax = args[0].detach().abs().amax().float()
+        input_amax[layer] = torch.maximum(input_amax[layer], amax) if layer in input_amax else amax
+
+    layers = [layer for layer in module.modules() if isinstance(layer, FP8Linear)]
+    handles = [layer.register_forward_pre_hook(record_input_amax) for layer in layers]
+    try:
         yield
-        return
-
-    origin_linear = F.linear
-
-    def fp8_linear(
-        input: torch.Tensor,
-        weight: torch.Tensor,
-        bias: torch.Tensor | None = None,
-    ) -> torch.Tensor:
-        device = input.device
-        origin_dtype = input.dtype
-        input = input.to(torch.float8_e4m3fn)
-        weight = weight.to(torch.float8_e4m3fn)
-
-        if len(input.shape) > 2:
-            origin_shape = input.shape
-            input = input.reshape(-1, origin_shape[-1])
-            scaled_mm_result = torch._scaled_mm(
-                input,
-                weight.T,
-                scale_a=torch.tensor(1.0).to(device=device),
-                scale_b=torch.tensor(1.0).to(device=device),
-                bias=bias,
-                out_dtype=origin_dtype,
-            )
-
-            # Extract the actual tensor from the tuple
-            if isinstance(scaled_mm_result, tuple):
-                result = scaled_mm_result[0]
-            else:
-                result = scaled_mm_result
-
-            new_shape = origin_shape[:-1] + result.shape[-1:]
-            result = result.reshape(new_shape)
-        else:
-            scaled_mm_result = torch._scaled_mm(
-                input,
-                weight.T,
-                scale_a=torch.tensor(1.0).to(device=device),
-                scale_b=torch.tensor(1.0).to(device=device),
-                bias=bias,
-                out_dtype=origin_dtype,
-            )
-
-            # Extract the actual tensor from the tuple
-            if isinstance(scaled_mm_result, tuple):
-                result = scaled_mm_result[0]
-            else:
-                result = scaled_mm_result
-
-        return result
-
-    F.linear = fp8_linear
-    yield
-    F.linear = origin_linear
+    finally:
+        for handle in handles:
+            handle.remove()
+        for layer, amax in input_amax.items():
+            layer.input_scale = (amax / FP8_MAX).clamp(min=FP8_MIN_SCALE).to(layer.weight.device)
@@ -1,9 +1,17 @@
 # modified from diffusers.quantizers.gguf
+import fnmatch
+import itertools
+import threading
+import weakref
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import gguf
-from gguf import GGUFReader
-from contextlib import contextmanager
+from collections import OrderedDict
+from gguf import GGUFReader, GGUFWriter
+from typing import Dict, Optional
+
+from diffsynth_engine.models.basic.lora import LoRALinear
 
 
 class GGUFParameter(torch.nn.Parameter):
@@ -59,35 +67,177 @@ class GGUFParameter(torch.nn.Parameter):
             return result
 
 
-@contextmanager
-def gguf_inference():
-    origin_embedding = F.embedding
-    origin_linear = F.linear
-
-    def gguf_embedding(
-        input: torch.Tensor,
-        weight: torch.Tensor,
-        *args,
-        **kwargs,
-    ) -> torch.Tensor:
-        if isinstance(weight, GGUFParameter):
-            weight = dequantize(weight)
-        return origin_embedding(input, weight, *args, **kwargs)
-
-    def gguf_linear(
-        input: torch.Tensor,
-        weight: torch.Tensor,
-        bias: torch.Tensor | None = None,
-    ) -> torch.Tensor:
-        if isinstance(weight, GGUFParameter):
-            weight = dequantize(weight)
-        return origin_linear(input, weight, bias)
-
-    F.embedding = gguf_embedding
-    F.linear = gguf_linear
-    yield
-    F.embedding = origin_embedding
-    F.linear = origin_linear
+class GGUFDequantCache:
+    """
+    Cache of dequantized GGUF weights bounded by `max_bytes`, weights are dequantized on every call when the budget
+    is 0. Weights are admitted while they fit into the budget and then stay, the others are dequantized on demand.
+    A model runs its layers in the same order every step, an LRU would evict every weight before its next use once
+    the model is larger than the budget, while pinned entries give hits in proportion to the budget. Entries are
+    only dropped when the budget shrinks, when their weight is moved or freed, or on `clear`.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._tokens = itertools.count()
+        # reentrant, the garbage collector may free a weight and discard its entries while the lock is held
+        self._lock = threading.RLock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _token(self, weight: "GGUFParameter") -> int:
+        # a token that is never reused, unlike the id and the address of a freed weight
+        token = getattr(weight, "_dequant_cache_token", None)
+        if token is None:
+            token = weight._dequant_cache_token = next(self._tokens)
+            weakref.finalize(weight, self._discard_token, token)
+        return token
+
+    def _key(self, weight: "GGUFParameter"):
+        # the storage changes when the weight is moved to another device
+        return self._token(weight), weight.device, weight.data_ptr(), weight.compute_dtype
+
+    def get(self, weight: "GGUFParameter") -> torch.Tensor:
+        if self.max_bytes <= 0:
+            return dequantize(weight)
+        with self._lock:
+            key = self._key(weight)
+            if key in self._cache:
+                self.hits += 1
+                return self._cache[key]
+            self.misses += 1
+        dequant = dequantize(weight)
+        num_bytes = dequant.numel() * dequant.element_size()
+        with self._lock:
+            if key not in self._cache and self.num_bytes + num_bytes <= self.max_bytes:
+                self._cache[key] = dequant
+                self.num_bytes += num_bytes
+        return dequant
+
+    def _evict(self, max_bytes: int):
+        while self.num_bytes > max_bytes and len(self._cache) > 0:
+            _, dequant = self._cache.popitem(last=False)
+            self.num_bytes -= dequant.numel() * dequant.element_size()
+            self.evictions += 1
+
+    def discard(self, weight: "GGUFParameter"):
+        token = getattr(weight, "_dequant_cache_token", None)
+        if token is not None:
+            self._discard_token(token)
+
+    def _discard_token(self, token: int):
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == token]:
+                dequant = self._cache.pop(key)
+                self.num_bytes -= dequant.numel() * dequant.element_size()
+
+    def resize(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict(max(max_bytes, 0))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.num_bytes = 0
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "num_bytes": self.num_bytes,
+                "num_weights": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+gguf_dequant_cache = GGUFDequantCache()
+
+
+def set_gguf_dequant_cache_budget(num_bytes: int):
+    """
+    Sets the max bytes of dequantized GGUF weights kept for reuse, 0 disables the cache.
+    """
+    if num_bytes < 0:
+        raise ValueError(f"gguf dequant cache budget must not be negative, but got {num_bytes}")
+    gguf_dequant_cache.resize(num_bytes)
+    if num_bytes == 0:
+        gguf_dequant_cache.clear()
+
+
+def get_gguf_dequant_cache_stats() -> Dict[str, int]:
+    return gguf_dequant_cache.stats()
+
+
+class GGUFLinear(LoRALinear):
+    """
+    Linear holding a GGUFParameter weight, which is dequantized to its compute dtype on every forward.
+    """
+
+    @staticmethod
+    def from_linear(linear: nn.Linear):
+        gguf_linear = torch.nn.utils.skip_init(
+            GGUFLinear,
+            linear.in_features,
+            linear.out_features,
+            linear.bias is not None,
+            device="meta",
+        )
+        gguf_linear.weight = linear.weight
+        gguf_linear.bias = linear.bias
+        if isinstance(linear, LoRALinear):
+            gguf_linear._lora_dict = linear._lora_dict
+        return gguf_linear
+
+    def add_frozen_lora(self, name: str, scale: float, rank: int, alpha: int, up, down, device, dtype, **kwargs):
+        # quantized weights cannot be patched in place, keep the LoRA unfused
+        self.add_lora(name, scale, rank, alpha, up, down, device, dtype)
+
+    def _apply(self, fn, recurse=True):
+        # dequantized weights on the old device are no longer used
+        if isinstance(self.weight, GGUFParameter):
+            gguf_dequant_cache.discard(self.weight)
+        return super()._apply(fn, recurse)
+
+    def forward(self, x):
+        weight = gguf_dequant_cache.get(self.weight) if isinstance(self.weight, GGUFParameter) else self.weight
+        w_x = F.linear(x, weight, self.bias)
+        for name, lora in self._lora_dict.items():
+            w_x += lora(x)
+        return w_x
+
+
+class GGUFEmbedding(nn.Embedding):
+    """
+    Embedding holding a GGUFParameter weight, only the looked up rows are dequantized.
+    """
+
+    @staticmethod
+    def from_embedding(embedding: nn.Embedding):
+        gguf_embedding = torch.nn.utils.skip_init(
+            GGUFEmbedding,
+            embedding.num_embeddings,
+            embedding.embedding_dim,
+            embedding.padding_idx,
+            device="meta",
+        )
+        gguf_embedding.weight = embedding.weight
+        return gguf_embedding
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        if isinstance(self.weight, GGUFParameter):
+            # quantized blocks of a row never cross rows
+            rows = self.weight.as_tensor()[input]
+            return dequantize(rows, self.weight.quant_dtype, self.weight.compute_dtype)
+        return super().forward(input)
 
 
 TORCH_COMPATIBLE_QTYPES = {gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16}
@@ -110,6 +260,10 @@ def _dequant_shape(tensor: torch.Tensor, quant_dtype=None):
     return shape
 
 
+# number of values dequantized at a time on cpu, intermediates of a chunk stay in cache and are reused by the allocator
+DEQUANT_CHUNK_SIZE = 1 << 18
+
+
 def dequantize(tensor: torch.Tensor, quant_dtype=None, compute_dtype=None) -> torch.Tensor:
     if isinstance(tensor, GGUFParameter):
         quant_dtype = tensor.quant_dtype
@@ -129,7 +283,11 @@ def dequantize(tensor: torch.Tensor, quant_dtype=None, compute_dtype=None) -> to
     n_blocks = tensor.numel() // type_size
     blocks = tensor.reshape((n_blocks, type_size))
 
-    dequant = dequant_fn(blocks, block_size, type_size, compute_dtype)
+    # compute in float32 like the gguf reference and cast once into the output
+    dequant = torch.empty((n_blocks, block_size), dtype=compute_dtype or torch.float32, device=tensor.device)
+    chunk_size = max(DEQUANT_CHUNK_SIZE // block_size, 1) if tensor.device.type == "cpu" else max(n_blocks, 1)
+    for i in range(0, n_blocks, chunk_size):
+        dequant[i : i + chunk_size] = dequant_fn(blocks[i : i + chunk_size], block_size, type_size, torch.float32)
     dequant = dequant.reshape(shape)
 
     return dequant
@@ -138,15 +296,17 @@ def dequantize(tensor: torch.Tensor, quant_dtype=None, compute_dtype=None) -> to
 # dequantize operations based on torch ports of GGUF dequantize_functions
 # from City96
 # more info: https://github.com/city96/ComfyUI-GGUF/blob/main/dequant.py
+# shifts are unrolled into scalar shifts and arithmetic is in place, which avoids the slow broadcast shifts and
+# most of the intermediate allocations
 
 
 QK_K = 256
 K_SCALE_SIZE = 12
 
 
-def to_uint32(x):
-    x = x.view(torch.uint8).to(torch.int32)
-    return (x[:, 0] | x[:, 1] << 8 | x[:, 2] << 16 | x[:, 3] << 24).unsqueeze(1)
+def to_float(x, dtype):
+    # fp16 scale bytes to [n_blocks, 1]
+    return x.contiguous().view(torch.float16).to(dtype)
 
 
 def split_block_dims(blocks, *args):
@@ -155,90 +315,83 @@ def split_block_dims(blocks, *args):
     return torch.split(blocks, dims, dim=1)
 
 
+def unpack_nibbles(qs, dim):
+    # low nibbles before high nibbles along `dim`
+    return torch.stack([qs & 0x0F, qs >> 4], dim=dim)
+
+
+def unpack_bits(qs, bits, dim):
+    # groups of `bits` bits from low to high along `dim`
+    mask = (1 << bits) - 1
+    return torch.stack([(qs >> shift) & mask for shift in range(0, 8, bits)], dim=dim)
+
+
 def get_scale_min(scales):
     n_blocks = scales.shape[0]
     scales = scales.view(torch.uint8)
     scales = scales.reshape((n_blocks, 3, 4))
 
-    d, m, m_d = torch.split(scales, scales.shape[-2] // 3, dim=-2)
+    d, m, m_d = scales[:, 0], scales[:, 1], scales[:, 2]
 
     sc = torch.cat([d & 0x3F, (m_d & 0x0F) | ((d >> 2) & 0x30)], dim=-1)
     min = torch.cat([m & 0x3F, (m_d >> 4) | ((m >> 2) & 0x30)], dim=-1)
 
-    return (sc.reshape((n_blocks, 8)), min.reshape((n_blocks, 8)))
+    return (sc, min)
 
 
 def dequantize_blocks_Q8_0(blocks, block_size, type_size, dtype=None):
     d, x = split_block_dims(blocks, 2)
-    d = d.view(torch.float16).to(dtype)
-    x = x.view(torch.int8)
-    return d * x
+    d = to_float(d, dtype)
+    x = x.view(torch.int8).to(dtype)
+    return x.mul_(d)
 
 
 def dequantize_blocks_Q5_1(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     d, m, qh, qs = split_block_dims(blocks, 2, 2, 4)
-    d = d.view(torch.float16).to(dtype)
-    m = m.view(torch.float16).to(dtype)
-    qh = to_uint32(qh)
+    d = to_float(d, dtype)
+    m = to_float(m, dtype)
 
-    qh = qh.reshape((n_blocks, 1)) >> torch.arange(32, device=d.device, dtype=torch.int32).reshape(1, 32)
-    ql = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor(
-        [0, 4], device=d.device, dtype=torch.uint8
-    ).reshape(1, 1, 2, 1)
-    qh = (qh & 1).to(torch.uint8)
-    ql = (ql & 0x0F).reshape((n_blocks, -1))
+    qh = unpack_bits(qh, 1, dim=-1).reshape((n_blocks, block_size))
+    ql = unpack_nibbles(qs, dim=1).reshape((n_blocks, block_size))
 
-    qs = ql | (qh << 4)
-    return (d * qs) + m
+    qs = (ql | (qh << 4)).to(dtype)
+    return qs.mul_(d).add_(m)
 
 
 def dequantize_blocks_Q5_0(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     d, qh, qs = split_block_dims(blocks, 2, 4)
-    d = d.view(torch.float16).to(dtype)
-    qh = to_uint32(qh)
+    d = to_float(d, dtype)
 
-    qh = qh.reshape(n_blocks, 1) >> torch.arange(32, device=d.device, dtype=torch.int32).reshape(1, 32)
-    ql = qs.reshape(n_blocks, -1, 1, block_size // 2) >> torch.tensor(
-        [0, 4], device=d.device, dtype=torch.uint8
-    ).reshape(1, 1, 2, 1)
+    qh = unpack_bits(qh, 1, dim=-1).reshape((n_blocks, block_size))
+    ql = unpack_nibbles(qs, dim=1).reshape((n_blocks, block_size))
 
-    qh = (qh & 1).to(torch.uint8)
-    ql = (ql & 0x0F).reshape(n_blocks, -1)
-
-    qs = (ql | (qh << 4)).to(torch.int8) - 16
-    return d * qs
+    qs = (ql | (qh << 4)).to(dtype).sub_(16)
+    return qs.mul_(d)
 
 
 def dequantize_blocks_Q4_1(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     d, m, qs = split_block_dims(blocks, 2, 2)
-    d = d.view(torch.float16).to(dtype)
-    m = m.view(torch.float16).to(dtype)
-
-    qs = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor(
-        [0, 4], device=d.device, dtype=torch.uint8
-    ).reshape(1, 1, 2, 1)
-    qs = (qs & 0x0F).reshape(n_blocks, -1)
+    d = to_float(d, dtype)
+    m = to_float(m, dtype)
 
-    return (d * qs) + m
+    qs = unpack_nibbles(qs, dim=1).reshape((n_blocks, block_size)).to(dtype)
+    return qs.mul_(d).add_(m)
 
 
 def dequantize_blocks_Q4_0(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     d, qs = split_block_dims(blocks, 2)
-    d = d.view(torch.float16).to(dtype)
+    d = to_float(d, dtype)
 
-    qs = qs.reshape((n_blocks, -1, 1, block_size // 2)) >> torch.tensor(
-        [0, 4], device=d.device, dtype=torch.uint8
-    ).reshape((1, 1, 2, 1))
-    qs = (qs & 0x0F).reshape((n_blocks, -1)).to(torch.int8) - 8
-    return d * qs
+    qs = unpack_nibbles(qs, dim=1).reshape((n_blocks, block_size)).to(dtype).sub_(8)
+    return qs.mul_(d)
 
 
 def dequantize_blocks_Q6_K(blocks, block_size, type_size, dtype=None):
@@ -252,21 +405,15 @@ def dequantize_blocks_Q6_K(blocks, block_size, type_size, dtype=None):
     ) = split_block_dims(blocks, QK_K // 2, QK_K // 4, QK_K // 16)
 
     scales = scales.view(torch.int8).to(dtype)
-    d = d.view(torch.float16).to(dtype)
+    d = to_float(d, dtype)
     d = (d * scales).reshape((n_blocks, QK_K // 16, 1))
 
-    ql = ql.reshape((n_blocks, -1, 1, 64)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 2, 1)
-    )
-    ql = (ql & 0x0F).reshape((n_blocks, -1, 32))
-    qh = qh.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 4, 1)
-    )
-    qh = (qh & 0x03).reshape((n_blocks, -1, 32))
-    q = (ql | (qh << 4)).to(torch.int8) - 32
+    ql = unpack_nibbles(ql.reshape((n_blocks, 2, 64)), dim=2).reshape((n_blocks, QK_K))
+    qh = unpack_bits(qh.reshape((n_blocks, 2, 32)), 2, dim=2).reshape((n_blocks, QK_K))
+    q = (ql | (qh << 4)).to(dtype).sub_(32)
     q = q.reshape((n_blocks, QK_K // 16, -1))
 
-    return (d * q).reshape((n_blocks, QK_K))
+    return q.mul_(d).reshape((n_blocks, QK_K))
 
 
 def dequantize_blocks_Q5_K(blocks, block_size, type_size, dtype=None):
@@ -274,96 +421,70 @@ def dequantize_blocks_Q5_K(blocks, block_size, type_size, dtype=None):
 
     d, dmin, scales, qh, qs = split_block_dims(blocks, 2, 2, K_SCALE_SIZE, QK_K // 8)
 
-    d = d.view(torch.float16).to(dtype)
-    dmin = dmin.view(torch.float16).to(dtype)
+    d = to_float(d, dtype)
+    dmin = to_float(dmin, dtype)
 
     sc, m = get_scale_min(scales)
 
     d = (d * sc).reshape((n_blocks, -1, 1))
     dm = (dmin * m).reshape((n_blocks, -1, 1))
 
-    ql = qs.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 2, 1)
-    )
-    qh = qh.reshape((n_blocks, -1, 1, 32)) >> torch.arange(0, 8, device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 8, 1)
-    )
-    ql = (ql & 0x0F).reshape((n_blocks, -1, 32))
-    qh = (qh & 0x01).reshape((n_blocks, -1, 32))
-    q = ql | (qh << 4)
+    ql = unpack_nibbles(qs.reshape((n_blocks, 4, 32)), dim=2).reshape((n_blocks, 8, 32))
+    qh = unpack_bits(qh, 1, dim=1)
+    q = (ql | (qh << 4)).to(dtype)
 
-    return (d * q - dm).reshape((n_blocks, QK_K))
+    return q.mul_(d).sub_(dm).reshape((n_blocks, QK_K))
 
 
 def dequantize_blocks_Q4_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     d, dmin, scales, qs = split_block_dims(blocks, 2, 2, K_SCALE_SIZE)
-    d = d.view(torch.float16).to(dtype)
-    dmin = dmin.view(torch.float16).to(dtype)
+    d = to_float(d, dtype)
+    dmin = to_float(dmin, dtype)
 
     sc, m = get_scale_min(scales)
 
     d = (d * sc).reshape((n_blocks, -1, 1))
     dm = (dmin * m).reshape((n_blocks, -1, 1))
 
-    qs = qs.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 2, 1)
-    )
-    qs = (qs & 0x0F).reshape((n_blocks, -1, 32))
+    qs = unpack_nibbles(qs.reshape((n_blocks, 4, 32)), dim=2).reshape((n_blocks, 8, 32)).to(dtype)
 
-    return (d * qs - dm).reshape((n_blocks, QK_K))
+    return qs.mul_(d).sub_(dm).reshape((n_blocks, QK_K))
 
 
 def dequantize_blocks_Q3_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     hmask, qs, scales, d = split_block_dims(blocks, QK_K // 8, QK_K // 4, 12)
-    d = d.view(torch.float16).to(dtype)
+    d = to_float(d, dtype)
 
-    lscales, hscales = scales[:, :8], scales[:, 8:]
-    lscales = lscales.reshape((n_blocks, 1, 8)) >> torch.tensor([0, 4], device=d.device, dtype=torch.uint8).reshape(
-        (1, 2, 1)
-    )
-    lscales = lscales.reshape((n_blocks, 16))
-    hscales = hscales.reshape((n_blocks, 1, 4)) >> torch.tensor(
-        [0, 2, 4, 6], device=d.device, dtype=torch.uint8
-    ).reshape((1, 4, 1))
-    hscales = hscales.reshape((n_blocks, 16))
-    scales = (lscales & 0x0F) | ((hscales & 0x03) << 4)
-    scales = scales.to(torch.int8) - 32
+    lscales = unpack_nibbles(scales[:, :8], dim=1).reshape((n_blocks, 16))
+    hscales = unpack_bits(scales[:, 8:], 2, dim=1).reshape((n_blocks, 16))
+    scales = (lscales | (hscales << 4)).to(dtype).sub_(32)
 
     dl = (d * scales).reshape((n_blocks, 16, 1))
 
-    ql = qs.reshape((n_blocks, -1, 1, 32)) >> torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 4, 1)
-    )
-    qh = hmask.reshape(n_blocks, -1, 1, 32) >> torch.arange(0, 8, device=d.device, dtype=torch.uint8).reshape(
-        (1, 1, 8, 1)
-    )
-    ql = ql.reshape((n_blocks, 16, QK_K // 16)) & 3
-    qh = (qh.reshape((n_blocks, 16, QK_K // 16)) & 1) ^ 1
-    q = ql.to(torch.int8) - (qh << 2).to(torch.int8)
+    ql = unpack_bits(qs.reshape((n_blocks, 2, 32)), 2, dim=2).reshape((n_blocks, 16, QK_K // 16))
+    qh = unpack_bits(hmask, 1, dim=1).reshape((n_blocks, 16, QK_K // 16)) ^ 1
+    q = ql.to(dtype).sub_((qh << 2).to(dtype))
 
-    return (dl * q).reshape((n_blocks, QK_K))
+    return q.mul_(dl).reshape((n_blocks, QK_K))
 
 
 def dequantize_blocks_Q2_K(blocks, block_size, type_size, dtype=None):
     n_blocks = blocks.shape[0]
 
     scales, qs, d, dmin = split_block_dims(blocks, QK_K // 16, QK_K // 4, 2)
-    d = d.view(torch.float16).to(dtype)
-    dmin = dmin.view(torch.float16).to(dtype)
+    d = to_float(d, dtype)
+    dmin = to_float(dmin, dtype)
 
     # (n_blocks, 16, 1)
     dl = (d * (scales & 0xF)).reshape((n_blocks, QK_K // 16, 1))
     ml = (dmin * (scales >> 4)).reshape((n_blocks, QK_K // 16, 1))
 
-    shift = torch.tensor([0, 2, 4, 6], device=d.device, dtype=torch.uint8).reshape((1, 1, 4, 1))
-
-    qs = (qs.reshape((n_blocks, -1, 1, 32)) >> shift) & 3
-    qs = qs.reshape((n_blocks, QK_K // 16, 16))
-    qs = dl * qs - ml
+    qs = unpack_bits(qs.reshape((n_blocks, 2, 32)), 2, dim=2).reshape((n_blocks, QK_K // 16, 16))
+    qs = qs.to(dtype).mul_(dl).sub_(ml)
 
     return qs.reshape((n_blocks, -1))
 
@@ -388,6 +509,189 @@ dequantize_functions = {
 SUPPORTED_GGUF_QUANT_TYPES = list(dequantize_functions.keys())
 
 
+# quantize operations, the inverse of the block layouts above
+# Q8_0 matches the gguf reference, the K-quants use min-max sub-block scales instead of the iterative search of
+# llama.cpp, which is much faster and slightly less accurate
+
+
+def round_half_away(x):
+    return x.abs().add_(0.5).floor_().copysign_(x)
+
+
+def from_float(x):
+    # [n_blocks, 1] float32 to fp16 scale bytes, returns the bytes and the rounded scale used for quantization
+    x = x.to(torch.float16)
+    return x.view(torch.uint8).reshape(-1, 2), x.float()
+
+
+def safe_reciprocal(x):
+    return torch.where(x == 0, 0.0, 1.0 / x)
+
+
+def quantize_blocks_Q8_0(blocks, block_size, type_size):
+    d = blocks.abs().amax(dim=1, keepdim=True) / 127
+    qs = round_half_away(blocks * safe_reciprocal(d)).to(torch.int8).view(torch.uint8)
+    d, _ = from_float(d)
+    return torch.cat([d, qs], dim=1)
+
+
+def quantize_blocks_Q6_K(blocks, block_size, type_size):
+    n_blocks = blocks.shape[0]
+    x = blocks.reshape((n_blocks, QK_K // 16, 16))
+
+    # sub-block scales map the value of largest magnitude to -32, the super-block scale maps them to int8
+    index = x.abs().argmax(dim=-1, keepdim=True)
+    scales = x.gather(-1, index).squeeze(-1) / -32
+    max_scale = scales.gather(-1, scales.abs().argmax(dim=-1, keepdim=True))
+    iscale = safe_reciprocal(max_scale) * -128
+    scales = torch.round(scales * iscale).clamp_(-128, 127)
+    d, d_float = from_float(safe_reciprocal(iscale))
+
+    dl = (d_float * scales).unsqueeze(-1)
+    q = torch.round(x * safe_reciprocal(dl)).clamp_(-32, 31).add_(32).to(torch.uint8)
+    q = q.reshape((n_blocks, 2, 128))
+
+    ql = (q[:, :, :64] & 0x0F) | ((q[:, :, 64:] & 0x0F) << 4)
+    qh = (q >> 4).reshape((n_blocks, 2, 4, 32))
+    qh = qh[:, :, 0] | (qh[:, :, 1] << 2) | (qh[:, :, 2] << 4) | (qh[:, :, 3] << 6)
+    scales = scales.to(torch.int8).view(torch.uint8)
+    return torch.cat([ql.reshape((n_blocks, -1)), qh.reshape((n_blocks, -1)), scales, d], dim=1)
+
+
+def quantize_blocks_Q4_K(blocks, block_size, type_size):
+    n_blocks = blocks.shape[0]
+    x = blocks.reshape((n_blocks, 8, 32))
+
+    mins = x.amin(dim=-1).clamp_(max=0).neg_()
+    scales = (x.amax(dim=-1) + mins) / 15
+    d, d_float = from_float(scales.amax(dim=-1, keepdim=True) / 63)
+    dmin, dmin_float = from_float(mins.amax(dim=-1, keepdim=True) / 63)
+    sc = torch.round(scales * safe_reciprocal(d_float)).clamp_(0, 63)
+    m = torch.round(mins * safe_reciprocal(dmin_float)).clamp_(0, 63)
+
+    dl = (d_float * sc).unsqueeze(-1)
+    ml = (dmin_float * m).unsqueeze(-1)
+    q = torch.round((x + ml) * safe_reciprocal(dl)).clamp_(0, 15).to(torch.uint8)
+    qs = q[:, 0::2] | (q[:, 1::2] << 4)
+
+    # inverse of get_scale_min
+    sc, m = sc.to(torch.uint8), m.to(torch.uint8)
+    scales = torch.cat(
+        [
+            sc[:, :4] | ((sc[:, 4:] >> 4) << 6),
+            m[:, :4] | ((m[:, 4:] >> 4) << 6),
+            (sc[:, 4:] & 0x0F) | ((m[:, 4:] & 0x0F) << 4),
+        ],
+        dim=1,
+    )
+    return torch.cat([d, dmin, scales, qs.reshape((n_blocks, -1))], dim=1)
+
+
+quantize_functions = {
+    gguf.GGMLQuantizationType.Q8_0: quantize_blocks_Q8_0,
+    gguf.GGMLQuantizationType.Q6_K: quantize_blocks_Q6_K,
+    gguf.GGMLQuantizationType.Q4_K: quantize_blocks_Q4_K,
+}
+SUPPORTED_GGUF_QUANTIZE_TYPES = list(quantize_functions.keys())
+
+# names of embedding tables kept in their original dtype when quantizing, matched with fnmatch. norm weights are 1-D
+# and never quantized, linear layers named after norms or embedders (AdaLN modulations, time embedders) are quantized
+DEFAULT_GGUF_EXCLUDE_PATTERNS = (
+    "*token_embedding*",
+    "*pos_embedding*",
+    "*position_embeds*",
+    "*relative_attention_bias*",
+)
+
+
+def _parse_quant_dtype(quant_dtype) -> gguf.GGMLQuantizationType:
+    if isinstance(quant_dtype, str):
+        if quant_dtype.upper() not in gguf.GGMLQuantizationType.__members__:
+            raise ValueError(f"unknown gguf quantization type: {quant_dtype}")
+        quant_dtype = gguf.GGMLQuantizationType[quant_dtype.upper()]
+    if quant_dtype not in SUPPORTED_GGUF_QUANTIZE_TYPES:
+        _supported_quants_str = ", ".join([type.name for type in SUPPORTED_GGUF_QUANTIZE_TYPES])
+        raise ValueError(f"cannot quantize to {quant_dtype}, expected one of {_supported_quants_str}")
+    return quant_dtype
+
+
+def quantize(tensor: torch.Tensor, quant_dtype) -> torch.Tensor:
+    """
+    Quantizes a float tensor to GGUF blocks along its last dim, the inverse of `dequantize`. Returns the uint8 bytes
+    of shape [..., last dim // block size * type size].
+    """
+    quant_dtype = _parse_quant_dtype(quant_dtype)
+    quant_fn = quantize_functions[quant_dtype]
+    block_size, type_size = gguf.GGML_QUANT_SIZES[quant_dtype]
+    if tensor.shape[-1] % block_size != 0:
+        raise ValueError(f"last dim of {tuple(tensor.shape)} is not a multiple of the block size {block_size}")
+
+    n_blocks = tensor.numel() // block_size
+    blocks = tensor.reshape((n_blocks, block_size))
+    quant = torch.empty((n_blocks, type_size), dtype=torch.uint8, device=tensor.device)
+    chunk_size = max(DEQUANT_CHUNK_SIZE // block_size, 1)
+    for i in range(0, n_blocks, chunk_size):
+        quant[i : i + chunk_size] = quant_fn(blocks[i : i + chunk_size].float(), block_size, type_size)
+    return quant.reshape((*tensor.shape[:-1], tensor.shape[-1] // block_size * type_size))
+
+
+def should_quantize(name: str, tensor: torch.Tensor, quant_dtype, exclude=DEFAULT_GGUF_EXCLUDE_PATTERNS) -> bool:
+    """
+    Per layer quantization policy: only float matrices whose rows split into whole blocks and whose name matches
+    none of the `exclude` patterns are quantized.
+    """
+    quant_dtype = _parse_quant_dtype(quant_dtype)
+    block_size, _ = gguf.GGML_QUANT_SIZES[quant_dtype]
+    if isinstance(tensor, GGUFParameter) or not torch.is_floating_point(tensor):
+        return False
+    if tensor.dim() != 2 or tensor.shape[-1] % block_size != 0:
+        return False
+    return not any(fnmatch.fnmatch(name, pattern) for pattern in exclude or ())
+
+
+def quantize_state_dict(
+    state_dict: Dict[str, torch.Tensor],
+    quant_dtype,
+    exclude=DEFAULT_GGUF_EXCLUDE_PATTERNS,
+    compute_dtype: Optional[torch.dtype] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Quantizes the weights of a state dict to GGUFParameters, the other tensors are kept as they are. Only weights of
+    linear and embedding layers can be quantized, so `exclude` must cover other matrices of the model.
+    """
+    quant_dtype = _parse_quant_dtype(quant_dtype)
+    quantized_state_dict = {}
+    for name, param in state_dict.items():
+        if should_quantize(name, param, quant_dtype, exclude):
+            param = GGUFParameter(
+                quantize(param, quant_dtype), quant_dtype=quant_dtype, compute_dtype=compute_dtype or param.dtype
+            )
+        quantized_state_dict[name] = param
+    return quantized_state_dict
+
+
+def enable_gguf_linear(module: nn.Module, quant_dtype, exclude=DEFAULT_GGUF_EXCLUDE_PATTERNS, prefix: str = ""):
+    """
+    Replaces the float linear and embedding layers of `module` with GGUFLinear and GGUFEmbedding layers holding
+    weights quantized to `quant_dtype`, layers whose names match `exclude` are kept.
+    """
+    for name, child in module.named_children():
+        full_name = prefix + name
+        if isinstance(child, (nn.Linear, nn.Embedding)):
+            weight = child.weight.data
+            if not should_quantize(full_name, weight, quant_dtype, exclude):
+                continue
+            quantized = (
+                GGUFLinear.from_linear(child) if isinstance(child, nn.Linear) else GGUFEmbedding.from_embedding(child)
+            )
+            quantized.weight = GGUFParameter(
+                quantize(weight, quant_dtype), quant_dtype=_parse_quant_dtype(quant_dtype), compute_dtype=weight.dtype
+            )
+            setattr(module, name, quantized)
+        else:
+            enable_gguf_linear(child, quant_dtype, exclude, prefix=full_name + ".")
+
+
 def load_gguf_checkpoint(checkpoint_path, device="cpu", dtype=None):
     reader = GGUFReader(checkpoint_path)
 
@@ -407,9 +711,43 @@ def load_gguf_checkpoint(checkpoint_path, device="cpu", dtype=None):
             )
 
         param = torch.from_numpy(tensor.data.copy())
+        if quant_dtype == gguf.GGMLQuantizationType.BF16:
+            # unquantized bfloat16 tensors like norms written by save_gguf_checkpoint load as plain tensors
+            param, is_torch_compatible = param.view(torch.bfloat16), True
         state_dict[name] = (
             param.to(device=device, dtype=dtype)
             if is_torch_compatible
             else GGUFParameter(param.to(device=device), quant_dtype=quant_dtype, compute_dtype=dtype)
         )
     return state_dict
+
+
+def save_gguf_checkpoint(
+    state_dict: Dict[str, torch.Tensor],
+    checkpoint_path,
+    quant_dtype=None,
+    exclude=DEFAULT_GGUF_EXCLUDE_PATTERNS,
+    arch: str = "diffsynth",
+):
+    """
+    Writes a state dict to a GGUF file readable by `load_gguf_checkpoint`. With `quant_dtype` the tensors selected by
+    `should_quantize` are quantized, GGUFParameters are written as they are and bfloat16 tensors are kept as BF16.
+    """
+    if quant_dtype is not None:
+        state_dict = quantize_state_dict(state_dict, quant_dtype, exclude)
+    writer = GGUFWriter(checkpoint_path, arch)
+    for name, param in state_dict.items():
+        if isinstance(param, GGUFParameter):
+            data, raw_dtype = param.as_tensor().detach().cpu(), param.quant_dtype
+        elif param.dtype == torch.bfloat16:
+            data, raw_dtype = param.detach().cpu().view(torch.uint8), gguf.GGMLQuantizationType.BF16
+        elif param.dtype in (torch.float32, torch.float16):
+            data, raw_dtype = param.detach().cpu(), None
+        else:
+            data, raw_dtype = param.detach().cpu().float(), None
+        data = data.contiguous().numpy()
+        writer.add_tensor(name, data, raw_shape=data.shape if raw_dtype is not None else None, raw_dtype=raw_dtype)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
@@ -0,0 +1,146 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from typing import Optional, Tuple
+
+from diffsynth_engine.models.basic.lora import LoRALinear
+
+INT8_MAX = 127.0
+# avoid zero scales of all zero channels / tokens
+INT8_MIN_SCALE = 1e-12
+
+
+def quantize_int8(weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantizes a [out, in] weight to int8 with symmetric per output channel scales.
+    Returns the int8 weight and the [out, 1] float32 scale, weight ≈ int8_weight * scale.
+    """
+    weight = weight.float()
+    scale = (weight.abs().amax(dim=1, keepdim=True) / INT8_MAX).clamp(min=INT8_MIN_SCALE)
+    weight = (weight / scale).round().clamp(-INT8_MAX, INT8_MAX).to(torch.int8)
+    return weight, scale
+
+
+def dequantize_int8(weight: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    return (weight.float() * scale).to(dtype)
+
+
+def quantize_int8_activation(x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # symmetric per token scale ([M, 1]) computed on the fly
+    x = x.float()
+    x_scale = (x.abs().amax(dim=-1, keepdim=True) / INT8_MAX).clamp(min=INT8_MIN_SCALE)
+    x = (x / x_scale).round().clamp(-INT8_MAX, INT8_MAX).to(torch.int8)
+    return x, x_scale
+
+
+def int8_linear(
+    input: torch.Tensor,
+    weight: torch.Tensor,
+    weight_scale: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    dynamic: bool = True,
+) -> torch.Tensor:
+    """
+    input:          [..., in].
+    weight:         [out, in] int8.
+    weight_scale:   [out, 1] float32 per output channel scale.
+    dynamic:        quantize activations per token and multiply in int8, otherwise only weights are quantized and
+                    dequantized to the input dtype for the matmul.
+    """
+    out_features, in_features = weight.shape
+    if not dynamic:
+        # int8 values are exact in half dtypes, scale the output instead of the weight
+        result = F.linear(input, weight.to(input.dtype)) * weight_scale.T.to(input.dtype)
+        return result + bias if bias is not None else result
+
+    origin_shape, origin_dtype = input.shape, input.dtype
+    x, x_scale = quantize_int8_activation(input.reshape(-1, in_features))
+    # torch._int_mm requires more than 16 rows and multiples of 8 on cuda
+    if x.device.type == "cuda" and (x.shape[0] <= 16 or in_features % 8 != 0 or out_features % 8 != 0):
+        result = x.float() @ weight.T.float()
+    else:
+        result = torch._int_mm(x, weight.T).float()
+    result = result.mul_(x_scale).mul_(weight_scale.T)
+    if bias is not None:
+        result = result.add_(bias)
+    return result.to(origin_dtype).reshape(*origin_shape[:-1], out_features)
+
+
+class Int8Linear(LoRALinear):
+    """
+    Linear with int8 weight and per output channel float32 scales. With `dynamic`, activations are quantized per token
+    and the matmul runs in int8, otherwise the weight is dequantized for a matmul in the input dtype.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bias: bool = True,
+        device=None,
+        dtype=None,
+        dynamic: bool = True,
+    ) -> None:
+        super().__init__(in_features, out_features, bias, device, dtype)
+        self.dynamic = dynamic
+        self.weight = nn.Parameter(self.weight.data.to(torch.int8), requires_grad=False)
+        self.register_buffer("weight_scale", torch.ones(out_features, 1, device=device, dtype=torch.float32))
+
+    @staticmethod
+    def from_linear(linear: nn.Linear, dynamic: bool = True):
+        int8_linear = torch.nn.utils.skip_init(
+            Int8Linear,
+            linear.in_features,
+            linear.out_features,
+            linear.bias is not None,
+            device=linear.weight.device,
+            dtype=linear.weight.dtype,
+            dynamic=dynamic,
+        )
+        weight, weight_scale = quantize_int8(linear.weight.data)
+        int8_linear.weight = nn.Parameter(weight, requires_grad=False)
+        int8_linear.weight_scale = weight_scale
+        int8_linear.bias = linear.bias
+        if isinstance(linear, LoRALinear):
+            int8_linear._lora_dict = linear._lora_dict
+        return int8_linear
+
+    def add_frozen_lora(self, name: str, scale: float, rank: int, alpha: int, up, down, device, dtype, **kwargs):
+        # int8 weights cannot be patched in place, keep the LoRA unfused
+        self.add_lora(name, scale, rank, alpha, up, down, device, dtype)
+
+    def _apply(self, fn, recurse=True):
+        weight_scale = self.weight_scale
+        super()._apply(fn, recurse)
+        # keep the scales in float32 when the model is cast to a half dtype
+        if self.weight_scale.dtype != weight_scale.dtype:
+            self.weight_scale = weight_scale.to(self.weight_scale.device)
+        return self
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        weight = state_dict.get(prefix + "weight")
+        if weight is not None and torch.is_floating_point(weight):
+            # float checkpoint, quantize on load
+            state_dict[prefix + "weight"], state_dict[prefix + "weight_scale"] = quantize_int8(weight)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x):
+        w_x = int8_linear(x, self.weight, self.weight_scale, self.bias, self.dynamic)
+        for name, lora in self._lora_dict.items():
+            w_x += lora(x)
+        return w_x
+
+
+def enable_int8_linear(module: nn.Module, dynamic: bool = True):
+    """
+    Replaces the float linear layers of `module` with Int8Linear layers holding per channel scaled int8 weights.
+    """
+    for name, child in module.named_children():
+        if (
+            isinstance(child, nn.Linear)
+            and not isinstance(child, Int8Linear)
+            and torch.is_floating_point(child.weight.data)
+        ):
+            setattr(module, name, Int8Linear.from_linear(child, dynamic=dynamic))
+        else:
+            enable_int8_linear(child, dynamic=dynamic)
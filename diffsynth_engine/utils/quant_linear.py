@@ -0,0 +1,87 @@
+import torch
+import torch.nn as nn
+from typing import Dict, Optional
+
+from diffsynth_engine.models.basic.lora import LoRALinear
+from diffsynth_engine.utils.fp8_linear import FP8_DTYPE, FP8Linear
+from diffsynth_engine.utils.gguf import (
+    TORCH_COMPATIBLE_QTYPES,
+    GGUFEmbedding,
+    GGUFLinear,
+    GGUFParameter,
+    dequantize,
+)
+from diffsynth_engine.utils.int8_linear import Int8Linear
+
+QUANTIZED_MODULES = (FP8Linear, GGUFLinear, Int8Linear, GGUFEmbedding)
+
+
+def _quantized_linear_cls(weight: torch.Tensor, has_scale: bool) -> Optional[type]:
+    if isinstance(weight, GGUFParameter):
+        return GGUFLinear if weight.quant_dtype not in TORCH_COMPATIBLE_QTYPES else None
+    # plain fp8 checkpoints without scales are upcast to the model dtype as before
+    if weight.dtype == FP8_DTYPE and has_scale:
+        return FP8Linear
+    if weight.dtype == torch.int8 and has_scale:
+        return Int8Linear
+    return None
+
+
+def _empty_linear(cls, linear: nn.Linear) -> nn.Linear:
+    quantized_linear = torch.nn.utils.skip_init(
+        cls,
+        linear.in_features,
+        linear.out_features,
+        linear.bias is not None,
+        device=linear.weight.device,
+        dtype=linear.weight.dtype,
+    )
+    if isinstance(linear, LoRALinear):
+        quantized_linear._lora_dict = linear._lora_dict
+    return quantized_linear
+
+
+def replace_quantized_modules(module: nn.Module, state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """
+    Replaces the linear and embedding layers whose weights in `state_dict` are quantized with the quantized module of
+    the weight format before loading the state dict, in the same way LoRAContext replaces nn.Linear. The quantized
+    modules dispatch on their own weights, so models of different precisions can run side by side.
+    Other GGUF quantized tensors, like position embeddings or conv weights, are dequantized in the returned state dict.
+    """
+    for name, submodule in list(module.named_modules()):
+        if isinstance(submodule, QUANTIZED_MODULES):
+            continue
+        prefix = f"{name}." if name else ""
+        weight = state_dict.get(prefix + "weight")
+        if weight is None:
+            continue
+        replacement = None
+        if isinstance(submodule, nn.Linear):
+            cls = _quantized_linear_cls(weight, has_scale=prefix + "weight_scale" in state_dict)
+            if cls is GGUFLinear:
+                replacement = GGUFLinear.from_linear(submodule)
+            elif cls is not None:
+                replacement = _empty_linear(cls, submodule)
+        elif isinstance(submodule, nn.Embedding) and isinstance(weight, GGUFParameter):
+            if weight.quant_dtype not in TORCH_COMPATIBLE_QTYPES:
+                replacement = GGUFEmbedding.from_embedding(submodule)
+        if replacement is None:
+            continue
+        if name == "":
+            raise ValueError(f"cannot replace the root module {module.__class__.__name__} with a quantized module")
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(module.get_submodule(parent_name), child_name, replacement)
+
+    gguf_weights = {
+        f"{name}.weight"
+        for name, submodule in module.named_modules()
+        if isinstance(submodule, (GGUFLinear, GGUFEmbedding))
+    }
+    dequantized = {
+        name: dequantize(param)
+        for name, param in state_dict.items()
+        if isinstance(param, GGUFParameter)
+        and param.quant_dtype not in TORCH_COMPATIBLE_QTYPES
+        and name not in gguf_weights
+    }
+    return {**state_dict, **dequantized} if dequantized else state_dict
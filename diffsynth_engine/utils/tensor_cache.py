@@ -0,0 +1,159 @@
+import os
+import hashlib
+import weakref
+import torch
+import torch.nn as nn
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from PIL import Image
+from safetensors.torch import load_file, save_file
+
+from diffsynth_engine.models.basic.lora import LoRA, LoRALinear, LoRAConv2d
+from diffsynth_engine.utils import logging
+
+logger = logging.get_logger(__name__)
+
+# values sampled from the start of every tensor to tell checkpoints of the same architecture apart
+FINGERPRINT_NUM_VALUES = 16
+
+_model_fingerprints = weakref.WeakKeyDictionary()
+_lora_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _update_with_tensor(hasher, tensor: torch.Tensor):
+    hasher.update(f"{tuple(tensor.shape)}{tensor.dtype}".encode())
+    values = tensor.detach().flatten()[:FINGERPRINT_NUM_VALUES].to("cpu", copy=True)
+    # hashed as raw bytes, bfloat16 and fp8 have no numpy dtype
+    hasher.update(values.view(torch.uint8).numpy().tobytes())
+
+
+def model_fingerprint(model: nn.Module) -> str:
+    """
+    Identifies the weights of a model by the names, shapes and dtypes of its state dict and the first values of
+    each tensor. The fingerprint is computed once per model, LoRA patched onto the model is identified by
+    `lora_fingerprint` instead.
+    """
+    if model not in _model_fingerprints:
+        hasher = hashlib.sha256(model.__class__.__name__.encode())
+        for name, tensor in model.state_dict().items():
+            hasher.update(name.encode())
+            if tensor is not None:
+                _update_with_tensor(hasher, tensor)
+        _model_fingerprints[model] = hasher.hexdigest()
+    return _model_fingerprints[model]
+
+
+def _lora_fingerprint(lora: LoRA) -> str:
+    if lora not in _lora_fingerprints:
+        hasher = hashlib.sha256(f"{lora.rank}{lora.alpha}".encode())
+        for weight in (lora.up, lora.down):
+            _update_with_tensor(hasher, weight.weight if isinstance(weight, nn.Module) else weight)
+        _lora_fingerprints[lora] = hasher.hexdigest()
+    # the scale of a loaded LoRA can be modified
+    return f"{_lora_fingerprints[lora]}:{lora.scale}"
+
+
+def lora_fingerprint(model: nn.Module) -> str:
+    """
+    Identifies the LoRA currently patched onto the layers of a model, an empty string for none.
+    """
+    hasher = None
+    for name, module in model.named_modules():
+        if not isinstance(module, (LoRALinear, LoRAConv2d)):
+            continue
+        loras = list(module._lora_dict.values()) + module._frozen_lora_list
+        if len(loras) == 0:
+            continue
+        hasher = hasher or hashlib.sha256()
+        hasher.update(name.encode())
+        for lora in loras:
+            hasher.update(_lora_fingerprint(lora).encode())
+    return "" if hasher is None else hasher.hexdigest()
+
+
+def image_fingerprint(images: List[Image.Image]) -> str:
+    """
+    Identifies images by their content, mode and size.
+    """
+    hasher = hashlib.sha256()
+    for image in images:
+        hasher.update(f"{image.mode}{image.size}".encode())
+        hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+
+class TensorCache:
+    """
+    A two-level cache of named tensors by string key. The memory level keeps the most recently used entries on the
+    cpu within `max_memory_bytes`, the optional disk level stores every entry as a safetensors file in `cache_dir`
+    and serves it to other processes.
+    """
+
+    def __init__(self, max_memory_bytes: int = 1 << 30, cache_dir: Optional[str] = None):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.memory_bytes = 0
+        self._entries: OrderedDict[str, Dict[str, torch.Tensor]] = OrderedDict()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        hasher = hashlib.sha256()
+        for part in parts:
+            hasher.update(part.numpy().tobytes() if isinstance(part, torch.Tensor) else repr(part).encode())
+            # separates the parts, so that different splits of the same bytes get different keys
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    @staticmethod
+    def entry_bytes(tensors: Dict[str, torch.Tensor]) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def _put_memory(self, key: str, tensors: Dict[str, torch.Tensor]):
+        num_bytes = self.entry_bytes(tensors)
+        if num_bytes > self.max_memory_bytes:
+            return
+        if key in self._entries:
+            self.memory_bytes -= self.entry_bytes(self._entries.pop(key))
+        self._entries[key] = tensors
+        self.memory_bytes += num_bytes
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.memory_bytes -= self.entry_bytes(evicted)
+
+    def get(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.cache_dir is not None and os.path.isfile(self._path(key)):
+            try:
+                tensors = load_file(self._path(key))
+            except Exception as e:
+                logger.warning(f"failed to load cached tensors {self._path(key)}: {e}")
+                return None
+            self._put_memory(key, tensors)
+            return tensors
+        return None
+
+    def put(self, key: str, tensors: Dict[str, torch.Tensor]):
+        tensors = {name: tensor.detach().to("cpu").contiguous() for name, tensor in tensors.items()}
+        self._put_memory(key, tensors)
+        if self.cache_dir is not None and not os.path.isfile(self._path(key)):
+            # write to a temporary file first, other processes never read a partial file
+            tmp_path = f"{self._path(key)}.{os.getpid()}.tmp"
+            save_file(tensors, tmp_path)
+            os.replace(tmp_path, self._path(key))
+
+    def clear(self):
+        self._entries.clear()
+        self.memory_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return key in self._entries or (self.cache_dir is not None and os.path.isfile(self._path(key)))
@@ -1,5 +1,4 @@
 import imageio
-import imageio.v3 as iio
 import numpy as np
 from PIL import Image
 from typing import List
@@ -27,14 +26,44 @@ def load_video(path: str) -> VideoReader:
     return VideoReader(path)
 
 
-def save_video(frames, save_path, fps=15):
-    if save_path.endswith(".webm"):
-        codec = "libvpx-vp9"
-    elif save_path.endswith(".mp4"):
-        codec = "libx264"
+class VideoWriter:
+    def __init__(self, path: str, fps: int = 15):
+        codec = None
+        if path.endswith(".webm"):
+            codec = "libvpx-vp9"
+        elif path.endswith(".mp4"):
+            codec = "libx264"
+        self.writer = imageio.get_writer(path, format="FFMPEG", fps=fps, codec=codec)
+
+    def write(self, frames):
+        """
+        Appends a PIL image, a [H, W, C] uint8 frame or a [T, H, W, C] uint8 chunk of frames.
+        """
+        if isinstance(frames, Image.Image) or (isinstance(frames, np.ndarray) and frames.ndim == 3):
+            frames = [frames]
+        elif isinstance(frames, np.ndarray) and frames.ndim != 4:
+            raise ValueError(f"expected a frame or a chunk of frames, got an array of shape {frames.shape}")
+        elif isinstance(frames, (list, tuple)) and any(np.ndim(frame) == 4 for frame in frames):
+            # the chunks of a batched WanVideoPipeline.stream, one per video
+            raise ValueError("got a list of frame chunks, write the chunks of each video with its own VideoWriter")
+        for frame in frames:
+            self.writer.append_data(np.asarray(frame))
+
+    def close(self):
+        self.writer.close()
 
-    frames = [np.array(img) for img in frames]
+    def __enter__(self):
+        return self
 
-    # 使用 imageio 写入 .webm 文件
-    with iio.imopen(save_path, "w", plugin="FFMPEG") as writer:
-        writer.write(frames, fps=fps, codec=codec)
+    def __exit__(self, *args):
+        self.close()
+
+
+def save_video(frames, save_path, fps=15):
+    """
+    Writes frames as they come, a list of PIL images or any iterable of frames or frame chunks accepted by
+    `VideoWriter.write`, e.g. the chunks yielded by `WanVideoPipeline.stream`.
+    """
+    with VideoWriter(save_path, fps=fps) as writer:
+        for frame in frames:
+            writer.write(frame)
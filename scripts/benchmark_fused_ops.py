@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import torch
+
+from diffsynth_engine.models.basic import fused_ops
+
+OPS = ["modulate", "gate_add", "rms_norm", "gelu_tanh"]
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def make_inputs(name: str, batch_size: int, tokens: int, dim: int, dtype: torch.dtype, device: str):
+    def activation():
+        return torch.randn(batch_size, tokens, dim, dtype=dtype, device=device)
+
+    def modulation():
+        return torch.randn(batch_size, 1, dim, dtype=dtype, device=device)
+
+    inputs = {
+        "modulate": lambda: ((activation(), modulation(), modulation()), {}),
+        "gate_add": lambda: ((activation(), modulation(), activation()), {}),
+        "rms_norm": lambda: ((activation(), torch.ones(dim, dtype=dtype, device=device)), {"eps": 1e-6}),
+        "gelu_tanh": lambda: ((activation(),), {}),
+    }[name]()
+    # the least traffic of any implementation: every activation read once and the output written once
+    num_bytes = sum(arg.numel() * arg.element_size() for arg in inputs[0] if arg.dim() == 3) + inputs[0][0].nbytes
+    return inputs, num_bytes
+
+
+def benchmark(func, args, kwargs, repeat: int, device: str) -> float:
+    for _ in range(2):
+        func(*args, **kwargs)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args, **kwargs)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused DiT elementwise ops against their references.")
+    parser.add_argument("--ops", type=str, nargs="+", default=OPS, choices=OPS)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--tokens", type=int, default=32760, help="32760 tokens for 81 frames of 480P Wan video")
+    parser.add_argument("--dim", type=int, default=5120)
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=list(DTYPES))
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--compile", action="store_true", help="Also time the fused ops under torch.compile")
+    args = parser.parse_args()
+
+    dtype = DTYPES[args.dtype]
+    print(f"{'op':<10} {'impl':<10} {'ms':>8} {'GB/s':>8} {'speedup':>8}")
+    for name in args.ops:
+        (inputs, kwargs), num_bytes = make_inputs(name, args.batch_size, args.tokens, args.dim, dtype, args.device)
+        impls = {
+            "reference": getattr(fused_ops, f"{name}_reference"),
+            "fused": getattr(fused_ops, name),
+        }
+        if args.compile:
+            impls["compiled"] = torch.compile(getattr(fused_ops, name), dynamic=False)
+        reference_time = None
+        for impl, func in impls.items():
+            elapsed = benchmark(func, inputs, kwargs, args.repeat, args.device)
+            reference_time = reference_time or elapsed
+            gbps = num_bytes / elapsed / 1e9
+            print(f"{name:<10} {impl:<10} {elapsed * 1e3:>8.2f} {gbps:>8.2f} {reference_time / elapsed:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import gguf
+import numpy as np
+import torch
+
+from diffsynth_engine.utils.gguf import dequantize
+
+QUANT_TYPES = ["Q4_0", "Q4_K", "Q5_K", "Q6_K", "Q8_0"]
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def random_quantized_tensor(quant_type: gguf.GGMLQuantizationType, rows: int, cols: int) -> torch.Tensor:
+    # random quant bytes with finite fp16 super block scales
+    block_size, type_size = gguf.GGML_QUANT_SIZES[quant_type]
+    n_blocks = rows * cols // block_size
+    data = np.random.randint(0, 256, (n_blocks, type_size), dtype=np.uint8)
+    scale_offsets = {
+        gguf.GGMLQuantizationType.Q4_0: [0],
+        gguf.GGMLQuantizationType.Q8_0: [0],
+        gguf.GGMLQuantizationType.Q4_K: [0, 2],
+        gguf.GGMLQuantizationType.Q5_K: [0, 2],
+        gguf.GGMLQuantizationType.Q6_K: [type_size - 2],
+    }[quant_type]
+    for offset in scale_offsets:
+        scale = np.random.uniform(-0.01, 0.01, (n_blocks, 1)).astype(np.float16)
+        data[:, offset : offset + 2] = scale.view(np.uint8)
+    return torch.from_numpy(data).reshape(rows, cols // block_size * type_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GGUF dequantization throughput per quant type.")
+    parser.add_argument("--quant-types", type=str, nargs="+", default=QUANT_TYPES, choices=QUANT_TYPES)
+    parser.add_argument("--rows", type=int, default=4096)
+    parser.add_argument("--cols", type=int, default=4096)
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=list(DTYPES))
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--check", action="store_true", help="Compare against the gguf numpy reference")
+    args = parser.parse_args()
+
+    dtype = DTYPES[args.dtype]
+    print(f"{'type':<6} {'ms':>8} {'in GB/s':>8} {'out GB/s':>9}")
+    for name in args.quant_types:
+        quant_type = gguf.GGMLQuantizationType[name]
+        data = random_quantized_tensor(quant_type, args.rows, args.cols)
+        if args.check:
+            expected = torch.from_numpy(gguf.quants.dequantize(data.numpy(), quant_type)).to(dtype)
+            assert torch.equal(dequantize(data, quant_type, dtype), expected), f"{name} mismatch"
+        data = data.to(args.device)
+
+        dequantize(data, quant_type, dtype)
+        if data.device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            output = dequantize(data, quant_type, dtype)
+        if data.device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / args.repeat
+
+        in_gbps = data.numel() * data.element_size() / elapsed / 1e9
+        out_gbps = output.numel() * output.element_size() / elapsed / 1e9
+        print(f"{name:<6} {elapsed * 1e3:>8.2f} {in_gbps:>8.2f} {out_gbps:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import argparse
+import os
+
+from safetensors.torch import load_file
+
+from diffsynth_engine.utils.gguf import DEFAULT_GGUF_EXCLUDE_PATTERNS, save_gguf_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a safetensors checkpoint to a GGUF file")
+    parser.add_argument("--input", "-i", type=str, required=True, help="Path to the input safetensors file")
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default=None,
+        help="Path for the output GGUF file (defaults to input with .<quant type>.gguf extension)",
+    )
+    parser.add_argument("--quant-type", "-q", type=str, default="Q8_0", choices=["Q8_0", "Q6_K", "Q4_K"])
+    parser.add_argument(
+        "--exclude",
+        type=str,
+        nargs="*",
+        default=list(DEFAULT_GGUF_EXCLUDE_PATTERNS),
+        help="fnmatch patterns of tensor names kept unquantized, matrices not belonging to linear or embedding "
+        "layers must be excluded",
+    )
+    args = parser.parse_args()
+
+    output_path = args.output
+    if output_path is None:
+        base, _ = os.path.splitext(args.input)
+        output_path = f"{base}.{args.quant_type}.gguf"
+
+    print(f"Loading {args.input}...")
+    state_dict = load_file(args.input)
+
+    print(f"Quantizing to {args.quant_type} and saving to {output_path}...")
+    save_gguf_checkpoint(state_dict, output_path, quant_dtype=args.quant_type, exclude=args.exclude)
+
+    print(f"Successfully saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import dataclasses
+import unittest
+import torch
+import torch.nn as nn
+
+from diffsynth_engine.models.basic.attention import (
+    Attention,
+    attention,
+    eager_attention,
+    get_attention_backend,
+    get_attention_chunk_sizes,
+    list_attention_backends,
+    make_key_padding_mask,
+    register_attention_backend,
+    resolve_attention_backend,
+    set_attention_chunk_budget,
+    set_attn_implementation,
+    set_global_attn_implementation,
+)
+from diffsynth_engine.utils.constants import KB, MB
+from tests.common.test_case import TestCase
+
+
+class TestAttentionBackends(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.q = torch.randn(2, 4, 77, 64)
+        self.k = torch.randn(2, 4, 50, 64)
+        self.v = torch.randn(2, 4, 50, 64)
+
+    def test_backends_match_eager(self):
+        expected = eager_attention(self.q, self.k, self.v)
+        for name in list_attention_backends():
+            output = attention(self.q, self.k, self.v, attn_impl=name)
+            self.assertTensorEqual(output, expected, atol=1e-4, rtol=1e-4)
+
+    def test_mask(self):
+        bool_mask = torch.rand(2, 1, 77, 50) > 0.3
+        bool_mask[..., 0] = True
+        float_mask = torch.zeros_like(bool_mask, dtype=torch.float32).masked_fill(~bool_mask, float("-inf"))
+        expected = eager_attention(self.q, self.k, self.v, attn_mask=bool_mask)
+        for name in ("sdpa", "chunked", "flash_attn_2", "sage_attn"):
+            for mask in (bool_mask, float_mask):
+                output = attention(self.q, self.k, self.v, attn_impl=name, attn_mask=mask)
+                self.assertTensorEqual(output, expected, atol=1e-4, rtol=1e-4)
+
+    def test_k_lens(self):
+        k_lens = torch.tensor([50, 20])
+        output = attention(self.q, self.k, self.v, attn_impl="flash_attn_2", k_lens=k_lens)
+        self.assertTensorEqual(output[:1], eager_attention(self.q[:1], self.k[:1], self.v[:1]), atol=1e-4)
+        expected = eager_attention(self.q[1:], self.k[1:, :, :20], self.v[1:, :, :20])
+        self.assertTensorEqual(output[1:], expected, atol=1e-4, rtol=1e-4)
+
+    def test_k_lens_fallback(self):
+        # an unavailable flash_attn_3 hands k_lens to flash_attn_2 instead of turning them into a dense mask
+        calls = []
+
+        def varlen_attention(q, k, v, attn_mask=None, scale=None, k_lens=None):
+            calls.append((attn_mask, k_lens))
+            return eager_attention(q, k, v, attn_mask=make_key_padding_mask(k_lens, k.shape[2], q.device))
+
+        backends = {name: get_attention_backend(name) for name in ("flash_attn_2", "flash_attn_3")}
+        try:
+            register_attention_backend(dataclasses.replace(backends["flash_attn_3"], is_available=lambda: False))
+            register_attention_backend(
+                dataclasses.replace(
+                    backends["flash_attn_2"],
+                    func=varlen_attention,
+                    is_available=lambda: True,
+                    device_types=None,
+                    dtypes=None,
+                )
+            )
+            k_lens = torch.tensor([50, 20])
+            output = attention(self.q, self.k, self.v, attn_impl="flash_attn_3", k_lens=k_lens)
+        finally:
+            for backend in backends.values():
+                register_attention_backend(backend)
+        self.assertEqual(len(calls), 1)
+        self.assertIsNone(calls[0][0])
+        self.assertEqual(calls[0][1].tolist(), [50, 20])
+        expected = eager_attention(self.q[1:], self.k[1:, :, :20], self.v[1:, :, :20])
+        self.assertTensorEqual(output[1:], expected, atol=1e-4, rtol=1e-4)
+
+    def test_fallback(self):
+        self.assertEqual(resolve_attention_backend("eager", self.q).name, "eager")
+        if not torch.cuda.is_available():
+            for name in ("flash_attn_2", "flash_attn_3", "sage_attn", "sparge_attn", "xformers"):
+                self.assertEqual(resolve_attention_backend(name, self.q).name, "sdpa")
+        with self.assertRaises(ValueError):
+            get_attention_backend("unknown")
+
+
+class TestChunkedAttention(TestCase):
+    def setUp(self):
+        super().setUp()
+        # 64KB budget splits both queries and keys of the inputs below into several chunks
+        set_attention_chunk_budget(64 * KB)
+
+    def tearDown(self):
+        set_attention_chunk_budget(256 * MB)
+
+    def test_chunk_sizes(self):
+        q_chunk_size, kv_chunk_size = get_attention_chunk_sizes(8, 300, 200)
+        self.assertLess(q_chunk_size, 300)
+        self.assertLess(kv_chunk_size, 200)
+        self.assertLessEqual(8 * q_chunk_size * kv_chunk_size * 4 * 2, 64 * KB)
+
+    def test_chunked(self):
+        q, k, v = torch.randn(2, 4, 300, 32), torch.randn(2, 4, 200, 32), torch.randn(2, 4, 200, 48)
+        expected = eager_attention(q, k, v, scale=0.1)
+        self.assertTensorEqual(attention(q, k, v, attn_impl="chunked", scale=0.1), expected, atol=1e-5, rtol=1e-4)
+
+        mask = torch.rand(2, 1, 300, 200) > 0.5
+        mask[..., 150:] = False  # some key chunks are fully masked
+        mask[..., 0] = True
+        expected = eager_attention(q, k, v, attn_mask=mask)
+        self.assertTensorEqual(attention(q, k, v, attn_impl="chunked", attn_mask=mask), expected, atol=1e-5, rtol=1e-4)
+
+        k_lens = torch.tensor([200, 70])
+        output = attention(q, k, v, attn_impl="chunked", k_lens=k_lens)
+        expected = eager_attention(q[1:], k[1:, :, :70], v[1:, :, :70])
+        self.assertTensorEqual(output[1:], expected, atol=1e-5, rtol=1e-4)
+
+    def test_half(self):
+        q, k, v = (torch.randn(1, 2, 256, 64, dtype=torch.bfloat16) for _ in range(3))
+        output = attention(q, k, v, attn_impl="chunked")
+        self.assertEqual(output.dtype, torch.bfloat16)
+        expected = eager_attention(q.float(), k.float(), v.float())
+        self.assertTensorEqual(output.float(), expected, atol=1e-2, rtol=1e-1)
+
+    def test_global_implementation(self):
+        layer = Attention(32, 2, 16, device="cpu", dtype=torch.float32)
+        x = torch.randn(1, 300, 32)
+        expected = layer(x)
+        set_global_attn_implementation("chunked")
+        try:
+            self.assertTensorEqual(layer(x), expected, atol=1e-5, rtol=1e-4)
+        finally:
+            set_global_attn_implementation(None)
+        with self.assertRaises(ValueError):
+            set_global_attn_implementation("unknown")
+
+
+class TestSlidingTileAttention(TestCase):
+    grid_size = (5, 6, 7)
+    tile_size = (2, 2, 4)
+    window_size = (1, 3, 3)
+
+    def reference_mask(self, num_global_tokens):
+        f, h, w = self.grid_size
+        coords = torch.stack(torch.meshgrid(torch.arange(f), torch.arange(h), torch.arange(w), indexing="ij"), -1)
+        tiles = coords.reshape(-1, 3) // torch.tensor(self.tile_size)  # [S, 3]
+        num_tiles = torch.tensor([-(-g // t) for g, t in zip(self.grid_size, self.tile_size)])
+        window = torch.minimum(torch.tensor(self.window_size), num_tiles)
+        starts = (tiles - window // 2).clamp(min=0)
+        starts = torch.minimum(starts, num_tiles - window)
+        # key tile inside the window of the query tile
+        mask = ((tiles[None, :] >= starts[:, None]) & (tiles[None, :] < starts[:, None] + window)).all(-1)
+        global_index = torch.linspace(0, mask.shape[0] - 1, num_global_tokens).long()
+        mask[:, global_index] = True
+        mask[global_index, :] = True
+        return mask
+
+    def test_sliding_tile(self):
+        s = self.grid_size[0] * self.grid_size[1] * self.grid_size[2]
+        q, k, v = (torch.randn(2, 3, s, 16) for _ in range(3))
+        for num_global_tokens in (0, 8):
+            output = attention(
+                q,
+                k,
+                v,
+                attn_impl="sliding_tile",
+                grid_size=self.grid_size,
+                tile_size=self.tile_size,
+                window_size=self.window_size,
+                num_global_tokens=num_global_tokens,
+            )
+            expected = eager_attention(q, k, v, attn_mask=self.reference_mask(num_global_tokens))
+            self.assertTensorEqual(output, expected, atol=1e-5, rtol=1e-4)
+
+    def test_dense_without_grid(self):
+        q, k, v = (torch.randn(1, 2, 40, 16) for _ in range(3))
+        output = attention(q, k, v, attn_impl="sliding_tile")
+        self.assertTensorEqual(output, eager_attention(q, k, v), atol=1e-5, rtol=1e-4)
+
+
+class TestSetAttnImplementation(TestCase):
+    def test_per_layer(self):
+        model = nn.ModuleDict(
+            {
+                "a": Attention(32, 2, 16, device="cpu", dtype=torch.float32),
+                "b": nn.Sequential(Attention(32, 2, 16, device="cpu", dtype=torch.float32)),
+            }
+        )
+        x = torch.randn(1, 10, 32)
+        expected = model["b"](x)
+        set_attn_implementation(model, "eager", module_names=["b"])
+        self.assertEqual(model["a"].attn_implementation, "sdpa")
+        self.assertEqual(model["b"][0].attn_implementation, "eager")
+        self.assertTensorEqual(model["b"](x), expected, atol=1e-5, rtol=1e-4)
+        set_attn_implementation(model, "chunked")
+        self.assertEqual(model["a"].attn_implementation, "chunked")
+        with self.assertRaises(ValueError):
+            set_attn_implementation(model, "unknown")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import torch
+import torch.nn as nn
+from torch._dynamo.utils import counters
+
+from diffsynth_engine.models.basic.attention import attention
+from diffsynth_engine.utils.compile import compile_blocks
+from tests.common.test_case import TestCase
+
+
+class TinyBlock(nn.Module):
+    def __init__(self, dim: int = 32, num_heads: int = 2):
+        super().__init__()
+        self.num_heads = num_heads
+        self.qkv = nn.Linear(dim, dim * 3)
+        self.proj = nn.Linear(dim, dim)
+
+    def forward(self, x):
+        b, s, d = x.shape
+        q, k, v = self.qkv(x).view(b, s, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        out = attention(q, k, v, attn_impl="flash_attn_2").transpose(1, 2).reshape(b, s, d)
+        return x + self.proj(out)
+
+
+class Skip(nn.Module):
+    def forward(self, x):
+        return x
+
+
+class TestCompileBlocks(TestCase):
+    def setUp(self):
+        super().setUp()
+        torch._dynamo.reset()
+        counters.clear()
+
+    def tearDown(self):
+        torch._dynamo.reset()
+
+    def test_compile_blocks(self):
+        blocks = nn.ModuleList([TinyBlock(), Skip(), TinyBlock()]).requires_grad_(False)
+        x = torch.randn(2, 16, 32)
+        expected = x
+        for block in blocks:
+            expected = block(expected)
+        keys = list(blocks.state_dict())
+
+        compile_blocks(blocks, backend="eager")
+        output = x
+        for block in blocks:
+            output = block(output)
+        self.assertTensorEqual(output, expected)
+        # blocks are compiled in place, parameterless blocks are left eager
+        self.assertEqual(list(blocks.state_dict()), keys)
+        self.assertIsNotNone(blocks[0]._compiled_call_impl)
+        self.assertIsNone(blocks[1]._compiled_call_impl)
+        # the unavailable flash attention falls back to sdpa without breaking the graph
+        self.assertEqual(dict(counters["graph_break"]), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
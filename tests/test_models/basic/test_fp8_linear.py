@@ -0,0 +1,97 @@
+import unittest
+import torch
+import torch.nn as nn
+
+from diffsynth_engine.utils.fp8_linear import (
+    FP8Linear,
+    dequantize_fp8,
+    enable_fp8_linear,
+    fp8_calibration,
+    fp8_linear_reference,
+    quantize_fp8,
+)
+from tests.common.test_case import TestCase
+
+
+class TestFP8Linear(TestCase):
+    def setUp(self):
+        super().setUp()
+        # channels of very different magnitude are lost by an unscaled fp8 cast
+        self.model = nn.Sequential(nn.Linear(64, 128), nn.GELU(), nn.Linear(128, 32))
+        with torch.no_grad():
+            self.model[0].weight.mul_(torch.logspace(-4, 0, 128)[:, None])
+        self.x = torch.randn(2, 10, 64)
+
+    def test_quantize(self):
+        weight = self.model[0].weight.data
+        fp8_weight, scale = quantize_fp8(weight)
+        self.assertEqual(fp8_weight.dtype, torch.float8_e4m3fn)
+        self.assertEqual(scale.shape, (128, 1))
+        self.assertTensorEqual(dequantize_fp8(fp8_weight, scale), weight, atol=1e-8, rtol=0.07)
+
+    def test_fp8_linear(self):
+        with torch.no_grad():
+            expected = self.model(self.x)
+            enable_fp8_linear(self.model)
+            self.assertIsInstance(self.model[0], FP8Linear)
+            self.assertIsInstance(self.model[2], FP8Linear)
+            output = self.model(self.x)
+        self.assertTensorEqual(output, expected, atol=2e-2, rtol=5e-2)
+        # scales are kept in float32 when the model is cast
+        self.model.to(torch.bfloat16)
+        self.assertEqual(self.model[0].weight.dtype, torch.float8_e4m3fn)
+        self.assertEqual(self.model[0].weight_scale.dtype, torch.float32)
+        with torch.no_grad():
+            output = self.model(self.x.bfloat16())
+        self.assertTensorEqual(output.float(), expected, atol=5e-2, rtol=1e-1)
+
+    def test_calibration(self):
+        enable_fp8_linear(self.model)
+        with torch.no_grad():
+            dynamic_output = self.model(self.x)
+            with fp8_calibration(self.model):
+                self.model(self.x)
+            self.assertEqual(self.model[0].input_scale.shape, ())
+            static_output = self.model(self.x)
+            layer = self.model[0]
+            expected = fp8_linear_reference(self.x, layer.weight, layer.weight_scale, layer.bias, layer.input_scale)
+            self.assertTensorEqual(layer(self.x), expected)
+        self.assertTensorEqual(static_output, dynamic_output, atol=5e-2, rtol=1e-1)
+
+    def test_state_dict(self):
+        enable_fp8_linear(self.model)
+        with torch.no_grad(), fp8_calibration(self.model):
+            self.model(self.x)
+        state_dict = self.model.state_dict()
+        self.assertIn("0.weight_scale", state_dict)
+        self.assertIn("0.input_scale", state_dict)
+
+        model = nn.Sequential(nn.Linear(64, 128), nn.GELU(), nn.Linear(128, 32))
+        enable_fp8_linear(model)
+        model.load_state_dict(state_dict)
+        with torch.no_grad():
+            self.assertTensorEqual(model(self.x), self.model(self.x))
+
+    def test_frozen_lora(self):
+        enable_fp8_linear(self.model)
+        # biases are rounded to bfloat16 by the casts below
+        self.model.to(torch.bfloat16).to(torch.float32)
+        layer = self.model[2]
+        weight = dequantize_fp8(layer.weight, layer.weight_scale)
+        up, down = torch.randn(32, 4), torch.randn(4, 128)
+        with torch.no_grad():
+            expected = self.model(self.x)
+            layer.add_frozen_lora("lora", 0.5, 4, 4, up, down, "cpu", torch.float32)
+            self.assertEqual(layer.weight.dtype, torch.float8_e4m3fn)
+            self.assertEqual(len(layer._lora_dict), 0)
+            self.assertTensorEqual(
+                dequantize_fp8(layer.weight, layer.weight_scale), weight + 0.5 * up @ down, atol=1e-2, rtol=0.07
+            )
+            # the saved fp8 weight and scale survive dtype conversions
+            self.model.to(torch.bfloat16).to(torch.float32)
+            layer.clear()
+            self.assertTensorEqual(self.model(self.x), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import torch
+
+from diffsynth_engine.models.basic import fused_ops
+from diffsynth_engine.models.basic.transformer_helper import AdaLayerNorm, RMSNorm
+from tests.common.test_case import TestCase
+
+
+class TestFusedOps(TestCase):
+    def setUp(self):
+        super().setUp()
+        # [B, S, C] activations with [B, 1, C] modulation
+        self.x = torch.randn(2, 64, 128)
+        self.y = torch.randn(2, 64, 128)
+        self.shift, self.scale, self.gate = torch.randn(3, 2, 1, 128).unbind(0)
+
+    def test_parity(self):
+        x, y, shift, scale, gate = self.x, self.y, self.shift, self.scale, self.gate
+        weight = torch.rand(128) + 0.5
+        cases = {
+            "modulate": ((x, shift, scale), {}),
+            "gate_add": ((x, gate, y), {}),
+            "rms_norm": ((x, weight), {"eps": 1e-6}),
+            "gelu_tanh": ((x,), {}),
+        }
+        for name, (args, kwargs) in cases.items():
+            fused, reference = getattr(fused_ops, name), getattr(fused_ops, f"{name}_reference")
+            for dtype in (torch.float32, torch.bfloat16):
+                with self.subTest(op=name, dtype=dtype):
+                    inputs = [arg.to(dtype) for arg in args]
+                    output = fused(*inputs, **kwargs)
+                    expected = reference(*inputs, **kwargs)
+                    self.assertEqual(output.dtype, expected.dtype)
+                    # the fused ops round once instead of after every step
+                    atol, rtol = (1e-5, 1e-5) if dtype == torch.float32 else (3e-2, 2e-2)
+                    self.assertTensorEqual(output, expected, atol=atol, rtol=rtol)
+
+    def test_mixed_dtypes(self):
+        # float32 modulation of bfloat16 activations promotes like the reference
+        x = self.x.bfloat16()
+        self.assertEqual(fused_ops.modulate(x, self.shift, self.scale).dtype, torch.float32)
+        self.assertEqual(fused_ops.gate_add(x, self.gate, self.y.bfloat16()).dtype, torch.float32)
+        weight = torch.ones(128, dtype=torch.bfloat16)
+        self.assertEqual(fused_ops.rms_norm(x, weight, 1e-6).dtype, torch.bfloat16)
+
+    def test_modules(self):
+        norm = RMSNorm(128, eps=1e-6, device="cpu", dtype=torch.float32)
+        self.assertTensorEqual(norm(self.x), fused_ops.rms_norm_reference(self.x, norm.weight, 1e-6))
+
+        ada_norm = AdaLayerNorm(128, device="cpu", dtype=torch.float32)
+        emb = torch.randn(2, 128)
+        x, gate_msa, *_ = ada_norm(self.x, emb)
+        modulation = ada_norm.linear(torch.nn.functional.silu(emb)).unsqueeze(1)
+        shift_msa, scale_msa, expected_gate, *_ = modulation.chunk(6, dim=2)
+        expected = fused_ops.modulate_reference(ada_norm.norm(self.x), shift_msa, scale_msa)
+        self.assertTensorEqual(x, expected)
+        self.assertTensorEqual(gate_msa, expected_gate)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import gguf
+import numpy as np
+import torch
+from gguf import quants
+
+from diffsynth_engine.utils.gguf import dequantize, dequantize_functions, quantize
+from tests.common.test_case import TestCase
+
+QuantType = gguf.GGMLQuantizationType
+
+
+def random_blocks(quant_type: QuantType, n_blocks: int) -> np.ndarray:
+    # random quant bytes with finite fp16 scales at the offsets of each block layout
+    block_size, type_size = gguf.GGML_QUANT_SIZES[quant_type]
+    if quant_type == QuantType.BF16:
+        data = np.random.randn(n_blocks, block_size).astype(np.float32)
+        return (data.view(np.uint32) >> 16).astype(np.uint16).view(np.uint8)
+    data = np.random.randint(0, 256, (n_blocks, type_size), dtype=np.uint8)
+    scale_offsets = {
+        QuantType.Q4_0: [0],
+        QuantType.Q4_1: [0, 2],
+        QuantType.Q5_0: [0],
+        QuantType.Q5_1: [0, 2],
+        QuantType.Q8_0: [0],
+        QuantType.Q2_K: [type_size - 4, type_size - 2],
+        QuantType.Q3_K: [type_size - 2],
+        QuantType.Q4_K: [0, 2],
+        QuantType.Q5_K: [0, 2],
+        QuantType.Q6_K: [type_size - 2],
+    }[quant_type]
+    for offset in scale_offsets:
+        data[:, offset : offset + 2] = np.random.uniform(-0.01, 0.01, (n_blocks, 1)).astype(np.float16).view(np.uint8)
+    return data
+
+
+class TestGGUFDequantize(TestCase):
+    def test_parity(self):
+        np.random.seed(42)
+        for quant_type in dequantize_functions:
+            with self.subTest(quant_type=quant_type.name):
+                data = random_blocks(quant_type, 1000).reshape(8, -1)
+                expected = torch.from_numpy(quants.dequantize(data, quant_type))
+                tensor = torch.from_numpy(data)
+                # computed in float32 like the reference, so half dtypes are the rounded reference
+                for dtype in (torch.float32, torch.float16, torch.bfloat16):
+                    output = dequantize(tensor, quant_type, dtype)
+                    self.assertEqual(output.dtype, dtype)
+                    self.assertTrue(torch.equal(output, expected.to(dtype)))
+
+    def test_chunks(self):
+        # tensors spanning several chunks match the reference
+        np.random.seed(42)
+        data = random_blocks(QuantType.Q4_K, 4096).reshape(16, -1)
+        expected = torch.from_numpy(quants.dequantize(data, QuantType.Q4_K))
+        self.assertTrue(torch.equal(dequantize(torch.from_numpy(data), QuantType.Q4_K, torch.float32), expected))
+
+
+class TestGGUFQuantize(TestCase):
+    def test_q8_0_parity(self):
+        x = torch.randn(16, 512)
+        expected = torch.from_numpy(quants.quantize(x.numpy(), QuantType.Q8_0))
+        self.assertTrue(torch.equal(quantize(x, QuantType.Q8_0), expected))
+
+    def test_round_trip(self):
+        x = torch.randn(64, 1024, dtype=torch.bfloat16) * 0.02
+        for quant_type, max_error in (("Q8_0", 0.01), ("Q6_K", 0.03), ("Q4_K", 0.1)):
+            with self.subTest(quant_type=quant_type):
+                quant = quantize(x, quant_type)
+                block_size, type_size = gguf.GGML_QUANT_SIZES[QuantType[quant_type]]
+                self.assertEqual(quant.shape, (64, 1024 // block_size * type_size))
+                # valid blocks for the gguf reference
+                output = dequantize(quant, QuantType[quant_type], torch.float32)
+                expected = torch.from_numpy(quants.dequantize(quant.numpy(), QuantType[quant_type]))
+                self.assertTrue(torch.equal(output, expected))
+                error = (output - x.float()).norm() / x.float().norm()
+                self.assertLess(error.item(), max_error)
+
+    def test_zeros(self):
+        for quant_type in ("Q8_0", "Q6_K", "Q4_K"):
+            x = torch.zeros(2, 256)
+            self.assertTrue(torch.equal(dequantize(quantize(x, quant_type), QuantType[quant_type], torch.float32), x))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            quantize(torch.randn(4, 100), "Q8_0")
+        with self.assertRaises(ValueError):
+            quantize(torch.randn(4, 256), "Q5_K")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,277 @@
+import gc
+import os
+import tempfile
+import unittest
+import gguf
+import torch
+import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
+from gguf import quants
+
+from diffsynth_engine.models.base import PreTrainedModel
+from diffsynth_engine.models.basic.lora import LoRAContext
+from diffsynth_engine.models.flux.flux_dit import FluxDiT
+from diffsynth_engine.utils.fp8_linear import FP8Linear, enable_fp8_linear
+from diffsynth_engine.utils.gguf import (
+    GGUFEmbedding,
+    GGUFLinear,
+    GGUFParameter,
+    dequantize,
+    enable_gguf_linear,
+    get_gguf_dequant_cache_stats,
+    gguf_dequant_cache,
+    load_gguf_checkpoint,
+    save_gguf_checkpoint,
+    set_gguf_dequant_cache_budget,
+    should_quantize,
+)
+from diffsynth_engine.utils.int8_linear import Int8Linear, enable_int8_linear
+from tests.common.test_case import TestCase
+
+
+class TinyModel(PreTrainedModel):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(100, 64)
+        self.proj_in = nn.Linear(64, 128)
+        self.proj_out = nn.Linear(128, 64, bias=False)
+
+    def forward(self, ids):
+        return self.proj_out(torch.relu(self.proj_in(self.embedding(ids))))
+
+
+class TinyModelWithPositions(TinyModel):
+    def __init__(self):
+        super().__init__()
+        self.positions = nn.Parameter(torch.randn(20, 64))
+
+    def forward(self, ids):
+        return self.proj_out(torch.relu(self.proj_in(self.embedding(ids) + self.positions)))
+
+
+def to_gguf(tensor: torch.Tensor, quant_dtype=gguf.GGMLQuantizationType.Q8_0) -> GGUFParameter:
+    data = torch.from_numpy(quants.quantize(tensor.float().numpy(), quant_dtype))
+    return GGUFParameter(data, quant_dtype=quant_dtype, compute_dtype=torch.float32)
+
+
+class TestInt8Linear(TestCase):
+    def test_int8_linear(self):
+        model = TinyModel().requires_grad_(False)
+        ids = torch.randint(0, 100, (2, 20))
+        expected = model(ids)
+        for dynamic in (True, False):
+            int8_model = TinyModel().requires_grad_(False)
+            int8_model.load_state_dict(model.state_dict())
+            enable_int8_linear(int8_model, dynamic=dynamic)
+            self.assertIsInstance(int8_model.proj_in, Int8Linear)
+            self.assertEqual(int8_model.proj_in.weight.dtype, torch.int8)
+            self.assertTensorEqual(int8_model(ids), expected, atol=2e-2, rtol=5e-2)
+
+
+class TestReplaceQuantizedModules(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = TinyModel().requires_grad_(False)
+        self.ids = torch.randint(0, 100, (2, 20))
+
+    def test_scaled_checkpoints(self):
+        for enable_quantized_linear, cls in ((enable_fp8_linear, FP8Linear), (enable_int8_linear, Int8Linear)):
+            enable_quantized_linear(self.model)
+            expected = self.model(self.ids)
+            model = TinyModel().requires_grad_(False)
+            model.load_state_dict(self.model.state_dict())
+            self.assertIsInstance(model.proj_in, cls)
+            self.assertIsInstance(model.proj_out, cls)
+            self.assertTensorEqual(model(self.ids), expected)
+            self.model = TinyModel().requires_grad_(False)
+
+    def test_gguf_checkpoint(self):
+        state_dict = {
+            name: to_gguf(param) if param.dim() == 2 else param for name, param in self.model.state_dict().items()
+        }
+        model = TinyModel().requires_grad_(False)
+        model.load_state_dict(state_dict, assign=True)
+        self.assertIsInstance(model.embedding, GGUFEmbedding)
+        self.assertIsInstance(model.proj_in, GGUFLinear)
+        self.assertTensorEqual(model(self.ids), self.model(self.ids), atol=2e-2, rtol=5e-2)
+
+    def test_save_gguf_checkpoint(self):
+        self.model.to(torch.bfloat16)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "model.gguf")
+            save_gguf_checkpoint(self.model.state_dict(), path, quant_dtype="Q8_0", exclude=["embedding.*"])
+            state_dict = load_gguf_checkpoint(path, dtype=torch.bfloat16)
+        self.assertEqual(state_dict["proj_in.weight"].quant_dtype, gguf.GGMLQuantizationType.Q8_0)
+        # excluded and unquantizable tensors are kept in bfloat16
+        self.assertIs(type(state_dict["embedding.weight"]), torch.Tensor)
+        self.assertTrue(torch.equal(state_dict["embedding.weight"], self.model.embedding.weight))
+        self.assertTrue(torch.equal(state_dict["proj_in.bias"], self.model.proj_in.bias))
+
+        model = TinyModel().requires_grad_(False)
+        model.load_state_dict(state_dict, assign=True)
+        self.assertIs(type(model.embedding), nn.Embedding)
+        self.assertIsInstance(model.proj_in, GGUFLinear)
+        self.assertTensorEqual(model(self.ids), self.model(self.ids), atol=2e-2, rtol=5e-2)
+
+    def test_enable_gguf_linear(self):
+        expected = self.model(self.ids)
+        # rows of 64 values do not split into Q6_K blocks
+        enable_gguf_linear(self.model, "Q6_K")
+        self.assertIs(type(self.model.proj_in), nn.Linear)
+        enable_gguf_linear(self.model, "Q8_0", exclude=["proj_out"])
+        self.assertIsInstance(self.model.embedding, GGUFEmbedding)
+        self.assertIsInstance(self.model.proj_in, GGUFLinear)
+        self.assertEqual(self.model.proj_in.weight.quant_dtype, gguf.GGMLQuantizationType.Q8_0)
+        self.assertIs(type(self.model.proj_out), nn.Linear)
+        self.assertTensorEqual(self.model(self.ids), expected, atol=2e-2, rtol=5e-2)
+
+    def test_default_exclude(self):
+        with torch.device("meta"):
+            dit = FluxDiT(device="meta", dtype=torch.bfloat16)
+        quantized, total = 0, 0
+        for name, module in dit.named_modules():
+            if isinstance(module, nn.Linear):
+                total += module.weight.numel()
+                if should_quantize(name, module.weight, "Q8_0"):
+                    quantized += module.weight.numel()
+        # AdaLN modulations and embedders are linear layers and quantized by default
+        for name in ("blocks.0.norm1_a.linear", "single_blocks.0.norm.linear", "final_norm_out.linear"):
+            self.assertTrue(should_quantize(name, dit.get_submodule(name).weight, "Q8_0"))
+        self.assertTrue(should_quantize("context_embedder", dit.context_embedder.weight, "Q8_0"))
+        self.assertEqual(quantized, total)
+        # embedding tables are kept
+        table = torch.empty(32128, 4096, device="meta")
+        self.assertFalse(should_quantize("token_embedding.weight", table, "Q8_0"))
+        self.assertFalse(should_quantize("blocks.0.pos_embedding.embedding.weight", table, "Q8_0"))
+
+    def test_gguf_parameter(self):
+        # quantized tensors of plain parameters are dequantized when loading
+        model = TinyModelWithPositions().requires_grad_(False)
+        state_dict = {name: to_gguf(param) if param.dim() == 2 else param for name, param in model.state_dict().items()}
+        gguf_model = TinyModelWithPositions()
+        gguf_model.load_state_dict(state_dict)
+        self.assertIs(type(gguf_model.positions), nn.Parameter)
+        self.assertTensorEqual(gguf_model.positions, dequantize(state_dict["positions"]))
+        self.assertIsInstance(gguf_model.proj_in, GGUFLinear)
+        self.assertTensorEqual(gguf_model(self.ids), model(self.ids), atol=2e-2, rtol=5e-2)
+
+    def test_gguf_lora(self):
+        state_dict = {
+            name: to_gguf(param) if param.dim() == 2 else param for name, param in self.model.state_dict().items()
+        }
+        with LoRAContext():
+            model = TinyModel()
+        model.load_state_dict(state_dict)
+        expected = model(self.ids)
+        up, down = torch.randn(64, 4), torch.randn(4, 128)
+        lora_delta = (torch.relu(model.proj_in(model.embedding(self.ids))) @ down.T @ up.T) * 0.5
+        weight = model.proj_out.weight
+        # quantized weights keep the LoRA unfused
+        model.proj_out.add_frozen_lora("lora", 0.5, 4, 4, up, down, "cpu", torch.float32)
+        self.assertIs(model.proj_out.weight, weight)
+        self.assertTensorEqual(model(self.ids), expected + lora_delta)
+        model.proj_out.clear()
+        self.assertTensorEqual(model(self.ids), expected)
+
+    def test_float_checkpoint(self):
+        model = TinyModel().requires_grad_(False)
+        model.load_state_dict(self.model.state_dict())
+        self.assertIs(type(model.proj_in), nn.Linear)
+        self.assertIs(type(model.embedding), nn.Embedding)
+
+    def test_threads(self):
+        # models of different precisions run concurrently without interfering with each other
+        fp8_model = TinyModel().requires_grad_(False)
+        fp8_model.load_state_dict(self.model.state_dict())
+        enable_fp8_linear(fp8_model)
+        models = [self.model, fp8_model] * 4
+        expected = [model(self.ids) for model in models]
+        with ThreadPoolExecutor(max_workers=len(models)) as executor:
+            outputs = list(executor.map(lambda model: model(self.ids), models))
+        for output, expected_output in zip(outputs, expected):
+            self.assertTensorEqual(output, expected_output)
+
+
+class TestGGUFDequantCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = TinyModel().requires_grad_(False)
+        state_dict = {
+            name: to_gguf(param) if param.dim() == 2 else param for name, param in self.model.state_dict().items()
+        }
+        self.model.load_state_dict(state_dict, assign=True)
+        self.ids = torch.randint(0, 100, (2, 20))
+        gguf_dequant_cache.reset_stats()
+
+    def tearDown(self):
+        set_gguf_dequant_cache_budget(0)
+
+    def test_cache(self):
+        expected = self.model(self.ids)
+        # both linear weights are 64 * 128 float32
+        set_gguf_dequant_cache_budget(64 * 128 * 4)
+        for _ in range(3):
+            self.assertTensorEqual(self.model(self.ids), expected)
+        # proj_in is admitted first and stays, proj_out does not fit and is dequantized on every call
+        stats = get_gguf_dequant_cache_stats()
+        self.assertEqual(stats["num_weights"], 1)
+        self.assertEqual(stats["num_bytes"], 64 * 128 * 4)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["evictions"], 0)
+
+        # the cached weight is kept when the budget grows
+        set_gguf_dequant_cache_budget(2 * 64 * 128 * 4)
+        gguf_dequant_cache.reset_stats()
+        for _ in range(3):
+            self.assertTensorEqual(self.model(self.ids), expected)
+        stats = get_gguf_dequant_cache_stats()
+        self.assertEqual(stats["num_weights"], 2)
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (5, 1, 0))
+        self.assertTensorEqual(gguf_dequant_cache.get(self.model.proj_in.weight), dequantize(self.model.proj_in.weight))
+
+        # moving the model drops its dequantized weights
+        self.model.to("cpu")
+        self.assertEqual(get_gguf_dequant_cache_stats()["num_weights"], 0)
+
+    def test_cyclic_layers(self):
+        # layers run in the same order every step, a budget for 6 of 8 layers keeps hitting on those 6
+        model = nn.Sequential(*[nn.Linear(64, 64, bias=False) for _ in range(8)]).requires_grad_(False)
+        enable_gguf_linear(model, gguf.GGMLQuantizationType.Q8_0)
+        x = torch.randn(2, 64)
+        set_gguf_dequant_cache_budget(6 * 64 * 64 * 4)
+        expected = [model(x) for _ in range(5)]
+        for output in expected[1:]:
+            self.assertTensorEqual(output, expected[0])
+        stats = get_gguf_dequant_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (24, 16, 0))
+        self.assertEqual(stats["num_weights"], 6)
+
+        # shrinking the budget drops weights, the remaining ones still hit
+        set_gguf_dequant_cache_budget(2 * 64 * 64 * 4)
+        gguf_dequant_cache.reset_stats()
+        model(x)
+        stats = get_gguf_dequant_cache_stats()
+        self.assertEqual((stats["num_weights"], stats["hits"], stats["misses"]), (2, 2, 6))
+
+    def test_freed_weights(self):
+        set_gguf_dequant_cache_budget(2 * 64 * 128 * 4)
+        self.model(self.ids)
+        self.assertEqual(get_gguf_dequant_cache_stats()["num_weights"], 2)
+        # a freed model drops its dequantized weights, a model loaded after it is not served them
+        del self.model
+        gc.collect()
+        self.assertEqual(get_gguf_dequant_cache_stats()["num_bytes"], 0)
+        self.setUp()
+        expected = self.model(self.ids)
+        gguf_dequant_cache.clear()
+        self.assertTensorEqual(self.model(self.ids), expected)
+
+    def test_disabled(self):
+        self.model(self.ids)
+        stats = get_gguf_dequant_cache_stats()
+        self.assertEqual((stats["num_weights"], stats["hits"], stats["misses"]), (0, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
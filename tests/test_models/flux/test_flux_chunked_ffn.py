@@ -0,0 +1,76 @@
+import unittest
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_leaves
+
+from diffsynth_engine.models.basic.lora import LoRALinear
+from diffsynth_engine.models.basic.transformer_helper import RoPEEmbedding
+from diffsynth_engine.models.flux.flux_dit import FluxSingleTransformerBlock
+from tests.common.test_case import TestCase
+
+
+class MaxWidthMode(TorchDispatchMode):
+    """
+    Records the widest [batch_size, seq_len, width] tensor produced while active.
+    """
+
+    def __init__(self, batch_size, seq_len):
+        super().__init__()
+        self.shape = (batch_size, seq_len)
+        self.max_width = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_leaves(out):
+            if isinstance(t, torch.Tensor) and t.dim() == 3 and tuple(t.shape[:2]) == self.shape:
+                self.max_width = max(self.max_width, t.shape[2])
+        return out
+
+
+class TestFluxChunkedFFN(TestCase):
+    def setUp(self):
+        self.block = FluxSingleTransformerBlock(64, 2, device="cpu", dtype=torch.float32).eval()
+        self.hidden_states_a = torch.randn(2, 40, 64)
+        self.hidden_states_b = torch.randn(2, 8, 64)
+        self.temb = torch.randn(2, 64)
+        ids = torch.randint(0, 16, (2, 40, 3)).float()
+        self.image_rotary_emb = RoPEEmbedding(32, 10000, [8, 12, 12])(ids)
+
+    def forward(self):
+        return self.block(self.hidden_states_a, self.hidden_states_b, self.temb, self.image_rotary_emb)
+
+    def test_single_block(self):
+        with torch.no_grad():
+            expected = self.forward()[0]
+            for chunk_modulation in (False, True):
+                self.block.ffn_chunk_size, self.block.chunk_modulation = 16, chunk_modulation
+                output, output_b = self.forward()
+                self.assertTensorEqual(output, expected, atol=1e-5, rtol=1e-5)
+                self.assertIs(output_b, self.hidden_states_b)
+
+    def test_single_block_lora(self):
+        self.block.to_qkv_mlp = LoRALinear.from_linear(self.block.to_qkv_mlp)
+        self.block.to_qkv_mlp.add_lora(
+            "test", 1.0, 4, 4, torch.randn(64 * 7, 4), torch.randn(4, 64), device="cpu", dtype=torch.float32
+        )
+        with torch.no_grad():
+            expected = self.forward()[0]
+            self.block.ffn_chunk_size = 16
+            self.assertTensorEqual(self.forward()[0], expected, atol=1e-4, rtol=1e-4)
+
+    def test_no_full_mlp_buffer(self):
+        # the unchunked block allocates [B, S, 7 * dim], the chunked one only the [B, S, 3 * dim] qkv
+        batch_size, seq_len, dim = self.hidden_states_a.shape
+        with torch.no_grad():
+            with MaxWidthMode(batch_size, seq_len) as mode:
+                self.forward()
+            self.assertEqual(mode.max_width, dim * 7)
+            for chunk_modulation in (False, True):
+                self.block.ffn_chunk_size, self.block.chunk_modulation = 16, chunk_modulation
+                with MaxWidthMode(batch_size, seq_len) as mode:
+                    self.forward()
+                self.assertEqual(mode.max_width, dim * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
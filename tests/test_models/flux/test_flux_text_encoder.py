@@ -6,6 +6,7 @@ from diffsynth_engine.tokenizers import CLIPTokenizer, T5TokenizerFast
 from diffsynth_engine.models.flux import FluxTextEncoder1, FluxTextEncoder2
 from diffsynth_engine.utils.constants import FLUX_TOKENIZER_1_CONF_PATH, FLUX_TOKENIZER_2_CONF_PATH
 from diffsynth_engine.utils.download import ensure_directory_exists
+from diffsynth_engine.utils.int8_linear import enable_int8_linear
 from diffsynth_engine import fetch_model
 from tests.common.test_case import TestCase, RUN_EXTRA_TEST
 
@@ -54,6 +55,19 @@ class TestFluxTextEncoder(TestCase):
         expected_embeds = expected_tensors["embeds"]
         self.assertTensorEqual(embeds, expected_embeds)
 
+    def test_encoder_2_int8(self):
+        text_ids = self.tokenizer_2(self.texts)["input_ids"]
+        expected_embeds = self.get_expect_tensor("flux/flux_text_encoder_2.safetensors")["embeds"].float()
+        for int8_mode in ("dynamic", "weight_only"):
+            text_encoder_2 = FluxTextEncoder2.from_state_dict(
+                load_file(self._t5_model_path), device="cpu", dtype=torch.bfloat16
+            ).eval()
+            enable_int8_linear(text_encoder_2, dynamic=int8_mode == "dynamic")
+            with torch.no_grad():
+                embeds = text_encoder_2(text_ids).float()
+            similarity = torch.nn.functional.cosine_similarity(embeds, expected_embeds, dim=-1)
+            self.assertGreater(similarity.min().item(), 0.99)
+
     @unittest.skipUnless(RUN_EXTRA_TEST, "RUN_EXTRA_TEST is not set")
     def test_encoder_1_and_save_tensors(self):
         from transformers.models.clip import CLIPTextModel, CLIPTextConfig
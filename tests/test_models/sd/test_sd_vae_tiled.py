@@ -0,0 +1,96 @@
+import unittest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from diffsynth_engine.models.components.vae import GroupNormStats, tiled_forward
+from diffsynth_engine.models.sd import SDVAEEncoder, SDVAEDecoder
+from tests.common.test_case import TestCase
+
+
+class TestSDVAETiled(TestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(42)
+
+    def test_tiled_forward(self):
+        # the blending masks sum up to one, tiles of a pixelwise function give the untiled result
+        sample = torch.randn(2, 4, 20, 28)
+        expected = F.interpolate(sample, scale_factor=8) * 2
+        result = tiled_forward(
+            lambda x: F.interpolate(x, scale_factor=8) * 2, sample, 8, 4, scale_factor=8, out_channels=4
+        )
+        self.assertTensorEqual(result, expected, atol=1e-5, rtol=1e-5)
+
+        result = tiled_forward(lambda x: x[:, :, ::8, ::8], expected, 64, 32, scale_factor=1 / 8, out_channels=4)
+        self.assertTensorEqual(result, sample * 2, atol=1e-5, rtol=1e-5)
+
+    def test_group_norm_stats(self):
+        model = nn.Sequential(nn.Conv2d(4, 8, 1), nn.GroupNorm(2, 8), nn.SiLU(), nn.Conv2d(8, 4, 1)).eval()
+        sample = torch.randn(2, 4, 16, 24)
+        with torch.no_grad():
+            expected = model(sample)
+            # the statistics recorded over disjoint tiles are the ones of the whole sample
+            norm_stats = GroupNormStats(model)
+            with norm_stats.recording():
+                model(sample[:, :, :, :10])
+                model(sample[:, :, :, 10:])
+            with norm_stats.applying():
+                self.assertTensorEqual(model(sample), expected, atol=1e-5, rtol=1e-5)
+        self.assertFalse(any("forward" in vars(module) for module in model.modules()))
+
+    def test_tiled_forward_norm_stats(self):
+        model = nn.Sequential(
+            nn.Conv2d(4, 32, 3, padding=1),
+            nn.GroupNorm(4, 32),
+            nn.SiLU(),
+            nn.Conv2d(32, 32, 3, padding=1),
+            nn.GroupNorm(4, 32),
+            nn.SiLU(),
+            nn.Conv2d(32, 4, 1),
+        ).eval()
+        # a smooth sample whose mean changes across the tiles, like the colors of an image
+        sample = F.interpolate(torch.randn(1, 4, 5, 7), size=(40, 56), mode="bicubic") + torch.linspace(-2, 2, 56)
+        with torch.no_grad():
+            expected = model(sample)
+            own_error = (tiled_forward(model, sample, 16, 8, scale_factor=1, out_channels=4) - expected).abs().mean()
+            shared = tiled_forward(model, sample, 16, 8, scale_factor=1, out_channels=4, module=model)
+        # measured 0.046 with shared statistics and 0.115 with the statistics of every tile
+        shared_error = (shared - expected).abs().mean()
+        self.assertLess(shared_error, 0.06)
+        self.assertLess(shared_error, own_error / 2)
+
+    def shared_stats_reference(self, model, sample, tile_size, tile_stride, scale_factor, out_channels):
+        # records the statistics over the tiles with a plain tiled pass, then blends tiles normalized by them
+        norm_stats = GroupNormStats(model)
+        with norm_stats.recording():
+            tiled_forward(model.forward, sample, tile_size, tile_stride, scale_factor, out_channels)
+        with norm_stats.applying():
+            return tiled_forward(model.forward, sample, tile_size, tile_stride, scale_factor, out_channels)
+
+    def test_tiled_vae(self):
+        encoder = SDVAEEncoder(device="cpu", dtype=torch.float32).eval()
+        decoder = SDVAEDecoder(device="cpu", dtype=torch.float32).eval()
+        image = F.interpolate(torch.randn(1, 3, 5, 7), size=(80, 112), mode="bicubic").clamp(-1, 1)
+        with torch.no_grad():
+            latents = encoder(image)
+            # a single tile covering the whole input is the untiled result
+            self.assertTensorEqual(encoder(image, tiled=True, tile_size=16, tile_stride=8), latents)
+            tiled_latents = encoder(image, tiled=True, tile_size=8, tile_stride=4)
+            self.assertEqual(tiled_latents.shape, (1, 4, 10, 14))
+            expected = self.shared_stats_reference(encoder, image, 64, 32, scale_factor=1 / 8, out_channels=4)
+            self.assertTensorEqual(tiled_latents, expected, atol=1e-5, rtol=1e-4)
+
+            decoded = decoder(latents)
+            self.assertTensorEqual(decoder(latents, tiled=True, tile_size=16, tile_stride=8), decoded)
+            tiled_decoded = decoder(latents, tiled=True, tile_size=8, tile_stride=4)
+            self.assertEqual(tiled_decoded.shape, (1, 3, 80, 112))
+            expected = self.shared_stats_reference(decoder, latents, 8, 4, scale_factor=8, out_channels=3)
+            self.assertTensorEqual(tiled_decoded, expected, atol=1e-5, rtol=1e-4)
+            # the statistics of every tile differ from the shared ones
+            own_decoded = tiled_forward(decoder.forward, latents, 8, 4, scale_factor=8, out_channels=3)
+            self.assertGreater((own_decoded - expected).abs().mean(), 0.1 * expected.abs().mean())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import torch
+
+from diffsynth_engine.models.wan.wan_dit import WanDiT
+from diffsynth_engine.models.wan.wan_vae import VideoVAE, WanVideoVAE
+from tests.common.test_case import TestCase
+
+
+class TestWanBatch(TestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(42)
+        self.vae = WanVideoVAE(device="cpu")
+        # a narrow VAE of the same structure keeps the test fast
+        self.vae.model = VideoVAE(dim=8, z_dim=16).eval().requires_grad_(False)
+
+    def test_tiled_decode(self):
+        latents = torch.randn(2, 16, 3, 12, 12)
+        with torch.no_grad():
+            videos = self.vae.decode(latents, device="cpu", tiled=True, tile_size=(8, 8), tile_stride=(4, 4))
+            for latent, video in zip(latents, videos):
+                expected = self.vae.decode([latent], device="cpu", tiled=True, tile_size=(8, 8), tile_stride=(4, 4))
+                self.assertEqual(video.shape, (3, 9, 96, 96))
+                self.assertTensorEqual(video, expected[0], atol=1e-5, rtol=1e-4)
+
+    def test_tiled_encode(self):
+        videos = torch.randn(2, 3, 5, 96, 96)
+        with torch.no_grad():
+            latents = self.vae.encode(videos, device="cpu", tiled=True, tile_size=(8, 8), tile_stride=(4, 4))
+            for video, latent in zip(videos, latents):
+                expected = self.vae.encode([video], device="cpu", tiled=True, tile_size=(8, 8), tile_stride=(4, 4))
+                self.assertEqual(latent.shape, (16, 2, 12, 12))
+                self.assertTensorEqual(latent, expected[0], atol=1e-5, rtol=1e-4)
+
+    def test_teacache_distance(self):
+        t_mod = torch.randn(1, 6, 32)
+        previous = torch.randn(1, 6, 32)
+        expected = WanDiT.teacache_distance(t_mod, previous)
+        # samples of the same timestep decide like a single sample
+        self.assertAlmostEqual(WanDiT.teacache_distance(t_mod.expand(4, -1, -1), previous.expand(4, -1, -1)), expected)
+        # the batch is recomputed by the sample that changed the most
+        batch_t_mod = torch.cat([previous, t_mod])
+        self.assertAlmostEqual(WanDiT.teacache_distance(batch_t_mod, previous.expand(2, -1, -1)), expected)
+        self.assertFalse(WanDiT.teacache_reusable(batch_t_mod, previous))
+        self.assertFalse(WanDiT.teacache_reusable(t_mod, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
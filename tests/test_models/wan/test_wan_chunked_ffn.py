@@ -0,0 +1,45 @@
+import torch
+
+from diffsynth_engine.models.wan.wan_dit import WanDiT
+from tests.common.test_case import TestCase
+
+
+class TestWanChunkedFFN(TestCase):
+    def test_chunked_ffn(self):
+        dit = WanDiT(
+            dim=64,
+            in_dim=4,
+            ffn_dim=256,
+            out_dim=4,
+            text_dim=32,
+            freq_dim=32,
+            eps=1e-6,
+            patch_size=(1, 2, 2),
+            num_heads=2,
+            num_layers=2,
+            has_image_input=False,
+            device="cpu",
+            dtype=torch.float32,
+        ).eval()
+        x = torch.randn(2, 50, 64)
+        t_mod = torch.randn(2, 6, 64)
+        freqs = torch.randn(50, 1, 16, dtype=torch.complex64)
+        context, context_mask = dit.embed_context(torch.randn(2, 7, 32))
+
+        def run_blocks():
+            hidden_states = x
+            for block in dit.blocks:
+                hidden_states = block(hidden_states, context, t_mod, freqs, 1, context_mask)
+            return hidden_states
+
+        with torch.no_grad():
+            expected = run_blocks()
+            # chunks of 16 tokens leave a last chunk of 2 tokens
+            for chunk_modulation in (False, True):
+                dit.enable_chunked_ffn(chunk_size=16, chunk_modulation=chunk_modulation)
+                self.assertTensorEqual(run_blocks(), expected, atol=1e-5, rtol=1e-5)
+            dit.disable_chunked_ffn()
+            self.assertIsNone(dit.blocks[0].ffn_chunk_size)
+            self.assertTensorEqual(run_blocks(), expected)
+        with self.assertRaises(ValueError):
+            dit.enable_chunked_ffn(chunk_size=0)
@@ -0,0 +1,46 @@
+import torch
+
+from diffsynth_engine.models.wan.wan_dit import WanDiT
+from tests.common.test_case import TestCase
+
+
+class TestWanSlidingTile(TestCase):
+    def test_dense_steps(self):
+        torch.manual_seed(42)
+        dit = WanDiT(
+            dim=64,
+            in_dim=4,
+            ffn_dim=128,
+            out_dim=4,
+            text_dim=32,
+            freq_dim=32,
+            eps=1e-6,
+            patch_size=(1, 2, 2),
+            num_heads=2,
+            num_layers=2,
+            has_image_input=False,
+            device="cpu",
+            dtype=torch.float32,
+        ).eval()
+        # the TeaCache state set up by from_state_dict, with every step computed
+        dit.cnt, dit.num_steps, dit.ret_steps, dit.cutoff_steps = 0, 1000, 1000, 1000
+        dit.previous_e0_even = dit.previous_e0_odd = None
+        dit.previous_residual_even = dit.previous_residual_odd = None
+        dit.use_ref_steps = True
+        x = torch.randn(1, 4, 4, 8, 8)
+        context = torch.randn(1, 7, 32)
+        timestep = torch.tensor([500.0])
+
+        def forward(step_index=None):
+            return dit(x=x, context=context, timestep=timestep, num_frames=4, step_index=step_index)
+
+        with torch.no_grad():
+            expected = forward()
+            dit.enable_sliding_tile_attention(
+                tile_size=(1, 2, 2), window_size=(1, 1, 1), num_global_tokens=1, dense_steps=2
+            )
+            # the dense steps are counted by the step index, whatever the number of calls per step
+            for _ in range(2):
+                for step_index in (0, 0, 1, None):
+                    self.assertTensorEqual(forward(step_index), expected)
+                self.assertFalse(torch.allclose(forward(2), expected))
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import torch
+import torch.nn.functional as F
+
+from diffsynth_engine.models.wan.wan_text_encoder import WanTextEncoder
+from diffsynth_engine.utils.gguf import GGUFEmbedding, GGUFLinear, load_gguf_checkpoint, save_gguf_checkpoint
+from tests.common.test_case import TestCase
+
+# wan names to llama.cpp names of UMT5 GGUF files
+BLOCK_RENAME_DICT = {
+    "norm1": "attn_norm",
+    "attn.q": "attn_q",
+    "attn.k": "attn_k",
+    "attn.v": "attn_v",
+    "attn.o": "attn_o",
+    "pos_embedding.embedding": "attn_rel_b",
+    "norm2": "ffn_norm",
+    "ffn.gate.0": "ffn_gate",
+    "ffn.fc1": "ffn_up",
+    "ffn.fc2": "ffn_down",
+}
+
+
+def to_llama_cpp_names(state_dict):
+    new_state_dict = {}
+    for key, param in state_dict.items():
+        if key == "token_embedding.weight":
+            new_state_dict["token_embd.weight"] = param
+        elif key == "norm.weight":
+            new_state_dict["enc.output_norm.weight"] = param
+        else:
+            _, i, name = key.split(".", 2)
+            name, suffix = name.rsplit(".", 1)
+            new_state_dict[f"enc.blk.{i}.{BLOCK_RENAME_DICT[name]}.{suffix}"] = param
+    return new_state_dict
+
+
+class TestWanTextEncoderGGUF(TestCase):
+    def build_encoder(self):
+        return WanTextEncoder(vocab=1000, dim=256, dim_attn=256, dim_ffn=512, num_heads=4, num_layers=2)
+
+    def test_gguf_checkpoint(self):
+        encoder = self.build_encoder().requires_grad_(False).eval().to(torch.bfloat16)
+        ids = torch.randint(1, 1000, (2, 64))
+        with torch.no_grad():
+            expected = encoder(ids, torch.ones_like(ids)).float()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "umt5.gguf")
+            save_gguf_checkpoint(to_llama_cpp_names(encoder.state_dict()), path, quant_dtype="Q8_0", exclude=[])
+            state_dict = load_gguf_checkpoint(path, dtype=torch.bfloat16)
+
+        gguf_encoder = self.build_encoder().eval().to(torch.bfloat16)
+        gguf_encoder.load_state_dict(state_dict)
+        self.assertIsInstance(gguf_encoder.token_embedding, GGUFEmbedding)
+        self.assertIsInstance(gguf_encoder.blocks[0].attn.q, GGUFLinear)
+        self.assertIsInstance(gguf_encoder.blocks[0].ffn.gate[0], GGUFLinear)
+        self.assertFalse(any(param.requires_grad for param in gguf_encoder.parameters()))
+        with torch.no_grad():
+            output = gguf_encoder(ids, torch.ones_like(ids))
+        self.assertEqual(output.dtype, torch.bfloat16)
+        similarity = F.cosine_similarity(output.float(), expected, dim=-1)
+        self.assertGreater(similarity.min().item(), 0.999)
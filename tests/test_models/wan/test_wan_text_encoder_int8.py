@@ -0,0 +1,43 @@
+import torch
+import torch.nn.functional as F
+
+from diffsynth_engine.models.components.t5 import T5EncoderModel
+from diffsynth_engine.models.wan.wan_text_encoder import WanTextEncoder
+from diffsynth_engine.utils.int8_linear import Int8Linear, enable_int8_linear
+from tests.common.test_case import TestCase
+
+
+class TestTextEncoderInt8(TestCase):
+    def check_int8(self, build_encoder, *inputs):
+        # int8 embeddings are compared with bf16 embeddings of the same weights
+        encoder = build_encoder().requires_grad_(False).eval().to(torch.bfloat16)
+        with torch.no_grad():
+            expected = encoder(*inputs).float()
+        for dynamic in (True, False):
+            int8_encoder = build_encoder().requires_grad_(False).eval().to(torch.bfloat16)
+            int8_encoder.load_state_dict(encoder.state_dict())
+            enable_int8_linear(int8_encoder, dynamic=dynamic)
+            linears = [module for module in int8_encoder.modules() if isinstance(module, torch.nn.Linear)]
+            self.assertTrue(all(isinstance(module, Int8Linear) for module in linears))
+            with torch.no_grad():
+                output = int8_encoder(*inputs)
+            self.assertEqual(output.dtype, torch.bfloat16)
+            similarity = F.cosine_similarity(output.float(), expected, dim=-1)
+            self.assertGreater(similarity.min().item(), 0.999)
+
+    def test_wan_text_encoder(self):
+        ids = torch.randint(1, 1000, (2, 64))
+        self.check_int8(
+            lambda: WanTextEncoder(vocab=1000, dim=256, dim_attn=256, dim_ffn=512, num_heads=4, num_layers=2),
+            ids,
+            torch.ones_like(ids),
+        )
+
+    def test_t5_encoder(self):
+        ids = torch.randint(1, 1000, (2, 64))
+        self.check_int8(
+            lambda: T5EncoderModel(
+                embed_dim=256, vocab_size=1000, num_encoder_layers=2, d_ff=512, num_heads=4, device="cpu"
+            ),
+            ids,
+        )
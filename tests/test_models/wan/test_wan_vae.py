@@ -2,9 +2,9 @@ import torch
 import numpy as np
 from safetensors.torch import load_file
 
-from diffsynth_engine.models.wan.wan_vae import WanVideoVAE
+from diffsynth_engine.models.wan.wan_vae import VideoVAE, WanVideoVAE, load_cache, offload_cache
 from diffsynth_engine import fetch_model
-from tests.common.test_case import VideoTestCase
+from tests.common.test_case import TestCase, VideoTestCase
 
 
 class TestWanVAE(VideoTestCase):
@@ -33,3 +33,56 @@ class TestWanVAE(VideoTestCase):
         with torch.no_grad():
             result = self.vae.decode(latent_tensor, device="cuda:0", tiled=True)[0].cpu()
         self.assertTensorEqual(result, expected)
+
+
+class TestWanVAEChunks(TestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(42)
+        self.vae = WanVideoVAE(device="cpu")
+        # a narrow VAE of the same structure keeps the test fast
+        self.vae.model = VideoVAE(dim=8, z_dim=16).eval().requires_grad_(False)
+
+    def test_tile_batch(self):
+        latents = torch.randn(1, 16, 2, 14, 14)
+        videos = torch.randn(1, 3, 5, 112, 112)
+        tiling = dict(device="cpu", tiled=True, tile_size=(8, 8), tile_stride=(4, 4))
+        with torch.no_grad():
+            # tiles of the same shape run as one batch give the same result as one by one
+            expected = self.vae.decode(latents, tile_batch_size=1, **tiling)[0]
+            self.assertTensorEqual(self.vae.decode(latents, tile_batch_size=4, **tiling)[0], expected, atol=1e-5)
+            expected = self.vae.encode(videos, tile_batch_size=1, **tiling)
+            self.assertTensorEqual(self.vae.encode(videos, tile_batch_size=4, **tiling), expected, atol=1e-5)
+
+    def test_chunk_size(self):
+        latents = torch.randn(1, 16, 6, 8, 8)
+        videos = torch.randn(1, 3, 21, 32, 32)
+        with torch.no_grad():
+            # several latent frames per call give the same result as one by one
+            expected = self.vae.decode(latents, device="cpu")[0]
+            self.assertTensorEqual(self.vae.decode(latents, device="cpu", chunk_size=4)[0], expected, atol=1e-5)
+            expected = self.vae.encode(videos, device="cpu")
+            self.assertTensorEqual(self.vae.encode(videos, device="cpu", chunk_size=4), expected, atol=1e-5)
+
+    def test_decode_stream(self):
+        latents = torch.randn(2, 16, 4, 14, 14)
+        tiling = dict(tiled=True, tile_size=(8, 8), tile_stride=(4, 4))
+        with torch.no_grad():
+            for kwargs in [{}, tiling]:
+                expected = torch.stack(self.vae.decode(latents, device="cpu", **kwargs))
+                chunks = list(self.vae.decode_stream(latents, device="cpu", chunk_size=2, **kwargs))
+                self.assertEqual([chunk.shape[2] for chunk in chunks], [1, 8, 4])
+                self.assertTensorEqual(torch.cat(chunks, dim=2), expected, atol=1e-5)
+
+    def test_decode_chunks_offload(self):
+        # the causal caches survive a round trip through the host between the chunks
+        latents = torch.randn(1, 16, 4, 8, 8)
+        with torch.no_grad():
+            expected = torch.cat(list(self.vae.model.decode_chunks(latents, self.vae.scale, chunk_size=2)), dim=2)
+            feat_cache, host_cache, chunks = {}, {}, []
+            for chunk in self.vae.model.decode_chunks(latents, self.vae.scale, chunk_size=2, feat_cache=feat_cache):
+                chunks.append(chunk)
+                offload_cache(feat_cache, host_cache)
+                self.assertTrue(all(cache is host_cache[key] for key, cache in feat_cache.items()))
+                load_cache(feat_cache, "cpu")
+        self.assertTensorEqual(torch.cat(chunks, dim=2), expected)
@@ -0,0 +1,28 @@
+import unittest
+import torch
+
+from diffsynth_engine.models.wan.wan_vae import VideoVAE, WanVideoVAE
+from tests.common.test_case import TestCase
+
+
+class TestWanVAEFirstFrame(TestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(42)
+        self.vae = WanVideoVAE(device="cpu")
+        # a narrow VAE of the same structure keeps the test fast
+        self.vae.model = VideoVAE(dim=8, z_dim=16).eval().requires_grad_(False)
+
+    def test_encode_first_frame(self):
+        images = torch.randn(2, 3, 1, 32, 32)
+        with torch.no_grad():
+            for num_frames in [1, 5, 17, 81]:
+                videos = [torch.cat([image, torch.zeros(3, num_frames - 1, 32, 32)], dim=1) for image in images]
+                expected = self.vae.encode(videos, device="cpu")
+                latents = self.vae.encode_first_frame(list(images), num_frames, device="cpu")
+                self.assertEqual(latents.shape, (2, 16, (num_frames - 1) // 4 + 1, 4, 4))
+                self.assertTensorEqual(latents, expected, atol=1e-5, rtol=1e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import math
+import torch
+import torch.nn.functional as F
+
+from diffsynth_engine.models.basic.attention import attention
+from diffsynth_engine.models.wan.wan_dit import WanDiT
+from diffsynth_engine.models.wan.wan_text_encoder import WanTextEncoder
+from diffsynth_engine.pipelines.wan_video import WanVideoPipeline
+from tests.common.test_case import TestCase
+
+
+class TestWanVarlenText(TestCase):
+    text_len = 32
+
+    def test_text_encoder(self):
+        encoder = WanTextEncoder(vocab=100, dim=64, dim_attn=64, dim_ffn=128, num_heads=4, num_layers=2).eval()
+        ids = torch.zeros(1, self.text_len, dtype=torch.long)
+        mask = torch.zeros(1, self.text_len, dtype=torch.long)
+        ids[:, :9] = torch.randint(1, 100, (1, 9))
+        mask[:, :9] = 1
+        with torch.no_grad():
+            expected = encoder(ids, mask)[:, :9]
+            output = encoder(ids[:, :9], mask[:, :9])
+            self.assertTensorEqual(output, expected, atol=1e-5, rtol=1e-4)
+
+    def test_dit_context(self):
+        dit = WanDiT(
+            dim=128,
+            in_dim=4,
+            ffn_dim=128,
+            out_dim=4,
+            text_dim=32,
+            freq_dim=32,
+            eps=1e-6,
+            patch_size=(1, 2, 2),
+            num_heads=2,
+            num_layers=2,
+            has_image_input=False,
+            text_len=self.text_len,
+            device="cpu",
+            dtype=torch.float32,
+        ).eval()
+        x = torch.randn(2, 48, 128)
+        t_mod = torch.randn(2, 6, 128)
+        freqs = torch.randn(48, 1, 32, dtype=torch.complex64)
+        prompt_embs = [torch.randn(1, 7, 32), torch.randn(1, 12, 32)]
+
+        def run_blocks(context, context_mask):
+            hidden_states = x
+            for block in dit.blocks:
+                hidden_states = block(hidden_states, context, t_mod, freqs, 1, context_mask)
+            return hidden_states
+
+        with torch.no_grad():
+            # reference: context zero padded to text_len
+            padded = torch.cat([F.pad(emb, (0, 0, 0, self.text_len - emb.shape[1])) for emb in prompt_embs])
+            expected = run_blocks(*dit.embed_context(padded))
+
+            context, context_lens = WanVideoPipeline.pad_prompt_embs(prompt_embs)
+            self.assertEqual(context.shape[1], 12)
+            self.assertEqual(context_lens.tolist(), [7, 12])
+            output = run_blocks(*dit.embed_context(context, context_lens))
+        self.assertTensorEqual(output, expected, atol=1e-5, rtol=1e-4)
+
+    def test_padding_offset_precision(self):
+        dit = WanDiT(
+            dim=64,
+            in_dim=4,
+            ffn_dim=64,
+            out_dim=4,
+            text_dim=32,
+            freq_dim=32,
+            eps=1e-6,
+            patch_size=(1, 2, 2),
+            num_heads=2,
+            num_layers=1,
+            has_image_input=False,
+            text_len=512,
+            device="cpu",
+            dtype=torch.bfloat16,
+        )
+        _, context_mask = dit.embed_context(torch.randn(2, 212, 32, dtype=torch.bfloat16), torch.tensor([212, 100]))
+        self.assertEqual(context_mask.dtype, torch.float32)
+        self.assertTensorEqual(context_mask[:, 0, 0, -1], torch.tensor([300.0, 412.0]).log())
+
+        # 300 zero keys and the padding token for 300 more: its weight is 0.5 in bfloat16 attention with the float32
+        # offset, the offset rounded to bfloat16 gives 0.504
+        num_keys = 300
+        q = torch.randn(1, 2, 4, 8, dtype=torch.bfloat16)
+        k = torch.zeros(1, 2, num_keys + 1, 8, dtype=torch.bfloat16)
+        v = torch.zeros(1, 2, num_keys + 1, 8, dtype=torch.bfloat16)
+        v[:, :, num_keys] = 1
+        attn_mask = torch.zeros(1, 1, 1, num_keys + 1)
+        attn_mask[..., num_keys] = math.log(300)
+        for attn_impl in ["eager", "sdpa", "chunked"]:
+            output = attention(q, k, v, attn_impl=attn_impl, attn_mask=attn_mask)
+            self.assertTensorEqual(output, torch.full_like(output, 0.5))
@@ -0,0 +1,55 @@
+import unittest
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from diffsynth_engine.pipelines import BasePipeline
+from tests.common.test_case import TestCase
+
+
+class TinyVAEEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, kernel_size=8, stride=8)
+        self.num_calls = 0
+
+    def forward(self, image, tiled=False, tile_size=64, tile_stride=32):
+        self.num_calls += 1
+        return self.conv(image)
+
+
+class TinyPipeline(BasePipeline):
+    def __init__(self):
+        super().__init__(device="cpu", dtype=torch.float32)
+        self.vae_encoder = TinyVAEEncoder()
+        self.model_names = ["vae_encoder"]
+        self.loaded_models = []
+
+    def load_models_to_device(self, load_model_names=None):
+        self.loaded_models.append(load_model_names)
+
+
+class TestConditionCache(TestCase):
+    def test_encode_input_image(self):
+        torch.manual_seed(42)
+        pipe = TinyPipeline()
+        image = Image.fromarray(np.random.randint(0, 256, (32, 48, 3), dtype=np.uint8))
+        with torch.no_grad():
+            expected = pipe.encode_input_image(image)
+            pipe.enable_condition_cache()
+            self.assertTensorEqual(pipe.encode_input_image(image), expected)
+            # the same image content is not encoded again and the VAE encoder is not loaded
+            pipe.vae_encoder.num_calls, pipe.loaded_models = 0, []
+            self.assertTensorEqual(pipe.encode_input_image(image.copy()), expected)
+            self.assertEqual(pipe.vae_encoder.num_calls, 0)
+            self.assertEqual(pipe.loaded_models, [])
+            # other content, resolution or tiling are encoded
+            pipe.encode_input_image(image.transpose(Image.Transpose.FLIP_LEFT_RIGHT))
+            pipe.encode_input_image(image.resize((24, 16)))
+            pipe.encode_input_image(image, tiled=True)
+            self.assertEqual(pipe.vae_encoder.num_calls, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
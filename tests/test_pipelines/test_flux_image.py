@@ -19,6 +19,18 @@ class TestFLUXImage(ImageTestCase):
         )
         self.assertImageEqualAndSaveFailed(image, "flux/flux_txt2img.png", threshold=0.99)
 
+    def test_batch(self):
+        images = self.pipe(
+            prompt=["A cat holding a sign that says hello world", "a beautiful girl"],
+            width=1024,
+            height=1024,
+            num_inference_steps=50,
+            seed=[42, 7],
+        )
+        self.assertEqual(len(images), 2)
+        # each image of a batch is the same as generated alone with its seed
+        self.assertImageEqualAndSaveFailed(images[0], "flux/flux_txt2img.png", threshold=0.99)
+
     def test_inpainting(self):
         image = self.pipe(
             prompt="a beautiful girl with green hair",
@@ -58,6 +70,22 @@ class TestFLUXImage(ImageTestCase):
         self.pipe.unload_loras()
         self.assertImageEqualAndSaveFailed(image, "flux/flux_lora.png", threshold=0.98)
 
+    def test_t5_truncation(self):
+        self.pipe.enable_t5_truncation(length_buckets=(128, 256))
+        self.assertEqual(self.pipe.get_t5_max_length(["A cat holding a sign that says hello world", ""]), 128)
+        try:
+            image = self.pipe(
+                prompt="A cat holding a sign that says hello world",
+                width=1024,
+                height=1024,
+                num_inference_steps=50,
+                seed=42,
+            )
+        finally:
+            self.pipe.disable_t5_truncation()
+        # compare with the image of the full 512 tokens
+        self.assertImageEqualAndSaveFailed(image, "flux/flux_txt2img.png", threshold=0.95)
+
 
 class TestFLUXGGUF(ImageTestCase):
     @classmethod
@@ -0,0 +1,43 @@
+import torch
+
+from diffsynth_engine.pipelines import BasePipeline
+from tests.common.test_case import TestCase
+
+
+class TestPipelineBatch(TestCase):
+    def test_prepare_batch(self):
+        prompts, negative_prompts, seeds = BasePipeline.prepare_batch("a cat", "blurry", 42)
+        self.assertEqual((prompts, negative_prompts, seeds), (["a cat"], ["blurry"], [42]))
+
+        prompts, negative_prompts, seeds = BasePipeline.prepare_batch(["a", "b"], ["x", "y"], 7, 2)
+        self.assertEqual(prompts, ["a", "a", "b", "b"])
+        self.assertEqual(negative_prompts, ["x", "x", "y", "y"])
+        self.assertEqual(seeds, [7, 8, 9, 10])
+
+        # a single prompt is repeated for every seed
+        prompts, negative_prompts, seeds = BasePipeline.prepare_batch("a", "", [1, 5, 3])
+        self.assertEqual((prompts, negative_prompts, seeds), (["a"] * 3, [""] * 3, [1, 5, 3]))
+        self.assertEqual(BasePipeline.prepare_batch(["a", "b"])[2], [None, None])
+
+        with self.assertRaises(ValueError):
+            BasePipeline.prepare_batch(["a", "b"], seed=[1, 2, 3])
+        with self.assertRaises(ValueError):
+            BasePipeline.prepare_batch(["a", "b"], negative_prompt=["x"])
+
+        self.assertFalse(BasePipeline.is_batch_call("a", 42, 1))
+        self.assertTrue(BasePipeline.is_batch_call(["a"], 42, 1))
+        self.assertTrue(BasePipeline.is_batch_call("a", [42], 1))
+        self.assertTrue(BasePipeline.is_batch_call("a", None, 2))
+
+    def test_generate_noise(self):
+        single = BasePipeline.generate_noise((1, 4, 8, 8), seed=42, dtype=torch.float32)
+        batch = BasePipeline.generate_noise((3, 4, 8, 8), seed=[7, 42, None], dtype=torch.float32)
+        self.assertEqual(batch.shape, (3, 4, 8, 8))
+        self.assertTrue(torch.equal(batch[1:2], single))
+        with self.assertRaises(ValueError):
+            BasePipeline.generate_noise((2, 4, 8, 8), seed=[42])
+
+    def test_unique_prompts(self):
+        unique, index = BasePipeline.unique_prompts(["a", "b", "a", "", ""])
+        self.assertEqual(unique, ["a", "b", ""])
+        self.assertEqual(index.tolist(), [0, 1, 0, 2, 2])
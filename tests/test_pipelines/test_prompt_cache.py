@@ -0,0 +1,120 @@
+import tempfile
+import unittest
+import torch
+import torch.nn as nn
+
+from diffsynth_engine.models.basic.lora import LoRALinear
+from diffsynth_engine.pipelines import BasePipeline
+from diffsynth_engine.utils.tensor_cache import TensorCache, lora_fingerprint, model_fingerprint
+from tests.common.test_case import TestCase
+
+
+class TinyTextEncoder(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(16, 8)
+        self.proj = LoRALinear(8, 8)
+        self.num_calls = 0
+
+    def forward(self, input_ids):
+        self.num_calls += 1
+        return self.proj(self.embedding(input_ids))
+
+
+class TinyPipeline(BasePipeline):
+    def __init__(self):
+        super().__init__(device="cpu", dtype=torch.float32)
+        self.text_encoder = TinyTextEncoder()
+        self.model_names = ["text_encoder"]
+        self.loaded_models = []
+
+    def load_models_to_device(self, load_model_names=None):
+        self.loaded_models.append(load_model_names)
+
+    def encode_prompt(self, input_ids: torch.Tensor, clip_skip: int = 1) -> torch.Tensor:
+        def encode(indices):
+            return {"prompt_emb": self.text_encoder(input_ids[indices])}
+
+        embs = self.encode_prompt_with_cache(["text_encoder"], [input_ids], encode, clip_skip=clip_skip)
+        return torch.cat([emb["prompt_emb"] for emb in embs])
+
+
+class TestPromptCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        torch.manual_seed(42)
+
+    def test_tensor_cache(self):
+        entry = {"emb": torch.zeros(4, 8)}  # 128 bytes
+        cache = TensorCache(max_memory_bytes=300)
+        cache.put("a", entry)
+        cache.put("b", entry)
+        self.assertIsNotNone(cache.get("a"))
+        # "b" is the least recently used entry when "c" exceeds the budget
+        cache.put("c", entry)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.memory_bytes, 256)
+        # entries larger than the budget are not kept in memory
+        cache.put("d", {"emb": torch.zeros(100, 8)})
+        self.assertIsNone(cache.get("d"))
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            TensorCache(cache_dir=cache_dir).put("a", {"emb": torch.randn(2, 3, dtype=torch.bfloat16)})
+            # another process finds the entry on disk
+            cache = TensorCache(cache_dir=cache_dir)
+            self.assertIn("a", cache)
+            self.assertEqual(cache.get("a")["emb"].dtype, torch.bfloat16)
+            self.assertEqual(len(cache), 1)
+
+    def test_fingerprint(self):
+        encoder = TinyTextEncoder()
+        fingerprint = model_fingerprint(encoder)
+        self.assertEqual(model_fingerprint(encoder), fingerprint)
+        self.assertNotEqual(model_fingerprint(TinyTextEncoder()), fingerprint)
+
+        self.assertEqual(lora_fingerprint(encoder), "")
+        lora_args = dict(name="proj", rank=2, alpha=2, up=torch.randn(8, 2), down=torch.randn(2, 8), device="cpu")
+        encoder.proj.add_lora(scale=1.0, dtype=torch.float32, **lora_args)
+        with_lora = lora_fingerprint(encoder)
+        self.assertNotEqual(with_lora, "")
+        encoder.proj.modify_scale("proj", 0.5)
+        self.assertNotEqual(lora_fingerprint(encoder), with_lora)
+        encoder.proj.clear()
+        self.assertEqual(lora_fingerprint(encoder), "")
+
+    def test_encode_prompt(self):
+        pipe = TinyPipeline()
+        input_ids = torch.randint(0, 16, (3, 5))
+        with torch.no_grad():
+            expected = pipe.encode_prompt(input_ids)
+            pipe.enable_prompt_cache()
+            self.assertTensorEqual(pipe.encode_prompt(input_ids[:2]), expected[:2])
+            # only the third prompt is encoded
+            pipe.text_encoder.num_calls, pipe.loaded_models = 0, []
+            self.assertTensorEqual(pipe.encode_prompt(input_ids), expected)
+            self.assertEqual(pipe.text_encoder.num_calls, 1)
+            # all prompts are cached, the text encoder is not even loaded
+            pipe.text_encoder.num_calls, pipe.loaded_models = 0, []
+            self.assertTensorEqual(pipe.encode_prompt(input_ids), expected)
+            self.assertEqual(pipe.text_encoder.num_calls, 0)
+            self.assertEqual(pipe.loaded_models, [])
+            # other encoder settings and LoRA are different keys
+            pipe.encode_prompt(input_ids, clip_skip=2)
+            self.assertEqual(pipe.text_encoder.num_calls, 1)
+            pipe.text_encoder.proj.add_lora(
+                name="proj",
+                scale=1.0,
+                rank=2,
+                alpha=2,
+                up=torch.randn(8, 2),
+                down=torch.randn(2, 8),
+                device="cpu",
+                dtype=torch.float32,
+            )
+            self.assertFalse(torch.allclose(pipe.encode_prompt(input_ids), expected))
+            self.assertEqual(pipe.text_encoder.num_calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
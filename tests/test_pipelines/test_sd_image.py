@@ -15,6 +15,13 @@ class TestSDImage(ImageTestCase):
         image = self.pipe(prompt="beautiful girl", width=512, height=512, num_inference_steps=20, seed=42)
         self.assertImageEqualAndSaveFailed(image, "sd/sd_txt2img.png", threshold=0.99)
 
+    def test_batch(self):
+        images = self.pipe(
+            prompt=["beautiful girl", "a cat"], width=512, height=512, num_inference_steps=20, seed=[42, 42]
+        )
+        self.assertEqual(len(images), 2)
+        self.assertImageEqualAndSaveFailed(images[0], "sd/sd_txt2img.png", threshold=0.99)
+
     def test_inpainting(self):
         image = self.pipe(
             prompt="a beautiful girl with green hair",
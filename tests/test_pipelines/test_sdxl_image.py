@@ -18,6 +18,20 @@ class TestSDXLImage(ImageTestCase):
 
         self.assertImageEqualAndSaveFailed(image, "sdxl/sdxl_txt2img.png", threshold=0.99)
 
+    def test_batch(self):
+        images = self.pipe(
+            prompt="a beautiful girl",
+            width=1024,
+            height=1024,
+            num_inference_steps=20,
+            seed=42,
+            clip_skip=2,
+            num_images_per_prompt=2,
+        )
+        self.assertEqual(len(images), 2)
+        # the first image of seeds 42, 43 is the same as generated alone with seed 42
+        self.assertImageEqualAndSaveFailed(images[0], "sdxl/sdxl_txt2img.png", threshold=0.99)
+
     def test_inpainting(self):
         image = self.pipe(
             prompt="a beautiful girl with green hair",
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from PIL import Image
+
+from diffsynth_engine.utils.video import save_video, load_video
+from tests.common.test_case import TestCase
+
+
+class TestVideoWriter(TestCase):
+    def test_save_video_chunks(self):
+        frames = [np.full((32, 48, 3), i * 20, dtype=np.uint8) for i in range(9)]
+        with tempfile.TemporaryDirectory() as save_dir:
+            save_video([Image.fromarray(frame) for frame in frames], os.path.join(save_dir, "images.mp4"))
+            # chunks of frames are written as they come, the way WanVideoPipeline.stream yields them
+            chunks = (np.stack(frames[start:end]) for start, end in [(0, 1), (1, 5), (5, 9)])
+            save_video(chunks, os.path.join(save_dir, "chunks.mp4"))
+
+            expected = load_video(os.path.join(save_dir, "images.mp4")).frames
+            result = load_video(os.path.join(save_dir, "chunks.mp4")).frames
+            self.assertEqual(len(result), 9)
+            for result_frame, expected_frame in zip(result, expected):
+                self.assertTrue(np.array_equal(np.asarray(result_frame), np.asarray(expected_frame)))
+
+    def test_save_video_batch_chunks(self):
+        # a batched WanVideoPipeline.stream yields one chunk per video, which are not frames of a single video
+        chunks = [[np.zeros((4, 32, 48, 3), dtype=np.uint8) for _ in range(2)]]
+        with tempfile.TemporaryDirectory() as save_dir:
+            with self.assertRaises(ValueError):
+                save_video(chunks, os.path.join(save_dir, "batch.mp4"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,6 +23,19 @@ class TestWanVideo(VideoTestCase):
         )
         self.save_video(video, "wan_t2v.mp4")
 
+    def test_batch(self):
+        videos = self.pipe(
+            prompt=["一只活泼的小狗在绿茵茵的草地上迅速奔跑。", "一只橘猫趴在窗台上晒太阳，尾巴轻轻摆动。"],
+            num_frames=41,
+            width=480,
+            height=480,
+            seed=[42, 7],
+        )
+        self.assertEqual(len(videos), 2)
+        for i, video in enumerate(videos):
+            self.assertEqual(len(video), 41)
+            self.save_video(video, f"wan_t2v_batch_{i}.mp4")
+
 
 class TestWanVideoTP(VideoTestCase):
     @classmethod